@@ -10,7 +10,13 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import bisect
+import collections
+import sys
+from array import array
+
 import file_utils as fu
+import lookup as lk
 import utils as u
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
@@ -147,495 +153,736 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""One VCF record as the stages see it
+
+   fields are the columns as read; chrom (interned), pos, ref and alt are
+   parsed once from them (at the format's indices) so the stages need not
+   strip and convert them again. INFO is kept as a list of parts that the
+   stages append to and that is only joined when it is read or written,
+   so building it is linear in its length.
 """
 
+INFO = 7
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+class VariantRecord(object):
+    __slots__ = ("fields", "chrom", "pos", "ref", "alt", "info")
 
-    inds = getFormatSpecificIndices(format=format)
+    def __init__(self, fields, inds):
+        self.fields = fields
+        self.chrom = sys.intern(fields[inds[0]].strip())
+        self.pos = int(fields[inds[1]].strip())
+        self.ref = fields[inds[2]].strip()
+        self.alt = fields[inds[3]].strip()
+        self.info = [fields[INFO]] if len(fields) > INFO else None
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def getInfo(self):
+        if len(self.info) > 1:
+            self.info = ["".join(self.info)]
+        return self.info[0]
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+    def setInfo(self, text):
+        self.info = [text]
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
-
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+    ## Appends text to INFO as it is
+    def extendInfo(self, text):
+        self.info.append(text)
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+    ## Appends an annotation to INFO, after a ";" unless INFO ends with one
+    def addInfo(self, text):
+        for part in reversed(self.info):
+            if part != "":
+                if not part.endswith(";"):
+                    self.info.append(";")
+                break
+        else:
+            self.info.append(";")
+        self.info.append(text)
+
+    ## Prefixes every column but the first with prefix
+    def indent(self, prefix):
+        fields = self.fields
+        for i in range(1, len(fields)):
+            fields[i] = prefix + fields[i]
+        if self.info is not None:
+            self.info.insert(0, prefix)
+
+    ## Strips trailing whitespace off the last column, as reading the record
+    ## back from a file would
+    def stripLast(self):
+        if self.info is not None and len(self.fields) == INFO + 1:
+            info = self.info
+            info[-1] = info[-1].rstrip()
+            while len(info) > 1 and info[-1] == "":
+                info.pop()
+                info[-1] = info[-1].rstrip()
+        else:
+            self.fields[-1] = self.fields[-1].rstrip()
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+    def line(self, sep="\t"):
+        if self.info is not None:
+            self.fields[INFO] = self.getInfo()
+        return sep.join(self.fields)
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+"""Comment and header lines are passed through every stage unchanged
+"""
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def isHeader(line):
+    return line.startswith("#") or line.startswith("CHROM")
 
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
-"""
+"""Base class of the annotation stages
 
+   A stage annotates one VariantRecord in place.
+   annotateBlock receives runs of consecutive records, so stages that can
+   resolve several records with one lookup override it. Counters are
+   written to the .count.log by writeLog once every record has been seen.
+   getCounters/addCounters let the counters of stages that annotated
+   different parts of a file be added up before writeLog.
+"""
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+class Stage(object):
+    label = ""
+    counters = ()
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
+    def __init__(self, format="vcf"):
+        self.inds = getFormatSpecificIndices(format=format)
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
+    def annotate(self, record):
+        raise NotImplementedError
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
+    def annotateBlock(self, block):
+        for record in block:
+            self.annotate(record)
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    def getCounters(self):
+        return dict((name, getattr(self, name)) for name in self.counters)
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+    def addCounters(self, counters):
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
+    def writeLog(self, fh_log):
+        pass
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+    def close(self):
+        pass
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+"""Annotates the records of a block and writes them out
+"""
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+def flushBlock(fh_out, stage, block):
+    if len(block) > 0:
+        stage.annotateBlock(block)
+        for record in block:
+            fh_out.write(record.line() + "\n")
+        del block[:]
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+"""Runs one stage over vcf + tmpextin and writes vcf + tmpextout;
+   the stage counters go to vcf + .count.log (opened with logmode)
+"""
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+def runStage(
+    vcf, stage, tmpextin="", tmpextout=".1", sep="\t", logmode="a", block_size=1000
+):
+    fh = open(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+    block = []
 
-            if keep_going:
-                fh_out.write(line + "\n")
+    for line in fh:
+        line = line.strip()
+        if isHeader(line):
+            flushBlock(fh_out, stage, block)
+            fh_out.write(line + "\n")
+        else:
+            block.append(VariantRecord(line.split(sep), stage.inds))
+            if len(block) >= block_size:
+                flushBlock(fh_out, stage, block)
 
-            vcf_linenum = vcf_linenum + 1
+    flushBlock(fh_out, stage, block)
 
-        else:
-            fh_out.write(line + "\n")
+    fh_log = open(vcf + ".count.log", logmode)
+    stage.writeLog(fh_log)
+    fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
 
-"""Get information about location in gene structures
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
 """
 
+DBSNP_KEY = dict(
+    chrom_col="CHR", start_col="POS", end_col="POS", columns="REF, INFO, dbSNP.*"
+)
+
+
+class DbSnpStage(Stage):
+    label = "dbSNP"
+    counters = ("var_count", "linenum")
+
+    def __init__(self, lookup, format="vcf", varclass="SNV", batch_size=0):
+        Stage.__init__(self, format=format)
+        self.lookup = lookup
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.var_count = 0
+        self.linenum = 1
+
+    def variant(self, record):
+        chr = record.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+
+        compRef = getComplementary(record.ref)
+        return (chr, record.pos, record.ref, compRef)
+
+    ## REF = ref OR REF = compRef, and INFO = varclass, as lookup filters;
+    ## the block lookup filters on INFO only, its positions have other refs
+    def filters(self, ref=None, compRef=None):
+        filters = ((("INFO",), ((self.varclass,),)),)
+        if ref is None:
+            return filters
+        return ((("REF",), ((ref,), (compRef,))),) + filters
+
+    ## Rows at the variant position with REF = ref OR REF = compRef and
+    ## INFO = varclass, compared like the server does
+    def match(self, rows, ref, compRef):
+        refs = (ref.upper(), compRef.upper())
+        varclass = self.varclass.upper()
+        return [
+            r[2:]
+            for r in rows
+            if str(r[0]).upper() in refs and str(r[1]).upper() == varclass
+        ]
+
+    def annotate(self, record):
+        chr, pos, ref, compRef = self.variant(record)
+        rows = self.lookup.overlap(
+            "dbSNP", chr, pos, filters=self.filters(ref, compRef), **DBSNP_KEY
+        )
+        self.annotateRows(record, self.match(rows, ref, compRef))
+
+    ## Looks up the positions of the whole block, batch_size positions of one
+    ## chromosome at a time, and matches REF back per record
+    def annotateBlock(self, block):
+        if self.batch_size <= 0:
+            return Stage.annotateBlock(self, block)
+
+        variants = [self.variant(record) for record in block]
+        keys = {}
+        for chr, pos, ref, compRef in variants:
+            keys.setdefault(chr, set()).add(pos)
+
+        found = {}
+        filters = self.filters()
+        for chr, positions in keys.items():
+            positions = sorted(positions)
+            for i in range(0, len(positions), self.batch_size):
+                batch = positions[i : i + self.batch_size]
+                rows = self.lookup.overlapBlock(
+                    "dbSNP", chr, batch, filters=filters, **DBSNP_KEY
+                )
+                for pos, r in zip(batch, rows):
+                    found[(chr, pos)] = r
+
+        for record, (chr, pos, ref, compRef) in zip(block, variants):
+            self.annotateRows(record, self.match(found[(chr, pos)], ref, compRef))
+
+    def annotateRows(self, record, rows):
+        fields = record.fields
+        varclass = self.varclass
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = "."
+        rsids = []
+        mafs = []
+        if len(rows) > 0:
+            for row in rows:
+                rsids.append(str(row[3]))
+                if str(row[7]) != ".":
+                    mafs.append("GMAF=" + str(row[7]))
+
+            maf_str = ""
+            if len(mafs) > 0:
+                maf_str = ";" + ";".join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if record.getInfo() == ".":
+                record.setInfo("DB" + maf_str)
+            else:
+                record.extendInfo(";DB;VC=" + varclass + maf_str)
+
+            fields[2] = str(";".join(rsids))
 
-def getGenes(
+        self.linenum = self.linenum + 1
+
+    ## linenum starts at 1, so only the lines seen are handed out
+    def getCounters(self):
+        counters = Stage.getCounters(self)
+        counters["linenum"] = counters["linenum"] - 1
+        return counters
+
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+def getSnpsFromDbSnp(
     vcf,
     format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
     sep="\t",
+    batch_size=0,
+    lookup="sql",
 ):
+    lookup = lk.openLookup(lookup)
+    stage = DbSnpStage(lookup, format=format, varclass=varclass, batch_size=batch_size)
+    runStage(vcf, stage, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep, logmode="w")
+    stage.close()
+    lookup.close()
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+
+BIGREFGENE_TIERS = [
+    (
+        "chrom_pos_equal_base",
+        "start",
+        "start",
+        "haplotypeReference, haplotypeAlternate, chrom_pos_equal_base.*",
+    ),
+    ("chrom_pos_equal_nobase", "start", "start", "*"),
+    ("chrom_pos_unequal", "start", "end", "*"),
+]
+
+
+"""Splits sorted positions into windows of at most batch_size positions
+   spanning at most WINDOW_SPAN bases
+"""
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
 
+def positionWindows(positions, batch_size):
+    window = []
+    for pos in positions:
+        if len(window) > 0 and (
+            len(window) >= batch_size or pos - window[0] > WINDOW_SPAN
+        ):
+            yield window
+            window = []
+        window.append(pos)
+    if len(window) > 0:
+        yield window
+
+
+class BigRefGeneStage(Stage):
+    label = "BigRefGene"
+
+    def __init__(self, lookup, format="vcf", batch_size=0):
+        Stage.__init__(self, format=format)
+        self.lookup = lookup
+        self.batch_size = batch_size
+
+    def variant(self, record):
+        chr = record.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+
+        ref = record.ref
+        alt = record.alt
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        ## (haplotypeReference, haplotypeAlternate) accepted by the first tier
+        alleles = [(ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper())]
+        return (chr, record.pos, alleles, ((ref, alt), (compRef, compAlt)))
+
+    ## Rows of tier i that annotate a variant with alleles
+    def accept(self, i, rows, alleles):
+        if i == 0:
+            return [
+                r[2:] for r in rows if (str(r[0]).upper(), str(r[1]).upper()) in alleles
+            ]
+        return rows
+
+    def annotate(self, record):
+        chr, pos, alleles, pairs = self.variant(record)
+
+        for i, (table, start_col, end_col, columns) in enumerate(BIGREFGENE_TIERS):
+            filters = None
+            if i == 0:
+                filters = ((("haplotypeReference", "haplotypeAlternate"), pairs),)
+            rows = self.lookup.overlap(
+                table,
+                chr,
+                pos,
+                chrom_col="CHR",
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+            rows = self.accept(i, rows, alleles)
             if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
+                self.annotateRows(record, rows)
+                break
+
+    ## Resolves the block tier by tier: each tier is looked up once per
+    ## window for the positions of the records no earlier tier annotated,
+    ## so a window costs at most one lookup per tier, and the precedence is
+    ## applied per record in memory
+    def annotateBlock(self, block):
+        if self.batch_size <= 0:
+            return Stage.annotateBlock(self, block)
+
+        variants = [self.variant(record) for record in block]
+        pending = list(range(len(block)))
+        for i, (table, start_col, end_col, columns) in enumerate(BIGREFGENE_TIERS):
+            keys = {}
+            for n in pending:
+                chr, pos, alleles, pairs = variants[n]
+                keys.setdefault(chr, set()).add(pos)
+
+            found = {}
+            for chr, positions in keys.items():
+                for window in positionWindows(sorted(positions), self.batch_size):
+                    rows = self.lookup.overlapBlock(
+                        table,
+                        chr,
+                        window,
+                        chrom_col="CHR",
+                        start_col=start_col,
+                        end_col=end_col,
+                        columns=columns,
                     )
+                    for pos, r in zip(window, rows):
+                        found[(chr, pos)] = r
 
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
+            unresolved = []
+            for n in pending:
+                chr, pos, alleles, pairs = variants[n]
+                rows = self.accept(i, found[(chr, pos)], alleles)
+                if len(rows) > 0:
+                    self.annotateRows(block[n], rows)
+                else:
+                    unresolved.append(n)
+            pending = unresolved
+            if len(pending) == 0:
+                break
 
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
+    ## all isoforms collapsed into INFO
+    def annotateRows(self, record, rows):
+        m = set([])
+        for row in rows:
+            m.add(collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]])))
 
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
+        record.extendInfo(";" + ";".join(m))
+        info = record.getInfo()
+        if info.startswith(".;"):
+            record.setInfo(info.replace(".;", "", 1))
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+def getBigRefGene(
+    vcf,
+    format="vcf",
+    tmpextin=".1",
+    tmpextout=".2",
+    sep="\t",
+    batch_size=0,
+    lookup="sql",
+):
+    lookup = lk.openLookup(lookup)
+    stage = BigRefGeneStage(lookup, format=format, batch_size=batch_size)
+    runStage(vcf, stage, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+    stage.close()
+    lookup.close()
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+"""Counters of the gene structure stages
+"""
 
-        else:
-            fh_out.write(line + "\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+class GeneCounts(object):
+    def __init__(self):
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    def getCounters(self):
+        return dict(vars(self))
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    def addCounters(self, counters):
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In '3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In '5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
+
+
+"""Get information about location in gene structures
 """
 
+"""Exon structure of one transcript, parsed once from exonStarts/exonEnds
 
-def getExonsEtAl(
+   refGene exons are sorted and do not overlap, so the exons containing a
+   position are found with a bisect on the starts; transcripts that break
+   that order are scanned exon by exon
+"""
+
+
+class ExonIndex(object):
+    __slots__ = ("count", "starts", "ends", "ordered")
+
+    def __init__(self, exonCount, exonStarts, exonEnds):
+        self.count = exonCount
+        self.starts = array("i", [int(x) for x in exonStarts.split(",")[0:exonCount]])
+        self.ends = array("i", [int(x) for x in exonEnds.split(",")[0:exonCount]])
+        self.ordered = all(
+            self.starts[e] <= self.starts[e + 1] and self.ends[e] <= self.ends[e + 1]
+            for e in range(len(self.starts) - 1)
+        )
+
+    ## Numbers of the exons containing pos, counted from the 5' end
+    def exonNumbers(self, pos, strand):
+        if self.ordered:
+            hits = []
+            e = bisect.bisect_right(self.starts, pos) - 1
+            while e >= 0 and self.ends[e] >= pos:
+                hits.append(e)
+                e = e - 1
+            hits.reverse()
+        else:
+            hits = [
+                e
+                for e in range(len(self.starts))
+                if u.isBetween(pos, self.starts[e], self.ends[e])
+            ]
+
+        if strand == "-":
+            return [self.count - e for e in hits]
+        return [e + 1 for e in hits]
+
+
+"""Exon index of a refGene row, cached per transcript
+"""
+
+
+def getExonIndex(cache, row):
+    key = (row[1], row[2], row[4], row[5])
+    exons = cache.get(key)
+    if exons is None:
+        exons = ExonIndex(
+            int(row[8]), str(row[9].decode("utf-8")), str(row[10].decode("utf-8"))
+        )
+        cache[key] = exons
+    return exons
+
+
+"""First CpG island containing a position, or None
+
+   Every transcript of a variant in a promoter window asks for the same
+   position, so the answers for the last size positions are kept
+"""
+
+CPG_CACHE_SIZE = 10000
+
+
+class CpgIslands(object):
+    def __init__(self, lookup, size=CPG_CACHE_SIZE):
+        self.lookup = lookup
+        self.size = size
+        self.cache = collections.OrderedDict()
+
+    def get(self, chr, pos):
+        key = (chr, pos)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        rows = self.lookup.overlap(
+            "cpgIslandExt", chr, pos, columns="chrom, chromStart, chromEnd, name"
+        )
+        cpg = rows[0] if len(rows) > 0 else None
+        self.cache[key] = cpg
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return cpg
+
+
+class GenesStage(Stage):
+    label = "Genes"
+
+    def __init__(self, lookup, format="vcf", table="refGene", promoter_offset=500):
+        Stage.__init__(self, format=format)
+        self.lookup = lookup
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.counts = GeneCounts()
+        self.exons = {}
+        self.cpgIslands = CpgIslands(lookup)
+
+    def annotate(self, record):
+        promoter_offset = self.promoter_offset
+        counts = self.counts
+
+        chr = record.chrom
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = record.pos
+        info_field = clean_mysql_chars(record.getInfo()).strip()
+
+        ## (txStart - offset) <= pos AND pos <= (txEnd + offset)
+        offset = int(promoter_offset)
+        rows = self.lookup.overlap(
+            self.table,
+            chr,
+            pos - offset,
+            pos + offset,
+            start_col="txStart",
+            end_col="txEnd",
+        )
+        info = []
+
+        ## rows may be a stream (see lookup.StreamLookup), read once; cnt
+        ## counts the transcripts as they are read
+        cnt = 1
+        for row in rows:
+            # count location
+            positionType = str(u.parse_field(info_field, "positionType", ";", "="))
+
+            if positionType == "intron":
+                counts.intronic_count = counts.intronic_count + 1
+            elif positionType == "non_coding_intron":
+                counts.non_coding_intronic_count = counts.non_coding_intronic_count + 1
+            elif positionType == "CDS":
+                counts.cds_count = counts.cds_count + 1
+            elif positionType == "non_coding_exon":
+                counts.non_coding_exonic_count = counts.non_coding_exonic_count + 1
+            elif positionType == "utr5":
+                counts.utr5_count = counts.utr5_count + 1
+            elif positionType == "utr3":
+                counts.utr3_count = counts.utr3_count + 1
+
+            txtStart = int(row[4])
+            txtEnd = int(row[5])
+            cdsStart = int(row[6])
+            cdsEnd = int(row[7])
+            exonCount = int(row[8])
+            exonIndex = getExonIndex(self.exons, row)
+            strand = str(row[3])
+
+            promoter_plus = txtStart - int(promoter_offset)
+            promoter_minus = txtEnd + int(promoter_offset)
+            region = ""
+            exons = []
+
+            if cdsStart == cdsEnd:
+                for exnum in exonIndex.exonNumbers(pos, strand):
+                    exons.append(
+                        "non_coding_exon=" + "ex" + str(exnum) + "/" + str(exonCount)
+                    )
+                if len(exons) > 0:
+                    region = ";".join(exons)
+            elif u.isBetween(pos, cdsStart, cdsEnd):
+                for exnum in exonIndex.exonNumbers(pos, strand):
+                    exons.append("exon=" + "ex" + str(exnum) + "/" + str(exonCount))
+                    counts.exonic_count = counts.exonic_count + 1
+                if len(exons) > 0:
+                    region = ";".join(exons)
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or (
+                u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")
+            ):
+                cpg = self.cpgIslands.get(chr, pos)
+
+                if cpg is not None:
+                    region = "putativePromoterRegion=" + "".join(str(cpg[3]).split())
+                    counts.promoter_count = counts.promoter_count + 1
+
+            if region != "":
+                info.append(
+                    collapseGeneNames(
+                        row=row,
+                        indices=indicesKnownGenes,
+                        region=region,
+                        cnt=cnt,
+                    )
+                )
+
+            cnt = cnt + 1
+
+        if cnt > 1:
+            str_info = ";".join(info)
+            record.extendInfo(";" + str_info)
+
+        else:
+            record.extendInfo(";positionType=interGenic")
+            counts.interGenic_count = counts.interGenic_count + 1
+
+    def getCounters(self):
+        return self.counts.getCounters()
+
+    def addCounters(self, counters):
+        self.counts.addCounters(counters)
+
+    def writeLog(self, fh_log):
+        self.counts.writeLog(fh_log)
+
+
+def getGenes(
     vcf,
     format="vcf",
     table="refGene",
@@ -643,263 +890,327 @@ def getExonsEtAl(
     tmpextin=".2",
     tmpextout=".3",
     sep="\t",
+    lookup="sql",
 ):
+    lookup = lk.openLookup(lookup)
+    stage = GenesStage(
+        lookup, format=format, table=table, promoter_offset=promoter_offset
+    )
+    runStage(vcf, stage, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+    stage.close()
+    lookup.close()
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "-"
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "-")
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
 
+class ExonsEtAlStage(Stage):
+    label = "ExonsEtAl"
+
+    def __init__(self, lookup, format="vcf", table="refGene", promoter_offset=500):
+        Stage.__init__(self, format=format)
+        self.lookup = lookup
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.counts = GeneCounts()
+        self.exons = {}
+        self.cpgIslands = CpgIslands(lookup)
+
+    def annotate(self, record):
+        promoter_offset = self.promoter_offset
+        counts = self.counts
+
+        chr = record.chrom
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = record.pos
+
+        ## (txStart - offset) <= pos AND pos <= (txEnd + offset)
+        offset = int(promoter_offset)
+        rows = self.lookup.overlap(
+            self.table,
+            chr,
+            pos - offset,
+            pos + offset,
+            start_col="txStart",
+            end_col="txEnd",
+        )
+        info = []
+        if len(rows) > 0:
+            cnt = 1
+            for row in rows:
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                exonIndex = getExonIndex(self.exons, row)
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                exons = []
+
+                if cdsStart == cdsEnd:
+                    for exnum in exonIndex.exonNumbers(pos, strand):
+                        exons.append(
+                            "non_coding_exon="
+                            + "ex"
+                            + str(exnum)
+                            + "/"
+                            + str(exonCount)
+                        )
+                        counts.non_coding_exonic_count = (
+                            counts.non_coding_exonic_count + 1
+                        )
+                    if len(exons) > 0:
+                        region = "positionType=non_coding_exon;" + ";".join(exons)
                     else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
+                        counts.non_coding_intronic_count = (
+                            counts.non_coding_intronic_count + 1
                         )
+                        region = "positionType=non_coding_intron"
+
+                elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                    counts.cds_count = counts.cds_count + 1
+                    for exnum in exonIndex.exonNumbers(pos, strand):
+                        exons.append("exon=" + "ex" + str(exnum) + "/" + str(exonCount))
+                        counts.exonic_count = counts.exonic_count + 1
+                    if len(exons) > 0:
+                        region = "positionType=CDS;" + ";".join(exons)
+                    else:
+                        counts.intronic_count = counts.intronic_count + 1
+                        region = "positionType=CDS;" + "intron"
+
+                elif (
+                    u.isBetween(pos, txtStart, cdsStart)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "+")
+                ):
+                    counts.utr5_count = counts.utr5_count + 1
+                    region = "positionType=utr5"
+
+                elif (
+                    u.isBetween(pos, cdsEnd, txtEnd)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "+")
+                ):
+                    counts.utr3_count = counts.utr3_count + 1
+                    region = "positionType=utr3"
+
+                elif (
+                    u.isBetween(pos, cdsEnd, txtEnd)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "-")
+                ):
+                    counts.utr5_count = counts.utr5_count + 1
+                    region = "positionType=utr5"
+
+                elif (
+                    u.isBetween(pos, txtStart, cdsStart)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "-")
+                ):
+                    counts.utr3_count = counts.utr3_count + 1
+                    region = "positionType=utr3"
+
+                elif (
+                    u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")
+                ) or (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    cpg = self.cpgIslands.get(chr, pos)
+
+                    if cpg is not None:
+                        region = "putativePromoterRegion=" + "".join(
+                            str(cpg[3]).split()
+                        )
+                        counts.promoter_count = counts.promoter_count + 1
+
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
 
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+                cnt = cnt + 1
 
-            linenum = linenum + 1
+            str_info = ";".join(info)
+            record.extendInfo(";" + str_info)
 
         else:
-            fh_out.write(line + "\n")
+            record.extendInfo(";positionType=interGenic")
+            counts.interGenic_count = counts.interGenic_count + 1
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    def getCounters(self):
+        return self.counts.getCounters()
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    def addCounters(self, counters):
+        self.counts.addCounters(counters)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    def writeLog(self, fh_log):
+        self.counts.writeLog(fh_log)
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    lookup="sql",
+):
+    lookup = lk.openLookup(lookup)
+    stage = ExonsEtAlStage(
+        lookup, format=format, table=table, promoter_offset=promoter_offset
+    )
+    runStage(vcf, stage, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+    stage.close()
+    lookup.close()
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+"""Base class of the stages that overlap variants with an interval table
+   through a lookup backend (see lookup.py); counts hits per variant
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+   Subclasses name the table and chromosome to search in target() and add
+   the rows found to the record in annotateRows(). With batch_size > 0,
+   runs of up to batch_size consecutive records on the same chromosome
+   (spanning at most WINDOW_SPAN bases) are resolved with one lookup.
+"""
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+WINDOW_SPAN = 1000000
+
+
+class OverlapStage(Stage):
+    counters = ("var_count", "line_count")
+    chrom_col = "chrom"
+    start_col = "chromStart"
+    end_col = "chromEnd"
+    columns = "*"
+
+    def __init__(self, lookup, format="vcf", table="", batch_size=0):
+        Stage.__init__(self, format=format)
+        self.lookup = lookup
+        self.table = table
+        self.label = table
+        self.batch_size = batch_size
+        self.var_count = 0
+        self.line_count = 0
+
+    def chrom(self, record):
+        chr = record.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def target(self, record):
+        return (self.table, self.chrom(record))
+
+    def annotateRows(self, record, rows):
+        raise NotImplementedError
+
+    def annotate(self, record):
+        target = self.target(record)
+        if target is not None:
+            rows = self.lookup.overlap(
+                target[0],
+                target[1],
+                record.pos,
+                chrom_col=self.chrom_col,
+                start_col=self.start_col,
+                end_col=self.end_col,
+                columns=self.columns,
+            )
+            self.annotateRows(record, rows)
+
+    def annotateBlock(self, block):
+        if self.batch_size <= 0:
+            return Stage.annotateBlock(self, block)
+
+        ## (target, pos, record) of consecutive records on one chromosome
+        window = []
+        for record in block:
+            target = self.target(record)
+            if target is None:
+                continue
+            pos = record.pos
+            if len(window) > 0 and (
+                target != window[0][0]
+                or len(window) >= self.batch_size
+                or abs(pos - window[0][1]) > WINDOW_SPAN
+            ):
+                self.annotateWindow(window)
+                window = []
+            window.append((target, pos, record))
+        self.annotateWindow(window)
+
+    def annotateWindow(self, window):
+        if len(window) == 0:
+            return
+        table, chrom = window[0][0]
+        rows = self.lookup.overlapBlock(
+            table,
+            chrom,
+            [w[1] for w in window],
+            chrom_col=self.chrom_col,
+            start_col=self.start_col,
+            end_col=self.end_col,
+            columns=self.columns,
+        )
+        for w, r in zip(window, rows):
+            self.annotateRows(w[2], r)
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
+
+
+"""Runs an overlap stage over one file with its own lookup backend
+"""
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def runOverlapStage(
+    stage_class, vcf, format, table, tmpextin, tmpextout, sep, lookup, batch_size=0
+):
+    lookup = lk.openLookup(lookup)
+    stage = stage_class(lookup, format=format, table=table, batch_size=batch_size)
+    runStage(vcf, stage, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+    stage.close()
+    lookup.close()
 
 
 """Overlap with tfbsConsSites
 """
 
 
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
-):
+class TfbsConsSitesStage(OverlapStage):
+    columns = "chrom, chromStart, chromEnd, name"
+
+    ## chromosome_index holds the table of the current chromosome in memory
+    ## (lookup.ChromosomeLookup), for coordinate-sorted input only
+    def __init__(
+        self,
+        lookup,
+        format="vcf",
+        table="tfbsConsSites",
+        batch_size=0,
+        chromosome_index=False,
+    ):
+        if chromosome_index:
+            lookup = lk.ChromosomeLookup(lookup)
+        OverlapStage.__init__(
+            self, lookup, format=format, table=table, batch_size=batch_size
+        )
 
     allowed_chrom = [
         "1",
@@ -928,830 +1239,450 @@ def addOverlapWithTfbsConsSites(
         "Y",
     ]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+    def target(self, record):
+        # For some reason this table has no "chr" preceeding number
+        chrIndex = self.chrom(record).replace("chr", "")
+        if chrIndex in self.allowed_chrom:
+            return ("tfbsConsSites" + chrIndex, None)
+        return None
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    ## rows may be a stream (see lookup.StreamLookup), read once
+    def annotateRows(self, record, rows):
+        records = []
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
-
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-
-                    fh_out.write("\t".join(fields) + "\n")
-
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
+        for row in rows:
+            self.var_count = self.var_count + 1
+            t = str(row[3]) + "." + str(row[0]) + "." + str(row[1]) + "." + str(row[2])
+            t = t.strip()
+            records.append("tfbsRegion" + "=" + t)
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
+        if len(records) > 0:
+            self.line_count = self.line_count + 1
+            record.addInfo(";".join(records))
 
-        linenum = linenum + 1
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithTfbsConsSites(
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        TfbsConsSitesStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with GadAll table
 """
 
 
-def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class GadAllStage(OverlapStage):
+    chrom_col = "chromosome"
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+    def target(self, record):
+        chr = record.chrom
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return (self.table, chr)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    ## rows may be a stream (see lookup.StreamLookup), read once
+    def annotateRows(self, record, rows):
+        records = []
+        r_tmp = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+        for row in rows:
+            self.var_count = self.var_count + 1
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]))
+                records.append(str(self.table) + "=" + str(row[3]))
 
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+        if len(records) > 0:
+            self.line_count = self.line_count + 1
+            record.addInfo(";".join(records))
+            # annotated records have always been written with "\t " between
+            # columns; keep that so every runner produces the same file
+            record.indent(" ")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithGadAll(
+    vcf,
+    format="vcf",
+    table="gadAll",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        GadAllStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """ Overlap with gwasCatalog table """
 
 
-def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
+class GwasCatalogStage(OverlapStage):
+    start_col = "chromEnd"
+
+    def annotateRows(self, record, rows):
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(
+                    str(self.table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+            record.addInfo(";".join(records))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithGwasCatalog(
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        GwasCatalogStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+class HugoStage(OverlapStage):
+    def annotateRows(self, record, rows):
+        records = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+            record.addInfo(",".join(records).replace(";", ","))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWitHUGOGeneNomenclature(
+    vcf,
+    format="vcf",
+    table="hugo",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        HugoStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with segdup regions genomicSuperDups
 """
 
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
-
-                fh_out.write("\t".join(fields) + "\n")
+class GenomicSuperDupsStage(OverlapStage):
+    def annotateRows(self, record, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[0][7]
+            otherStart = rows[0][8]
+            otherEnd = rows[0][9]
+            record.extendInfo(
+                ";"
+                + str(self.table)
+                + "="
+                + str(isOverlap)
+                + ";"
+                + "otherChrom="
+                + str(otherChrom)
+                + ";otherStart="
+                + str(otherStart)
+                + ";otherEnd="
+                + str(otherEnd)
+            )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        GenomicSuperDupsStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
 
 
-def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+class RefGeneStage(OverlapStage):
+    start_col = "txStart"
+    end_col = "txEnd"
     colindex = 1
     colindex2 = 12
     name = "name"
     name2 = "name2"
-    startName = "txStart"
-    endName = "txEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
+    def annotateRows(self, record, rows):
+        overlapsWith = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(
+                    self.name2
+                    + "="
+                    + str(row[self.colindex2])
+                    + ";"
+                    + self.name
+                    + "="
+                    + str(row[self.colindex])
                 )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
 
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
+            genes = ";".join([str(x) for x in overlapsWith])
+            record.addInfo(str(genes))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithRefGene(
+    vcf,
+    format="vcf",
+    table="refGene",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        RefGeneStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with Cytoband table
 """
 
 
-def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
-):
+class CytobandStage(OverlapStage):
+    def __init__(self, lookup, format="vcf", table="cytoBand", batch_size=0):
+        OverlapStage.__init__(
+            self, lookup, format=format, table=table, batch_size=batch_size
+        )
+        self.colindex = 12
+        self.start_col = "txStart"
+        self.end_col = "txEnd"
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
-
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if table == "cytoBand":
+            self.colindex = 3
+            self.start_col = "chromStart"
+            self.end_col = "chromEnd"
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+    def annotateRows(self, record, rows):
+        overlapsWith = []
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+            record.addInfo(str(self.table) + "=" + str(cytoband))
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        CytobandStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
+    )
 
 
 """Method to find overlap with CNV tables
+   Only whether the variant falls in any CNV is reported, so only the
+   interval bounds are fetched
 """
 
 
-def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+class CnvStage(OverlapStage):
+    columns = "chromStart, chromEnd"
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
+    def annotateRows(self, record, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            record.addInfo(str(self.table) + "=" + str(isOverlap))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithCnvDatabase(
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    batch_size=0,
+    lookup="sql",
+):
+    runOverlapStage(
+        CnvStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with targetScanS tables
 """
 
 
-def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+class MiRNAStage(OverlapStage):
+    def annotateRows(self, record, rows):
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = (
+                str(rows[0][4])
+                + ","
+                + str(rows[0][1])
+                + "_"
+                + str(rows[0][2])
+                + "_"
+                + str(rows[0][3])
+            )
+            record.addInfo("miRNAsites=" + t.strip())
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In miRNAsites: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithMiRNA(
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    lookup="sql",
+    batch_size=0,
+):
+    runOverlapStage(
+        MiRNAStage,
+        vcf,
+        format,
+        table,
+        tmpextin,
+        tmpextout,
+        sep,
+        lookup,
+        batch_size=batch_size,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 ### EOF
@@ -0,0 +1,155 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Measures the reference database work done to annotate a VCF
+#
+# Usage: python benchmark.py <vcf> [--batch-size N] [--lookup sql|index]
+#        python benchmark.py <vcf> --rows-examined [--batch-size N]
+#
+# The file is annotated once per mode on a temporary copy; for each run the
+# number of statements sent, the number of distinct statement texts the
+# server has to parse and the runtime are reported.
+#
+# With --rows-examined the file is annotated without and with the bin IN
+# (...) range queries of lookup.SqlLookup, and the rows the server read for
+# each run (the change in its Handler_read_* counters) are reported. The
+# counters are global, so the server should not be serving other clients.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import driver
+import lookup as lk
+import utils as u
+
+"""Cursor that counts the statements it executes
+"""
+
+
+class CountingCursor(object):
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, args=None):
+        self.stats["statements"] = self.stats["statements"] + 1
+        mogrify = getattr(self.cursor, "mogrify", None)
+        text = mogrify(sql, args) if mogrify is not None else sql
+        self.stats["texts"].add(text)
+        self.stats["templates"].add(sql)
+        self.stats["bytes"] = self.stats["bytes"] + len(text)
+        return self.cursor.execute(sql, args)
+
+
+class CountingConnection(object):
+    def __init__(self, conn, stats):
+        self.conn = conn
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self, *args):
+        return CountingCursor(self.conn.cursor(*args), self.stats)
+
+
+def newStats():
+    return {"statements": 0, "bytes": 0, "texts": set(), "templates": set()}
+
+
+"""Annotates a temporary copy of vcf and returns the runtime in seconds
+"""
+
+
+def runOnce(vcf, **kwargs):
+    workdir = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(workdir, os.path.basename(vcf))
+        shutil.copy(vcf, infile)
+        start = time.time()
+        driver.run(infile, "vcf", **kwargs)
+        return time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+
+
+def report(label, stats, secs):
+    print(
+        f"{label}: {stats['statements']} statements, "
+        + f"{len(stats['texts'])} distinct statement texts "
+        + f"({len(stats['templates'])} templates), "
+        + f"{stats['bytes']} bytes of SQL, {secs:.2f} seconds"
+    )
+
+
+def countStatements(stats):
+    open_connection = u.open_db_connection
+
+    def counting():
+        return CountingConnection(open_connection(), stats)
+
+    u.open_db_connection = counting
+
+
+"""Rows read by the server so far: the sum of its Handler_read_* counters
+"""
+
+
+def rowsRead(cursor):
+    cursor.execute("SHOW GLOBAL STATUS LIKE 'Handler_read%'")
+    return sum([int(r[1]) for r in cursor.fetchall()])
+
+
+def rowsExamined(vcf, label, batch_size):
+    conn = u.open_db_connection()
+    cursor = conn.cursor()
+    for bins_label, bins in [("without bins", False), ("with bins", True)]:
+        lk.SqlLookup.bins = bins
+        before = rowsRead(cursor)
+        secs = runOnce(vcf, batch_size=batch_size, lookup="sql", fused=True)
+        print(
+            f"{label}, {bins_label}: {rowsRead(cursor) - before} rows examined, "
+            + f"{secs:.2f} seconds"
+        )
+    lk.SqlLookup.bins = True
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark annotation lookups")
+    parser.add_argument("vcf")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--lookup", default="sql")
+    parser.add_argument("--rows-examined", action="store_true")
+    args = parser.parse_args()
+
+    if args.rows_examined:
+        rowsExamined(args.vcf, "per-row", 0)
+        rowsExamined(args.vcf, "batched", args.batch_size)
+        sys.exit(0)
+
+    stats = newStats()
+    countStatements(stats)
+
+    for label, batch_size in [("per-row", 0), ("batched", args.batch_size)]:
+        stats.update(newStats())
+        secs = runOnce(args.vcf, batch_size=batch_size, lookup=args.lookup, fused=True)
+        report(label, stats, secs)
+
+
+### EOF
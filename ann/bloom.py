@@ -0,0 +1,202 @@
+# bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bloom filter over the (CHR, POS) keys of dbSNP
+#
+# Usage: python bloom.py [--rate R] [--table dbSNP] <file>
+#
+# Builds the filter from the database and writes it to <file>, reporting
+# the measured false-positive rate. The annotator maps the file and skips
+# the dbSNP lookup of every variant the filter rules out (see
+# lookup.BloomLookup); a position it lets through is still looked up, so
+# false positives only cost the query the filter did not save.
+#
+# A filter file is MAGIC, the header length (8 bytes), a JSON header padded
+# to 8 bytes and the bit array.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+
+import pymysql
+
+import utils as u
+
+MAGIC = b"ANNBLM01"
+
+# False-positive rate the filter is sized for
+FALSE_POSITIVE_RATE = 0.01
+
+# Absent keys probed to measure the false-positive rate of a new filter
+PROBES = 100000
+
+"""Key of a position; the chromosome is compared the way the server
+   compares it (case and trailing blanks ignored), so the filter never
+   rules out a row the query would find
+"""
+
+
+def bloomKey(chrom, pos):
+    return (str(chrom).strip().upper() + ":" + str(int(pos))).encode("utf-8")
+
+
+"""Bloom filter of bits bits set by hashes hash functions, derived from
+   one blake2b digest by double hashing; data is a bytearray while the
+   filter is built and the mapped file once it is opened
+"""
+
+
+class BloomFilter(object):
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8) if data is None else data
+        self.count = 0
+        self.table = None
+
+    def positions(self, chrom, pos):
+        digest = hashlib.blake2b(bloomKey(chrom, pos), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, chrom, pos):
+        for bit in self.positions(chrom, pos):
+            self.data[bit >> 3] |= 1 << (bit & 7)
+        self.count = self.count + 1
+
+    def mayContain(self, chrom, pos):
+        data = self.data
+        for bit in self.positions(chrom, pos):
+            if not data[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def write(self, path, table):
+        self.table = table
+        header = json.dumps(
+            {
+                "table": table,
+                "bits": self.bits,
+                "hashes": self.hashes,
+                "count": self.count,
+            }
+        ).encode("utf-8")
+        header = header + b" " * (-len(header) % 8)
+
+        tmp = path + ".tmp"
+        fh = open(tmp, "wb")
+        fh.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        fh.write(self.data)
+        fh.close()
+        os.rename(tmp, path)
+
+
+"""Sizes a filter for count keys at the given false-positive rate
+"""
+
+
+def newFilter(count, rate=FALSE_POSITIVE_RATE):
+    count = max(count, 1)
+    bits = int(math.ceil(-count * math.log(rate) / (math.log(2) ** 2)))
+    hashes = max(1, int(round(bits / count * math.log(2))))
+    return BloomFilter(bits, hashes)
+
+
+"""Filters opened by this process, keyed by path
+"""
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+def openFilter(path):
+    with _filters_lock:
+        bloom = _filters.get(path)
+        if bloom is None:
+            fh = open(path, "rb")
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            fh.close()
+            if mm[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a Bloom filter file")
+            (header_len,) = struct.unpack("<Q", mm[8:16])
+            header = json.loads(mm[16 : 16 + header_len].decode("utf-8"))
+            data = memoryview(mm)[16 + header_len :]
+            bloom = BloomFilter(header["bits"], header["hashes"], data)
+            bloom.count = header["count"]
+            bloom.table = header["table"]
+            _filters[path] = bloom
+            print(f"Opened Bloom filter of {bloom.table} ({str(bloom.count)} keys)")
+    return bloom
+
+
+"""Share of keys that are not in the filter but pass it, measured on
+   probes positions of a chromosome no table has
+"""
+
+
+def measureFalsePositives(bloom, probes=PROBES):
+    rng = random.Random(0)
+    passed = 0
+    for i in range(probes):
+        if bloom.mayContain("probe", rng.randrange(1 << 40)):
+            passed = passed + 1
+    return passed / float(probes)
+
+
+"""Builds the filter over the (chrom_col, pos_col) keys of table and
+   writes it to path; rows are streamed, so only the bit array is held in
+   memory
+"""
+
+
+def buildFilter(
+    path, table="dbSNP", chrom_col="CHR", pos_col="POS", rate=FALSE_POSITIVE_RATE
+):
+    conn = u.open_db_connection()
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+
+    cursor.execute("select count(*) from " + table)
+    (count,) = cursor.fetchone()
+    cursor.fetchall()
+    bloom = newFilter(int(count), rate)
+
+    cursor.execute("select " + chrom_col + ", " + pos_col + " from " + table)
+    for chrom, pos in cursor:
+        if chrom is not None and pos is not None:
+            bloom.add(chrom, pos)
+
+    cursor.close()
+    conn.close()
+
+    bloom.write(path, table)
+    measured = measureFalsePositives(bloom)
+    print(
+        f"Wrote {path}: {str(bloom.count)} keys of {table}, {str(bloom.bits)} bits, "
+        + f"{str(bloom.hashes)} hashes, false-positive rate {measured:.4%} "
+        + f"(sized for {rate:.2%})"
+    )
+    return bloom
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the dbSNP Bloom filter")
+    parser.add_argument("path")
+    parser.add_argument("--table", default="dbSNP")
+    parser.add_argument("--rate", type=float, default=FALSE_POSITIVE_RATE)
+    args = parser.parse_args()
+
+    buildFilter(args.path, table=args.table, rate=args.rate)
+
+
+### EOF
@@ -0,0 +1,361 @@
+# dbtools.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Index provisioning and query-plan checks for the reference database
+#
+# Usage: python dbtools.py indexes [--dry-run]
+#        python dbtools.py explain
+#
+# The lookups to check are not listed by hand: every annotation stage is
+# run, per row and batched, over a few sample variants, and the lookups it
+# makes are recorded. Each one needs an index on (chrom_col, start_col) for
+# exact positions, or on (chrom_col, start_col, end_col) for intervals; a
+# table with a UCSC bin column also needs (chrom_col, bin) for the bin
+# ranges of lookup.SqlLookup.
+#
+# indexes creates the indexes that are missing (an existing index whose
+# leading columns are the required ones is enough). explain runs EXPLAIN on
+# the statements each stage sends and exits with status 1 if any of them
+# would scan more than SCAN_ROWS rows of a whole table or index, or would
+# use another index than the ones provisioned for its table.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import collections
+import sys
+
+import annotate as ann
+import driver
+import intervals as iv
+import lookup as lk
+
+# Variants the stages are run over; one block, close enough together for
+# the batched stages to resolve it in a single window
+SAMPLE_VARIANTS = [
+    "chr1\t1000000\t.\tA\tG\t.\t.\t.",
+    "chr1\t1001000\t.\tC\tT\t.\t.\t.",
+    "chr1\t1002000\t.\tG\tA\t.\t.\t.",
+]
+
+# EXPLAIN access types that read a whole table or index
+FULL_SCANS = ("ALL", "index")
+
+# Estimated rows up to which a whole table or index scan is not flagged; the
+# server may rightly prefer scanning a small table to using its index
+SCAN_ROWS = 1000
+
+"""Runs every stage over the sample variants, per row and then batched,
+   with lookup; lookup.stage names the stage making the lookups
+"""
+
+
+def runStages(lookup):
+    for batch_size in [0, len(SAMPLE_VARIANTS)]:
+        for stage in driver.buildStages(lookup, batch_size=batch_size):
+            lookup.stage = stage.label + (" (batched)" if batch_size > 0 else "")
+            stage.annotateBlock(
+                [
+                    ann.VariantRecord(line.split("\t"), stage.inds)
+                    for line in SAMPLE_VARIANTS
+                ]
+            )
+
+    ## the genes stages only look up CpG islands for the transcripts found
+    lookup.stage = "Genes"
+    record = ann.VariantRecord(
+        SAMPLE_VARIANTS[0].split("\t"), ann.getFormatSpecificIndices()
+    )
+    ann.CpgIslands(lookup).get(record.chrom, record.pos)
+
+
+"""Records the (table, chrom_col, start_col, end_col) of every lookup and
+   the stages making it, without touching the database; tables a stage
+   reads whole with loadTable need no index and are left out
+"""
+
+
+class KeyLookup(lk.Lookup):
+    def __init__(self):
+        self.stage = None
+        self.keys = collections.OrderedDict()
+
+    def record(self, table, chrom_col, start_col, end_col):
+        key = (table, chrom_col, start_col, end_col)
+        self.keys.setdefault(key, []).append(self.stage)
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        self.record(table, chrom_col, start_col, end_col)
+        return []
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        self.record(table, chrom_col, start_col, end_col)
+        return [[] for pos in positions]
+
+    def loadTable(self, *args, **kwargs):
+        return iv.IntervalIndex().freeze()
+
+
+"""Cursor that, while plans is a list, runs EXPLAIN on the statements
+   instead of the statements and appends (statement, plan rows) to plans;
+   the plan rows are dicts keyed by EXPLAIN column
+"""
+
+
+class ExplainCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, sql, args=None):
+        if self.plans is None:
+            return self.cursor.execute(sql, args)
+        self.cursor.execute("EXPLAIN " + sql, args)
+        names = [d[0] for d in self.cursor.description]
+        rows = [dict(zip(names, r)) for r in self.cursor.fetchall()]
+        self.plans.append((sql, rows))
+
+    def fetchall(self):
+        if self.plans is None:
+            return self.cursor.fetchall()
+        return ()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+"""Sends the statements of SqlLookup as EXPLAIN; plans maps the text of
+   every statement to the stages sending it and its plan rows
+"""
+
+
+class ExplainLookup(lk.SqlLookup):
+    def __init__(self):
+        lk.SqlLookup.__init__(self)
+        self.cursor = ExplainCursor(self.cursor)
+        self.stage = None
+        self.plans = collections.OrderedDict()
+
+    def explain(self, method, *args, **kwargs):
+        self.cursor.plans = []
+        try:
+            method(self, *args, **kwargs)
+        finally:
+            explained = self.cursor.plans
+            self.cursor.plans = None
+        for sql, rows in explained:
+            stages, plan = self.plans.setdefault(sql, ([], rows))
+            if self.stage not in stages:
+                stages.append(self.stage)
+        return []
+
+    def overlap(self, table, chrom, lo, *args, **kwargs):
+        return self.explain(lk.SqlLookup.overlap, table, chrom, lo, *args, **kwargs)
+
+    def overlapBlock(self, table, chrom, positions, *args, **kwargs):
+        self.explain(
+            lk.SqlLookup.overlapBlock, table, chrom, positions, *args, **kwargs
+        )
+        return [[] for pos in positions]
+
+    def loadTable(self, *args, **kwargs):
+        return iv.IntervalIndex().freeze()
+
+    ## the column check is a query of its own, not one to explain
+    def hasBin(self, table):
+        plans = self.cursor.plans
+        self.cursor.plans = None
+        try:
+            return lk.SqlLookup.hasBin(self, table)
+        finally:
+            self.cursor.plans = plans
+
+
+"""Indexes the lookups of the stages need, as an ordered dict of
+   table -> list of column tuples
+"""
+
+
+def requiredIndexes(sql_lookup):
+    keys = KeyLookup()
+    runStages(keys)
+
+    required = collections.OrderedDict()
+    for table, chrom_col, start_col, end_col in keys.keys:
+        columns = [(chrom_col, start_col)]
+        if start_col != end_col:
+            columns = [(chrom_col, start_col, end_col)]
+        if sql_lookup.hasBin(table):
+            columns.append((chrom_col, "bin"))
+        for c in columns:
+            if c not in required.setdefault(table, []):
+                required[table].append(c)
+    return required
+
+
+"""Column lists of the indexes of table, keyed by index name
+"""
+
+
+def existingIndexes(cursor, table):
+    cursor.execute("SHOW INDEX FROM " + table)
+    names = [d[0] for d in cursor.description]
+    indexes = collections.OrderedDict()
+    for r in cursor.fetchall():
+        r = dict(zip(names, r))
+        indexes.setdefault(r["Key_name"], []).append(
+            (int(r["Seq_in_index"]), r["Column_name"])
+        )
+    return dict(
+        (name, tuple([c.lower() for seq, c in sorted(columns)]))
+        for name, columns in indexes.items()
+    )
+
+
+"""Names of the existing indexes whose leading columns are columns
+"""
+
+
+def matchingIndexes(existing, columns):
+    wanted = tuple([c.lower() for c in columns])
+    return [name for name, have in existing.items() if have[: len(wanted)] == wanted]
+
+
+def createIndexes(dry_run=False):
+    sql_lookup = lk.SqlLookup()
+    cursor = sql_lookup.cursor
+    created = 0
+    for table, required in requiredIndexes(sql_lookup).items():
+        existing = existingIndexes(cursor, table)
+        for columns in required:
+            found = matchingIndexes(existing, columns)
+            if len(found) > 0:
+                print(f"{table} ({', '.join(columns)}): index {found[0]}")
+                continue
+
+            sql = (
+                "CREATE INDEX ann_"
+                + "_".join(columns)
+                + " ON "
+                + table
+                + " ("
+                + ", ".join(columns)
+                + ")"
+            )
+            print(sql)
+            if not dry_run:
+                cursor.execute(sql)
+            created = created + 1
+    sql_lookup.close()
+    print(f"{str(created)} indexes {'missing' if dry_run else 'created'}")
+    return created
+
+
+"""Problems of the plan rows of a statement: a scan of a whole table or
+   index estimated at more than SCAN_ROWS rows, or a lookup through another
+   index than the ones in expected (table -> index names) on a table that
+   has one of them; smaller scans are left to the server
+"""
+
+
+def planProblems(rows, expected):
+    problems = []
+    for r in rows:
+        estimate = int(r.get("rows") or 0)
+        if r.get("type") in FULL_SCANS:
+            if estimate > SCAN_ROWS:
+                problems.append(
+                    f"{r.get('table')}: {r.get('type')} scan of {str(estimate)} rows"
+                )
+            continue
+        indexes = expected.get(r.get("table"), [])
+        if len(indexes) > 0 and r.get("key") not in indexes:
+            problems.append(
+                f"{r.get('table')}: reads key {r.get('key')}, "
+                + f"not {' or '.join(indexes)}"
+            )
+    return problems
+
+
+"""EXPLAINs the statements of every stage and returns the number with
+   problems (see planProblems)
+"""
+
+
+def explainStages():
+    explain_lookup = ExplainLookup()
+    runStages(explain_lookup)
+
+    expected = {}
+    for table, required in requiredIndexes(explain_lookup).items():
+        existing = existingIndexes(explain_lookup.cursor, table)
+        for columns in required:
+            for name in matchingIndexes(existing, columns):
+                if name not in expected.setdefault(table, []):
+                    expected[table].append(name)
+    explain_lookup.close()
+
+    flagged = 0
+    for sql, (stages, rows) in explain_lookup.plans.items():
+        problems = planProblems(rows, expected)
+        print(("FLAGGED " if len(problems) > 0 else "ok ") + ", ".join(stages))
+        print("  " + sql)
+        for r in rows:
+            print(
+                f"  table={r.get('table')} type={r.get('type')} "
+                + f"key={r.get('key')} rows={r.get('rows')} "
+                + f"extra={r.get('Extra')}"
+            )
+        for problem in problems:
+            print("  " + problem)
+        if len(problems) > 0:
+            flagged = flagged + 1
+    return flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reference database tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    indexes = commands.add_parser("indexes", help="create the missing indexes")
+    indexes.add_argument("--dry-run", action="store_true")
+    commands.add_parser("explain", help="check the query plans of the stages")
+    args = parser.parse_args()
+
+    if args.command == "indexes":
+        createIndexes(dry_run=args.dry_run)
+    else:
+        flagged = explainStages()
+        if flagged > 0:
+            print(f"{str(flagged)} statements would not use the provisioned indexes")
+            sys.exit(1)
+        print("Every stage uses the provisioned indexes")
+
+
+### EOF
@@ -12,166 +12,408 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
 import annotate as ann
+import bloom as bl
+import lookup as lk
+import pipeline as pl
+import vcfsort as vs
 
+"""Annotation stages, in the order they are applied
+   sweep has the overlap stages sweep their tables alongside the input
+   cache, a lookup.ResultCache, is shared by all of them
+   bloom is the path of a dbSNP Bloom filter (see bloom.py)
+   stream has the genes, gadAll and tfbsConsSites stages read their rows
+   from the database as they go through them
+   chromosome_index has the tfbsConsSites stage load the table of each
+   chromosome into an interval index, for a coordinate-sorted input; its
+   rows are then held in memory, and only stream again if the input turns
+   out not to be sorted
+"""
 
-def run(infile, format):
 
-    print("Running . . .")
+def buildStages(
+    lookup,
+    format="vcf",
+    batch_size=0,
+    sweep=False,
+    cache=None,
+    bloom=None,
+    stream=False,
+    chromosome_index=False,
+):
+    if cache is not None:
+        lookup = lk.CachedLookup(lookup, cache)
+    overlap = lk.SweepLookup(lookup) if sweep else lookup
+    dbsnp = lookup if bloom is None else lk.BloomLookup(lookup, bl.openFilter(bloom))
+    genes = lk.StreamLookup(lookup) if stream else lookup
+    stages = [
+        ann.DbSnpStage(dbsnp, format=format, batch_size=batch_size),
+        ann.BigRefGeneStage(lookup, format=format, batch_size=batch_size),
+        ann.GenesStage(genes, format=format, table="refGene", promoter_offset=500),
+    ]
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+    for stage_class, table in [
+        (ann.CytobandStage, "cytoBand"),
+        (ann.GadAllStage, "gadAll"),
+        (ann.GwasCatalogStage, "gwasCatalog"),
+        (ann.MiRNAStage, "targetScanS"),
+        (ann.HugoStage, "hugo"),
+        (ann.CnvStage, "dgv_Cnv"),
+        (ann.CnvStage, "abParts_IG_T_CelReceptors"),
+        (ann.CnvStage, "mcCarroll_Cnv"),
+        (ann.CnvStage, "conrad_Cnv"),
+        (ann.GenomicSuperDupsStage, "genomicSuperDups"),
+    ]:
+        stage_lookup = overlap
+        if stream and table == "gadAll":
+            stage_lookup = lk.StreamLookup(overlap)
+        stages.append(
+            stage_class(stage_lookup, format=format, table=table, batch_size=batch_size)
+        )
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    tfbs = lk.StreamLookup(overlap) if stream else overlap
+    stages.append(
+        ann.TfbsConsSitesStage(
+            tfbs,
+            format=format,
+            table="tfbsConsSites",
+            batch_size=batch_size,
+            chromosome_index=chromosome_index,
+        )
     )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    return stages
+
+
+"""Worker of the parallel mode: annotates one chromosome shard with its own
+   lookup and stages, and returns the stage and result cache counters for
+   the .count.log
+"""
+
+
+def annotateShard(
+    shard,
+    format,
+    batch_size=0,
+    lookup="sql",
+    sweep=False,
+    cache_size=0,
+    bloom=None,
+    stream=False,
+    chromosome_index=False,
+):
+    lookup = lk.openLookup(lookup)
+    cache = lk.ResultCache(cache_size) if cache_size > 0 else None
+    stages = buildStages(
+        lookup,
+        format=format,
+        batch_size=batch_size,
+        sweep=sweep,
+        cache=cache,
+        bloom=bloom,
+        stream=stream,
+        chromosome_index=chromosome_index,
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    pl.annotateFile(shard, stages, tmpextout=".annot")
+    counters = [stage.getCounters() for stage in stages]
+    for stage in stages:
+        stage.close()
+    lookup.close()
+    return counters, None if cache is None else cache.getCounters()
+
+
+"""Splits infile by chromosome, annotates the shards in up to workers
+   processes and merges them back in the original order; the counters of
+   every shard are added into stages (and cache) before the .count.log is
+   written
+"""
+
+
+def runParallel(
+    infile,
+    format,
+    stages,
+    workers,
+    batch_size=0,
+    lookup="sql",
+    sweep=False,
+    cache=None,
+    bloom=None,
+    stream=False,
+    chromosome_index=False,
+):
+    cache_size = 0 if cache is None else cache.size
+    shards = pl.splitShards(infile)
+
+    if len(shards) > 0:
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+            futures = [
+                pool.submit(
+                    annotateShard,
+                    shard,
+                    format,
+                    batch_size,
+                    lookup,
+                    sweep,
+                    cache_size,
+                    bloom,
+                    stream,
+                    chromosome_index,
+                )
+                for shard, size in shards
+            ]
+            for future in futures:
+                counters, cache_counters = future.result()
+                for stage, stage_counters in zip(stages, counters):
+                    stage.addCounters(stage_counters)
+                if cache is not None:
+                    cache.addCounters(cache_counters)
+
+    pl.mergeShards(infile, tmpextin=".annot", tmpextout=".annot")
+    pl.writeCountLog(infile, stages)
 
     ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
+    for shard, size in shards:
+        fu.delete(shard)
+        fu.delete(shard + ".annot")
+
+
+"""Annotates infile with the asyncio engine: stages is the first of
+   concurrency chains of stages, the others get their own lookup and share
+   cache
+"""
+
+
+def runConcurrent(
+    infile,
+    format,
+    stages,
+    concurrency,
+    batch_size=0,
+    lookup="sql",
+    sweep=False,
+    cache=None,
+    bloom=None,
+    stream=False,
+    chromosome_index=False,
+):
+    lookups = [lk.openLookup(lookup) for i in range(concurrency - 1)]
+    chains = [stages] + [
+        buildStages(
+            other,
+            format=format,
+            batch_size=batch_size,
+            sweep=sweep,
+            cache=cache,
+            bloom=bloom,
+            stream=stream,
+            chromosome_index=chromosome_index,
+        )
+        for other in lookups
+    ]
+
+    pl.runAsync(infile, chains, tmpextout=".annot")
+
+    for other in chains[1:]:
+        for stage in other:
+            stage.close()
+    for other in lookups:
+        other.close()
+
+
+"""Appends the peak resident memory of this process (and, after a parallel
+   run, of its largest worker) to the .count.log
+"""
+
+
+def writePeakRss(infile, workers=1):
+    ## ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    line = f"Peak RSS: {str(peak)} MB"
+    if workers > 1:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024
+        line = line + f" (largest worker {str(children)} MB)"
+    print(line)
+    fh_log = open(infile + ".count.log", "a")
+    fh_log.write(line + "\n")
+    fh_log.close()
+
+
+"""Runs the annotation stages over infile
+   batch_size > 0 resolves dbSNP, bigRefGene and the overlap stages in
+   per-chromosome windows of that many variants instead of one query per
+   variant
+   lookup selects the backend of the reference lookups: sql, index,
+   snapshot or daemon (lookupd.py)
+   fused annotates every record with all stages in one pass instead of
+   writing a temp file per stage
+   workers > 1 annotates the chromosomes in that many processes, each of
+   them in one fused pass
+   streaming runs every stage in its own thread, connected by queues of
+   queue_depth blocks
+   concurrency > 1 keeps that many blocks in flight in the asyncio engine
+   sweep resolves the overlap stages by sweeping each table alongside a
+   coordinate-sorted input, falling back to lookup if it is not sorted
+   cache_size > 0 keeps the results of that many lookups in an LRU cache
+   shared by all stages; its hits and misses go to the .count.log
+   sort sorts the records of an unsorted infile by coordinate (in place)
+   before annotating them and restores the original order of the output
+   bloom is the path of a dbSNP Bloom filter built by bloom.py; dbSNP is
+   not queried for the variants it rules out
+   stream_rows has the genes, gadAll and tfbsConsSites stages process the
+   rows of a lookup as they are read from an unbuffered cursor instead of
+   buffering them first; the result cache (cache_size > 0) keeps every
+   result in memory, so nothing streams with it, and the batched window
+   lookups (batch_size > 0) and sweep of gadAll and tfbsConsSites are
+   buffered, leaving only the genes stage streaming
+   tfbs_index loads the tfbsConsSites table of each chromosome into an
+   interval index when infile is coordinate-sorted (or sort sorts it),
+   so stream_rows no longer streams that stage; unsorted input is looked
+   up one variant at a time instead
+   The peak RSS of the run is appended to the .count.log
+"""
+
+
+def run(
+    infile,
+    format,
+    batch_size=0,
+    lookup="sql",
+    fused=False,
+    workers=1,
+    streaming=False,
+    queue_depth=4,
+    concurrency=1,
+    sweep=False,
+    cache_size=0,
+    sort=False,
+    bloom=None,
+    stream_rows=False,
+    tfbs_index=False,
+):
+
+    print("Running . . .")
+
+    ## rows held in memory anyway are not read any lighter by streaming them
+    if stream_rows and cache_size > 0:
+        print("Warning: stream_rows has no effect while cache_size > 0")
+    elif stream_rows and (batch_size > 0 or sweep):
+        print(
+            "Warning: with batch_size > 0 or sweep only the genes stage "
+            + "streams its rows"
+        )
+
+    order = vs.sortVcf(infile) if sort else None
+
+    ## an unsorted input would reload a chromosome every time it came back
+    chromosome_index = tfbs_index and (sort or vs.isSorted(infile))
+    if tfbs_index and not chromosome_index:
+        print("Input is not sorted, tfbsConsSites is looked up per variant")
+    elif chromosome_index and stream_rows and cache_size == 0:
+        ## batched and swept lookups of tfbsConsSites are warned about above
+        print(
+            "Warning: with tfbs_index the tfbsConsSites rows of each "
+            + "chromosome are held in memory, not streamed"
+        )
+
+    backend = lookup
+    if workers > 1:
+        ## every shard opens its own lookup; the stages of this process
+        ## only add up the counters of the shards
+        lookup = lk.Lookup()
+    elif streaming:
+        ## the stages share the lookup from different threads
+        lookup = lk.ThreadLookup(backend)
+    else:
+        lookup = lk.openLookup(backend)
+    cache = lk.ResultCache(cache_size) if cache_size > 0 else None
+    stages = buildStages(
+        lookup,
+        format=format,
+        batch_size=batch_size,
+        sweep=sweep,
+        cache=cache,
+        bloom=bloom,
+        stream=stream_rows,
+        chromosome_index=chromosome_index,
+    )
+
+    if workers > 1:
+        runParallel(
+            infile,
+            format,
+            stages,
+            workers,
+            batch_size=batch_size,
+            lookup=backend,
+            sweep=sweep,
+            cache=cache,
+            bloom=bloom,
+            stream=stream_rows,
+            chromosome_index=chromosome_index,
+        )
+        print("Parallel stages - done.")
+
+    elif streaming:
+        pl.runStreaming(infile, stages, tmpextout=".annot", depth=queue_depth)
+        print("Streaming stages - done.")
+
+    elif concurrency > 1:
+        runConcurrent(
+            infile,
+            format,
+            stages,
+            concurrency,
+            batch_size=batch_size,
+            lookup=backend,
+            sweep=sweep,
+            cache=cache,
+            bloom=bloom,
+            stream=stream_rows,
+            chromosome_index=chromosome_index,
+        )
+        print("Concurrent stages - done.")
+
+    elif fused:
+        pl.runFused(infile, stages, tmpextout=".annot")
+        print("Fused stages - done.")
+
+    else:
+        tmpextin = ""
+        for i, stage in enumerate(stages):
+            tmpextout = "." + str(i + 1)
+            ann.runStage(
+                infile,
+                stage,
+                tmpextin=tmpextin,
+                tmpextout=tmpextout,
+                logmode="w" if i == 0 else "a",
+            )
+            print(f"{stage.label} - done.")
+            tmpextin = tmpextout
+
+        ## Cleanup
+        for i in range(1, len(stages)):
+            fu.delete(infile + "." + str(i))
+
+        os.rename(infile + "." + str(len(stages)), infile + ".annot")
+
+    if cache is not None:
+        fh_log = open(infile + ".count.log", "a")
+        cache.writeLog(fh_log)
+        fh_log.close()
+
+    for stage in stages:
+        stage.close()
+    lookup.close()
+
+    writePeakRss(infile, workers=workers)
+
+    if order is not None:
+        vs.restoreOrder(infile + ".annot", order)
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
     os.rename(infile + ".annot", finalout)
 
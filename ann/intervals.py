@@ -0,0 +1,192 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval indexes over reference tables
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import bisect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# UCSC binning scheme: the first bin of each level, from the 128 kb bins
+# up to the one bin of 512 Mb, and the shift of the smallest bin size and
+# between levels
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+# Smallest block resolved with the batch kernel; below it the numpy call
+# overhead outweighs the vectorized scan
+KERNEL_MIN_BLOCK = 32
+
+"""Batch overlap kernel (needs numpy)
+
+   starts is sorted and maxends[i] is the largest end among intervals
+   0..i, so the intervals that may contain a position p are exactly
+   [searchsorted(maxends, p), searchsorted(starts, p, "right")): every one
+   before the range ends before p and every one after it starts after p.
+   Returns (hits, bounds): the indices of the intervals containing
+   positions[i] are hits[bounds[i]:bounds[i + 1]], in index order.
+"""
+
+
+def blockHits(starts, ends, maxends, positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    lo = np.searchsorted(maxends, positions, side="left")
+    hi = np.maximum(lo, np.searchsorted(starts, positions, side="right"))
+
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(positions)), counts)
+    first = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    candidates = np.arange(len(owner)) + first
+
+    keep = ends[candidates] >= positions[owner]
+    hits = candidates[keep]
+    bounds = np.searchsorted(owner[keep], np.arange(len(positions) + 1))
+    return hits, bounds
+
+
+"""Intervals of one chromosome, sorted by start
+
+   maxends[i] is the largest end among intervals 0..i, so a backwards scan
+   from the last start <= hi can stop as soon as maxends drops below lo
+"""
+
+
+class ChromIntervals(object):
+    __slots__ = ("starts", "ends", "maxends", "order", "rows", "arrays")
+
+    def __init__(self, entries):
+        entries.sort(key=lambda e: (e[0], e[2]))
+        self.starts = [e[0] for e in entries]
+        self.ends = [e[1] for e in entries]
+        self.order = [e[2] for e in entries]
+        self.rows = [e[3] for e in entries]
+        self.maxends = []
+        maxend = None
+        for end in self.ends:
+            maxend = end if maxend is None else max(maxend, end)
+            self.maxends.append(maxend)
+        self.arrays = None
+
+    def query(self, lo, hi):
+        hits = []
+        i = bisect.bisect_right(self.starts, hi) - 1
+        while i >= 0 and self.maxends[i] >= lo:
+            if self.ends[i] >= lo:
+                hits.append(i)
+            i = i - 1
+        hits.sort(key=lambda h: self.order[h])
+        return [self.rows[h] for h in hits]
+
+    ## Point lookups for a block of positions, one list of rows each
+    def queryBlock(self, positions):
+        if np is None or len(positions) < KERNEL_MIN_BLOCK:
+            return [self.query(pos, pos) for pos in positions]
+
+        if self.arrays is None:
+            self.arrays = [
+                np.array(a, dtype=np.int64)
+                for a in (self.starts, self.ends, self.maxends, self.order)
+            ]
+        starts, ends, maxends, order = self.arrays
+
+        hits, bounds = blockHits(starts, ends, maxends, positions)
+        if len(hits) > 1:
+            ## table order within the hits of each position
+            owner = np.repeat(np.arange(len(positions)), np.diff(bounds))
+            hits = hits[np.lexsort((order[hits], owner))]
+
+        rows = self.rows
+        hits = hits.tolist()
+        bounds = bounds.tolist()
+        return [
+            [rows[h] for h in hits[bounds[i] : bounds[i + 1]]]
+            for i in range(len(positions))
+        ]
+
+
+"""Per-chromosome interval index answering start <= hi AND lo <= end,
+   returning rows in the order they were added (i.e. table order)
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self):
+        self.pending = {}
+        self.chroms = {}
+        self.count = 0
+
+    def add(self, chrom, start, end, row):
+        self.pending.setdefault(chrom, []).append((start, end, self.count, row))
+        self.count = self.count + 1
+
+    def freeze(self):
+        for chrom, entries in self.pending.items():
+            self.chroms[chrom] = ChromIntervals(entries)
+        self.pending = {}
+        return self
+
+    def query(self, chrom, lo, hi=None):
+        intervals = self.chroms.get(chrom)
+        if intervals is None:
+            return []
+        return intervals.query(lo, lo if hi is None else hi)
+
+    def queryBlock(self, chrom, positions):
+        intervals = self.chroms.get(chrom)
+        if intervals is None:
+            return [[] for pos in positions]
+        return intervals.queryBlock(positions)
+
+    ## (start, end, order, row) of the intervals of chrom, sorted by start
+    def intervals(self, chrom):
+        intervals = self.chroms.get(chrom)
+        if intervals is None:
+            return iter(())
+        return zip(intervals.starts, intervals.ends, intervals.order, intervals.rows)
+
+
+"""Loads an index from a query whose first columns are [chrom,] start, end;
+   the remaining columns are kept as the row. Rows are added as the cursor
+   yields them, so an unbuffered cursor never holds the whole result.
+"""
+
+
+def loadIndex(cursor, sql, has_chrom=True, args=None):
+    index = IntervalIndex()
+    cursor.execute(sql, args)
+    key_len = 3 if has_chrom else 2
+    for r in cursor:
+        chrom = r[0] if has_chrom else None
+        index.add(chrom, int(r[key_len - 2]), int(r[key_len - 1]), tuple(r[key_len:]))
+    return index.freeze()
+
+
+"""Bins of the UCSC binning scheme that may hold a feature overlapping
+   the bases [lo, hi]; a feature [start, end) is stored in the smallest bin
+   covering start..end - 1, so rows found with bin IN (...) are a superset
+   of those overlapping the range at every level
+"""
+
+
+def binsOverlapping(lo, hi):
+    lo = max(lo, 0)
+    start = lo >> BIN_FIRST_SHIFT
+    end = max(hi, lo) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start, offset + end + 1))
+        start = start >> BIN_NEXT_SHIFT
+        end = end >> BIN_NEXT_SHIFT
+    return bins
+
+
+### EOF
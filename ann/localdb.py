@@ -0,0 +1,397 @@
+# localdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local SQLite or DuckDB copy of the reference database
+#
+# Usage: python localdb.py [--backend sqlite|duckdb] [--tables T,...]
+#                          <database> <dump> [<dump> ...]
+#
+# Imports MySQL dumps of the annotator tables into a local database file:
+# mysqldump output (CREATE TABLE and INSERT statements), or the table.sql
+# and table.txt[.gz] pairs of mysqldump --tab, the format UCSC publishes
+# its tables in. Dumps may be gzipped. The KEYs of each table are created
+# as indexes once its rows are loaded.
+#
+# With DatabaseBackend (ANN_DB_BACKEND) set to sqlite or duckdb and
+# DatabasePath (ANN_DB_PATH) to the file, utils.open_db_connection() opens
+# the file instead of the RDS database, so nodes, benchmark.py and test
+# runs need no network. Text columns compare case-insensitively, like
+# they do under MySQL's default collation.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import gzip
+import os
+import re
+import sqlite3
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+BACKENDS = ("sqlite", "duckdb")
+
+# Rows inserted with one executemany
+INSERT_BATCH = 10000
+
+# Rows fetched at a time when a cursor is iterated
+FETCH_BATCH = 10000
+
+"""Column types of the local tables for the MySQL types, by the MySQL
+   type name; DECIMAL is kept as text so values print like MySQL's do, and
+   BLOBs are bytes, like pymysql returns them
+"""
+INTEGER_TYPES = ("tinyint", "smallint", "mediumint", "int", "integer", "bigint", "bit")
+REAL_TYPES = ("float", "double", "real")
+BLOB_TYPES = ("binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob")
+
+"""Cursor with the interface of a pymysql cursor: statements use %s
+   placeholders and fetchall() returns a tuple
+"""
+
+
+class LocalCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = {}
+
+    def translate(self, sql):
+        text = self.statements.get(sql)
+        if text is None:
+            text = sql.replace("%%", "\0").replace("%s", "?").replace("\0", "%")
+            self.statements[sql] = text
+        return text
+
+    def execute(self, sql, args=None):
+        if args is None:
+            return self.cursor.execute(sql)
+        return self.cursor.execute(self.translate(sql), tuple(args))
+
+    def executemany(self, sql, args):
+        return self.cursor.executemany(self.translate(sql), args)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return tuple(self.cursor.fetchmany(size))
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.cursor.fetchmany(FETCH_BATCH)
+            if len(rows) == 0:
+                return
+            for r in rows:
+                yield r
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Connection to a local database file; cursor() accepts (and ignores) a
+   pymysql cursor class, as local cursors always stream their rows
+"""
+
+
+class LocalConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args):
+        return LocalCursor(self.conn.cursor())
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(backend, path, read_only=True):
+    if backend == "sqlite":
+        if read_only:
+            conn = sqlite3.connect(
+                "file:" + path + "?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False)
+    elif backend == "duckdb":
+        if duckdb is None:
+            raise ValueError("The duckdb backend needs the duckdb package")
+        conn = duckdb.connect(path, read_only=read_only)
+    else:
+        raise ValueError(f"Unknown database backend {backend}")
+    return LocalConnection(conn)
+
+
+def openDump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+"""MySQL string escapes, as written by mysqldump and SELECT ... INTO
+   OUTFILE
+"""
+ESCAPES = {
+    "0": "\0",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "Z": "\x1a",
+}
+ESCAPE_RE = re.compile(r"\\(.)|''", re.S)
+TAB_ESCAPE_RE = re.compile(r"\\(.)", re.S)
+
+
+def unescape(text, pattern=ESCAPE_RE):
+    return pattern.sub(
+        lambda m: "'" if m.group(1) is None else ESCAPES.get(m.group(1), m.group(1)),
+        text,
+    )
+
+
+"""Columns and indexes of a CREATE TABLE statement: ([(column, type
+   name)], [(key name, [columns])])
+"""
+COLUMN_RE = re.compile(r"`([^`]+)`\s+([a-zA-Z]+)")
+KEY_RE = re.compile(r"^(PRIMARY|UNIQUE|KEY|INDEX)\b[^(]*?(?:`([^`]+)`)?\s*\((.*)\)")
+
+
+def parseCreate(statement):
+    columns = []
+    keys = []
+    body = statement[statement.index("(") + 1 : statement.rindex(")")]
+    for line in body.split("\n"):
+        line = line.strip().rstrip(",")
+        m = KEY_RE.match(line)
+        if m is not None:
+            name = m.group(2) if m.group(2) is not None else m.group(1).lower()
+            keys.append((name, re.findall(r"`([^`]+)`", m.group(3))))
+            continue
+        m = COLUMN_RE.match(line)
+        if m is not None:
+            columns.append((m.group(1), m.group(2).lower()))
+    return columns, keys
+
+
+def toBytes(text):
+    return text.encode("utf-8")
+
+
+def columnType(mysql_type):
+    if mysql_type in INTEGER_TYPES:
+        return "BIGINT", int
+    if mysql_type in REAL_TYPES:
+        return "DOUBLE", float
+    if mysql_type in BLOB_TYPES:
+        return "BLOB", toBytes
+    return "TEXT COLLATE NOCASE", str
+
+
+"""Values of the rows of an INSERT statement, as lists of strings (None
+   for NULL)
+"""
+VALUE_RE = re.compile(r"'((?:[^'\\]|\\.|'')*)'|(NULL)|([^,()'\s]+)|(\()|(\))", re.S)
+
+
+def parseInsert(statement):
+    rows = []
+    row = None
+    start = statement.upper().index(" VALUES") + len(" VALUES")
+    for m in VALUE_RE.finditer(statement, start):
+        if m.group(4) is not None:
+            row = []
+        elif m.group(5) is not None:
+            rows.append(row)
+            row = None
+        elif row is not None:
+            if m.group(1) is not None:
+                row.append(unescape(m.group(1)))
+            elif m.group(2) is not None:
+                row.append(None)
+            else:
+                row.append(m.group(3))
+    return rows
+
+
+"""Rows of a mysqldump --tab data file: tab-separated, \\N for NULL
+"""
+
+
+def readTabRows(path):
+    fh = openDump(path)
+    try:
+        for line in fh:
+            line = line.rstrip("\n")
+            yield [
+                None if f == "\\N" else unescape(f, TAB_ESCAPE_RE)
+                for f in line.split("\t")
+            ]
+    finally:
+        fh.close()
+
+
+"""Statements of a dump, one at a time; comments and statements other
+   than CREATE TABLE and INSERT are skipped
+"""
+
+
+def readStatements(path):
+    fh = openDump(path)
+    try:
+        statement = []
+        for line in fh:
+            if len(statement) == 0:
+                if not (line.startswith("CREATE TABLE") or line.startswith("INSERT")):
+                    continue
+            statement.append(line)
+            if line.rstrip().endswith(";"):
+                yield "".join(statement)
+                statement = []
+    finally:
+        fh.close()
+
+
+"""Writes the tables of MySQL dumps into a local database file
+"""
+
+
+class Importer(object):
+    def __init__(self, backend, path, tables=None):
+        self.conn = connect(backend, path, read_only=False)
+        self.cursor = self.conn.cursor()
+        self.tables = tables
+        self.columns = {}
+        self.keys = {}
+        if backend == "sqlite":
+            self.cursor.execute("PRAGMA journal_mode = OFF")
+            self.cursor.execute("PRAGMA synchronous = OFF")
+
+    def wanted(self, table):
+        return self.tables is None or table in self.tables
+
+    def create(self, statement):
+        table = re.search(r"CREATE TABLE\s+`?([^`\s(]+)", statement).group(1)
+        if not self.wanted(table):
+            return
+        columns, keys = parseCreate(statement)
+        self.columns[table] = [columnType(t)[1] for c, t in columns]
+        self.keys[table] = keys
+        self.cursor.execute("DROP TABLE IF EXISTS " + table)
+        self.cursor.execute(
+            "CREATE TABLE "
+            + table
+            + " ("
+            + ", ".join([c + " " + columnType(t)[0] for c, t in columns])
+            + ")"
+        )
+        print(f"Created {table} ({str(len(columns))} columns)")
+
+    def insert(self, table, rows):
+        if not self.wanted(table):
+            return 0
+        types = self.columns[table]
+        sql = (
+            "INSERT INTO " + table + " VALUES (" + ", ".join(["%s"] * len(types)) + ")"
+        )
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(
+                tuple(
+                    [
+                        None if v is None else convert(v)
+                        for convert, v in zip(types, row)
+                    ]
+                )
+            )
+            if len(batch) >= INSERT_BATCH:
+                self.cursor.executemany(sql, batch)
+                count = count + len(batch)
+                batch = []
+        if len(batch) > 0:
+            self.cursor.executemany(sql, batch)
+            count = count + len(batch)
+        return count
+
+    def index(self, table):
+        for name, columns in self.keys.get(table, []):
+            self.cursor.execute(
+                "CREATE INDEX "
+                + table
+                + "_"
+                + name
+                + " ON "
+                + table
+                + " ("
+                + ", ".join(columns)
+                + ")"
+            )
+        self.conn.commit()
+
+    ## A dump of one or more tables; with --tab, table.sql only holds the
+    ## CREATE TABLE and the rows are in table.txt[.gz]
+    def load(self, path):
+        loaded = []
+        for statement in readStatements(path):
+            if statement.startswith("CREATE TABLE"):
+                self.create(statement)
+                loaded.append(
+                    re.search(r"CREATE TABLE\s+`?([^`\s(]+)", statement).group(1)
+                )
+            else:
+                table = re.search(r"INSERT INTO\s+`?([^`\s(]+)", statement).group(1)
+                self.insert(table, parseInsert(statement))
+
+        base = re.sub(r"\.sql(\.gz)?$", "", path)
+        for data in [base + ".txt", base + ".txt.gz"]:
+            if os.path.exists(data) and len(loaded) == 1:
+                count = self.insert(loaded[0], readTabRows(data))
+                print(f"Loaded {str(count)} rows of {loaded[0]} from {data}")
+
+        for table in loaded:
+            if self.wanted(table):
+                self.index(table)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def importDumps(path, dumps, backend="sqlite", tables=None):
+    importer = Importer(backend, path, tables)
+    for dump in dumps:
+        importer.load(dump)
+    importer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import MySQL dumps locally")
+    parser.add_argument("database")
+    parser.add_argument("dumps", nargs="+")
+    parser.add_argument("--backend", choices=BACKENDS, default="sqlite")
+    parser.add_argument("--tables", default=None)
+    args = parser.parse_args()
+
+    tables = None if args.tables is None else set(args.tables.split(","))
+    importDumps(args.database, args.dumps, backend=args.backend, tables=tables)
+
+
+### EOF
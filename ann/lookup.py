@@ -0,0 +1,1265 @@
+# lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pluggable lookup backends for the annotation stages
+#
+# Every backend answers overlap(table, chrom, lo, hi) with the rows where
+# chrom_col = chrom AND start_col <= hi AND lo <= end_col, in table order.
+# A point lookup is lo == hi (hi may be omitted). overlapBlock() answers
+# point lookups for several positions on one chromosome at once and returns
+# one list of rows per position. loadTable() reads a whole table into an
+# object answering query(chrom, lo, hi) and queryBlock(chrom, positions).
+# intervals() returns the (start, end, order, row) of one chromosome sorted
+# by start, order being the table order, for the sweep of SweepLookup.
+# overlap() and overlapBlock() may be given filters, a tuple of (columns,
+# values) pairs: the rows must also have one of the tuples of values in
+# columns. Filters only narrow what is read; backends querying a database
+# add them to the statement, the ones answering from memory ignore them, so
+# callers still match the rows they get against the filters themselves.
+# streamOverlap() answers like overlap() but may return an iterator over
+# rows still being read, for stages that handle their rows one at a time.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import base64
+import collections
+import datetime
+import decimal
+import heapq
+import json
+import os
+import socket
+import stat
+import struct
+import threading
+
+import pymysql
+
+import intervals as iv
+import snapshot as ss
+import utils as u
+
+"""Unix socket of the lookup daemon (lookupd.py) on this host: in the
+   private runtime directory of the user ($XDG_RUNTIME_DIR), or else in a
+   directory of /tmp only that user may write to
+"""
+
+
+def defaultSocket():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "ann-lookupd.sock")
+    return os.path.join("/tmp", f"ann-lookupd-{os.getuid()}", "lookupd.sock")
+
+
+LOOKUPD_SOCKET = os.environ.get("ANN_LOOKUPD_SOCKET", defaultSocket())
+
+"""Common interface of the lookup backends
+"""
+
+
+class Lookup(object):
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        raise NotImplementedError
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        return [
+            self.overlap(
+                table,
+                chrom,
+                pos,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+            for pos in positions
+        ]
+
+    ## backends holding their rows in memory have nothing to stream
+    def streamOverlap(self, *args, **kwargs):
+        return self.overlap(*args, **kwargs)
+
+    def loadTable(
+        self,
+        table,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        return loadTableIndex(table, chrom_col, start_col, end_col, columns)
+
+    def intervals(
+        self,
+        table,
+        chrom,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        if chrom is None:
+            chrom_col = None
+        loaded = self.loadTable(table, chrom_col, start_col, end_col, columns)
+        return loaded.intervals(chrom)
+
+    def close(self):
+        pass
+
+
+"""Queries the reference database
+
+   Statements are parameterized, so each kind of lookup always sends the
+   same statement text. overlapBlock sends one statement per block: an IN
+   list for exact-position tables (start_col == end_col), otherwise one
+   range query over the block's span whose rows are resolved in memory.
+
+   Tables with a UCSC bin column are detected on first use, and their
+   lookups add bin IN (...) with the bins of the queried range (widened by
+   one base, as end_col is inclusive), so the (chrom, bin) index narrows
+   the rows the server examines; with bins = False they are left out.
+
+   streamOverlap reads its rows from an unbuffered cursor (SSCursor) on a
+   second connection, opened on first use, as they are consumed. A lookup
+   made while a stream is being read is answered with overlap().
+"""
+
+
+class SqlLookup(Lookup):
+    bins = True
+
+    def __init__(self):
+        self.conn = u.db_connect()
+        self.cursor = self.conn.cursor()
+        self.statements = {}
+        self.bin_tables = {}
+        self.stream_conn = None
+        self.stream_cursor = None
+        self.streaming = False
+
+    def hasBin(self, table):
+        found = self.bin_tables.get(table)
+        if found is None:
+            self.cursor.execute("select * from " + table + " limit 0")
+            self.cursor.fetchall()
+            found = "bin" in [d[0].lower() for d in self.cursor.description]
+            self.bin_tables[table] = found
+        return found
+
+    ## Prefixes where and args with the bins of the bases [lo - 1, hi]. The
+    ## statements have no ORDER BY, like the ones they replaced: on the UCSC
+    ## schema the chrom index of a bin table is (chrom, bin), so the rows
+    ## come in the same index order with or without the bin clause; a table
+    ## indexed on chrom alone may return them in another order
+    def binned(self, table, lo, hi, where, args):
+        if not self.bins or not self.hasBin(table):
+            return where, args
+        bins = iv.binsOverlapping(lo - 1, hi)
+        where = "bin IN (" + ", ".join(["%s"] * len(bins)) + ") AND " + where
+        return where, tuple(bins) + tuple(args)
+
+    ## Appends the filters of a lookup to where and args
+    def narrowed(self, where, args, filters):
+        if filters is None:
+            return where, args
+        for columns, values in filters:
+            if len(columns) == 1:
+                clause = columns[0] + " IN (" + ", ".join(["%s"] * len(values)) + ")"
+            else:
+                match = "(" + " AND ".join([c + " = %s" for c in columns]) + ")"
+                clause = "(" + " OR ".join([match] * len(values)) + ")"
+            where = where + " AND " + clause
+            args = tuple(args) + tuple([v for row in values for v in row])
+        return where, args
+
+    def statement(self, kind, table, chrom, chrom_col, key_cols, columns, where):
+        key = (kind, table, chrom is not None, chrom_col, key_cols, columns, where)
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = "select " + key_cols + columns + " from " + table + " where "
+            if chrom is not None:
+                sql = sql + chrom_col + " = %s AND "
+            sql = sql + where
+            self.statements[key] = sql
+        return sql
+
+    def execute(self, sql, chrom, args):
+        if chrom is not None:
+            args = (chrom,) + tuple(args)
+        self.cursor.execute(sql, args)
+        return self.cursor.fetchall()
+
+    def overlapStatement(
+        self, table, chrom, lo, hi, chrom_col, start_col, end_col, columns, filters
+    ):
+        hi = lo if hi is None else hi
+        if start_col == end_col and lo == hi:
+            where = start_col + " = %s"
+            args = (lo,)
+        else:
+            where = "(" + start_col + " <= %s AND %s <= " + end_col + ")"
+            args = (hi, lo)
+        where, args = self.binned(table, lo, hi, where, args)
+        where, args = self.narrowed(where, args, filters)
+        sql = self.statement("overlap", table, chrom, chrom_col, "", columns, where)
+        if chrom is not None:
+            args = (chrom,) + tuple(args)
+        return sql, args
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        sql, args = self.overlapStatement(
+            table, chrom, lo, hi, chrom_col, start_col, end_col, columns, filters
+        )
+        self.cursor.execute(sql, args)
+        return self.cursor.fetchall()
+
+    def streamOverlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if self.streaming:
+            return self.overlap(
+                table, chrom, lo, hi, chrom_col, start_col, end_col, columns, filters
+            )
+        return self.stream(
+            *self.overlapStatement(
+                table, chrom, lo, hi, chrom_col, start_col, end_col, columns, filters
+            )
+        )
+
+    def stream(self, sql, args):
+        if self.stream_cursor is None:
+            self.stream_conn = u.db_connect()
+            self.stream_cursor = self.stream_conn.cursor(pymysql.cursors.SSCursor)
+        self.streaming = True
+        try:
+            self.stream_cursor.execute(sql, args)
+            for r in self.stream_cursor:
+                yield r
+        finally:
+            self.streaming = False
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if start_col == end_col:
+            keys = sorted(set(positions))
+            where = start_col + " IN (" + ", ".join(["%s"] * len(keys)) + ")"
+            where, keys = self.binned(table, keys[0], keys[-1], where, keys)
+            where, keys = self.narrowed(where, keys, filters)
+            sql = self.statement(
+                "in", table, chrom, chrom_col, start_col + ", ", columns, where
+            )
+            found = {}
+            for r in self.execute(sql, chrom, keys):
+                found.setdefault(int(r[0]), []).append(tuple(r[1:]))
+            return [found.get(pos, []) for pos in positions]
+
+        where = "(" + start_col + " <= %s AND %s <= " + end_col + ")"
+        args = (max(positions), min(positions))
+        where, args = self.binned(table, args[1], args[0], where, args)
+        where, args = self.narrowed(where, args, filters)
+        sql = self.statement(
+            "window",
+            table,
+            chrom,
+            chrom_col,
+            start_col + ", " + end_col + ", ",
+            columns,
+            where,
+        )
+        if chrom is not None:
+            args = (chrom,) + tuple(args)
+        index = iv.loadIndex(self.cursor, sql, has_chrom=False, args=args)
+        return index.queryBlock(None, positions)
+
+    ## reads the chromosome in one statement and sorts it in memory, which
+    ## keeps the table order among intervals with the same start
+    def intervals(
+        self,
+        table,
+        chrom,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        sql = "select " + start_col + ", " + end_col + ", " + columns + " from " + table
+        args = None
+        if chrom is not None:
+            sql = sql + " where " + chrom_col + " = %s"
+            args = (chrom,)
+        index = iv.loadIndex(self.cursor, sql, has_chrom=False, args=args)
+        return index.intervals(None)
+
+    def close(self):
+        if self.stream_conn is not None:
+            self.stream_cursor.close()
+            self.stream_conn.close()
+        self.conn.close()
+
+
+"""Values loaded once and shared by threads, keyed by what they were
+   loaded from; a thread loading one key only makes the threads wanting
+   that same key wait for it, so a large table is never loaded twice and
+   never holds up the others
+"""
+
+
+class LoadOnce(object):
+    def __init__(self):
+        self.values = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, load, *args):
+        value = self.values.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.values.get(key)
+            if value is None:
+                value = load(*args)
+                self.values[key] = value
+        with self.lock:
+            self.loading.pop(key, None)
+        return value
+
+    def __len__(self):
+        return len(self.values)
+
+
+"""Indexes loaded once per process, keyed by
+   (table, chrom_col, start_col, end_col, columns)
+"""
+_indexes = LoadOnce()
+
+
+"""Answers lookups from in-memory interval indexes; each reference table is
+   read from the database once, on first use, and shared by all stages.
+   The point-lookup tables in sql_tables are too large to hold in memory
+   and are still queried.
+"""
+
+
+class IndexLookup(Lookup):
+    sql_tables = (
+        "dbSNP",
+        "chrom_pos_equal_base",
+        "chrom_pos_equal_nobase",
+        "chrom_pos_unequal",
+    )
+
+    def __init__(self):
+        self.sql = None
+
+    def sqlLookup(self):
+        if self.sql is None:
+            self.sql = SqlLookup()
+        return self.sql
+
+    def index(self, table, chrom, chrom_col, start_col, end_col, columns):
+        if chrom is None:
+            chrom_col = None
+        key = (table, chrom_col, start_col, end_col, columns)
+        return _indexes.get(key, loadTableIndex, *key)
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if table in self.sql_tables:
+            return self.sqlLookup().overlapBlock(
+                table,
+                chrom,
+                positions,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+        index = self.index(table, chrom, chrom_col, start_col, end_col, columns)
+        return index.queryBlock(chrom, positions)
+
+    def close(self):
+        if self.sql is not None:
+            self.sql.close()
+            self.sql = None
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if table in self.sql_tables:
+            return self.sqlLookup().overlap(
+                table,
+                chrom,
+                lo,
+                hi,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+        index = self.index(table, chrom, chrom_col, start_col, end_col, columns)
+        return index.query(chrom, lo, hi)
+
+    def intervals(
+        self,
+        table,
+        chrom,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        if table in self.sql_tables:
+            return self.sqlLookup().intervals(
+                table,
+                chrom,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+            )
+        index = self.index(table, chrom, chrom_col, start_col, end_col, columns)
+        return index.intervals(chrom)
+
+
+def loadTableIndex(table, chrom_col, start_col, end_col, columns):
+    keys = (
+        [start_col, end_col] if chrom_col is None else [chrom_col, start_col, end_col]
+    )
+    sql = "select " + ", ".join(keys) + ", " + columns + " from " + table
+
+    ## rows go into the index as they arrive instead of being buffered first
+    with u.db_cursor(unbuffered=True) as cursor:
+        index = iv.loadIndex(cursor, sql, has_chrom=chrom_col is not None)
+    print(f"Loaded {str(index.count)} intervals from {table}")
+    return index
+
+
+"""Answers lookups from the snapshot files written by snapshot.py, memory
+   mapped on first use; every stage, thread and process on the instance
+   shares their pages through the OS cache
+"""
+
+
+class SnapshotLookup(Lookup):
+    def __init__(self, directory=None):
+        self.directory = ss.SNAPSHOT_DIR if directory is None else directory
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        snapshot = ss.openSnapshot(self.directory, table)
+        snapshot.checkKey(None if chrom is None else chrom_col, start_col, end_col)
+        return snapshot.query(chrom, lo, lo if hi is None else hi, columns)
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        snapshot = ss.openSnapshot(self.directory, table)
+        snapshot.checkKey(None if chrom is None else chrom_col, start_col, end_col)
+        return snapshot.queryBlock(chrom, positions, columns)
+
+    ## the snapshot is already mapped, so nothing is read up front
+    def loadTable(
+        self,
+        table,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        snapshot = ss.openSnapshot(self.directory, table)
+        snapshot.checkKey(chrom_col, start_col, end_col)
+        return SnapshotTable(snapshot, columns)
+
+
+class SnapshotTable(object):
+    def __init__(self, snapshot, columns):
+        self.snapshot = snapshot
+        self.columns = columns
+
+    def query(self, chrom, lo, hi=None):
+        return self.snapshot.query(chrom, lo, lo if hi is None else hi, self.columns)
+
+    def queryBlock(self, chrom, positions):
+        return self.snapshot.queryBlock(chrom, positions, self.columns)
+
+    def intervals(self, chrom):
+        return self.snapshot.intervals(chrom, self.columns)
+
+
+"""Holds one table at a time in memory, for tables split per chromosome
+   (tfbsConsSites1..Y): a table is loaded through lookup when the first
+   variant of its chromosome arrives and released when a variant of
+   another one does, so a sorted input needs about one chromosome of memory.
+   It is meant for coordinate-sorted input: a table coming back after it
+   was released means the input is not sorted, and from then on every
+   lookup goes to the wrapped lookup instead of reloading tables.
+"""
+
+
+class ChromosomeLookup(Lookup):
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.key = None
+        self.table = None
+        self.loads = 0
+        self.done = set()
+        self.sorted = True
+
+    ## the table holding chrom, or None once the input is known not sorted
+    def loaded(self, table, chrom, chrom_col, start_col, end_col, columns):
+        key = (table, None if chrom is None else chrom_col, start_col, end_col, columns)
+        if not self.sorted or key == self.key:
+            return self.table
+        if key in self.done:
+            print("Input is not sorted, " + table + " falls back to lookups")
+            self.sorted = False
+            self.close()
+            return None
+
+        if self.key is not None:
+            self.done.add(self.key)
+        ## release the previous table before reading the next one
+        self.key = None
+        self.table = None
+        self.table = self.lookup.loadTable(*key)
+        self.key = key
+        self.loads = self.loads + 1
+        return self.table
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        loaded = self.loaded(table, chrom, chrom_col, start_col, end_col, columns)
+        if loaded is None:
+            return self.lookup.overlap(
+                table,
+                chrom,
+                lo,
+                hi,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+        return loaded.query(chrom, lo, hi)
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        loaded = self.loaded(table, chrom, chrom_col, start_col, end_col, columns)
+        if loaded is None:
+            return self.lookup.overlapBlock(
+                table,
+                chrom,
+                positions,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+        return loaded.queryBlock(chrom, positions)
+
+    def close(self):
+        self.key = None
+        self.table = None
+
+
+"""Sweep of one table for SweepLookup: the intervals of the current
+   chromosome are read in start order while the positions advance, and the
+   ones that may still contain a later position are kept in a heap by end
+"""
+
+
+class Sweep(object):
+    def __init__(self, lookup, key):
+        self.lookup = lookup
+        self.key = key
+        self.chrom = None
+        self.pos = None
+        self.done = set()
+        self.stream = None
+        self.next = None
+        self.active = []
+
+    ## rows containing pos, or None when the positions are not sorted
+    def query(self, chrom, pos):
+        if self.stream is None or chrom != self.chrom:
+            if chrom in self.done:
+                return None
+            if self.stream is not None:
+                self.done.add(self.chrom)
+            self.chrom = chrom
+            self.stream = iter(self.lookup.intervals(self.key[0], chrom, *self.key[1:]))
+            self.next = next(self.stream, None)
+            self.active = []
+        elif pos < self.pos:
+            return None
+        self.pos = pos
+
+        while self.next is not None and self.next[0] <= pos:
+            start, end, order, row = self.next
+            heapq.heappush(self.active, (end, order, row))
+            self.next = next(self.stream, None)
+        while len(self.active) > 0 and self.active[0][0] < pos:
+            heapq.heappop(self.active)
+
+        ## every interval left ends at or after pos; return them in table order
+        return [a[2] for a in sorted(self.active, key=lambda a: a[1])]
+
+
+"""Answers the point lookups of the overlap stages by sweeping each table
+   alongside a coordinate-sorted input: each table is read once per job, one
+   chromosome at a time, instead of being queried for every variant.
+   Positions going backwards or a chromosome coming back means the input is
+   not sorted; from then on every lookup goes to the wrapped backend.
+"""
+
+
+class SweepLookup(Lookup):
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.sweeps = {}
+        self.sorted = True
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if self.sorted and (hi is None or hi == lo):
+            key = (table, chrom_col, start_col, end_col, columns)
+            sweep = self.sweeps.get(key)
+            if sweep is None:
+                sweep = Sweep(self.lookup, key)
+                self.sweeps[key] = sweep
+            rows = sweep.query(chrom, lo)
+            if rows is not None:
+                return rows
+            print("Input is not sorted, sweep falls back to indexed lookups")
+            self.sorted = False
+            self.sweeps = {}
+
+        return self.lookup.overlap(
+            table,
+            chrom,
+            lo,
+            hi,
+            chrom_col=chrom_col,
+            start_col=start_col,
+            end_col=end_col,
+            columns=columns,
+            filters=filters,
+        )
+
+    def loadTable(self, *args, **kwargs):
+        return self.lookup.loadTable(*args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return self.lookup.intervals(*args, **kwargs)
+
+
+"""Bounded LRU cache of lookup results shared by every stage of a job, so
+   records repeating a position (multi-allelic sites split over several
+   lines, several samples) do not repeat the queries; hits and misses are
+   counted for the .count.log
+"""
+
+
+class ResultCache(object):
+    counters = ("hits", "misses")
+
+    def __init__(self, size):
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            rows = self.results.get(key)
+            if rows is None:
+                self.misses = self.misses + 1
+                return None
+            self.results.move_to_end(key)
+            self.hits = self.hits + 1
+        return list(rows)
+
+    def put(self, key, rows):
+        with self.lock:
+            self.results[key] = tuple(rows)
+            self.results.move_to_end(key)
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    def getCounters(self):
+        return dict((name, getattr(self, name)) for name in self.counters)
+
+    def addCounters(self, counters):
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"Result cache: {str(self.hits)} hits, {str(self.misses)} misses\n"
+        )
+
+
+"""Answers lookups from cache, querying lookup for the misses only
+"""
+
+
+class CachedLookup(Lookup):
+    def __init__(self, lookup, cache):
+        self.lookup = lookup
+        self.cache = cache
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        hi = lo if hi is None else hi
+        key = (table, chrom, lo, hi, chrom_col, start_col, end_col, columns, filters)
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = self.lookup.overlap(
+                table,
+                chrom,
+                lo,
+                hi,
+                chrom_col=chrom_col,
+                start_col=start_col,
+                end_col=end_col,
+                columns=columns,
+                filters=filters,
+            )
+            self.cache.put(key, rows)
+        return rows
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        keys = [
+            (table, chrom, pos, pos, chrom_col, start_col, end_col, columns, filters)
+            for pos in positions
+        ]
+        results = [self.cache.get(key) for key in keys]
+        missing = sorted(set(k[2] for k, rows in zip(keys, results) if rows is None))
+        if len(missing) == 0:
+            return results
+
+        fetched = self.lookup.overlapBlock(
+            table,
+            chrom,
+            missing,
+            chrom_col=chrom_col,
+            start_col=start_col,
+            end_col=end_col,
+            columns=columns,
+            filters=filters,
+        )
+        fetched = dict(zip(missing, fetched))
+        for pos, rows in fetched.items():
+            self.cache.put(
+                (
+                    table,
+                    chrom,
+                    pos,
+                    pos,
+                    chrom_col,
+                    start_col,
+                    end_col,
+                    columns,
+                    filters,
+                ),
+                rows,
+            )
+        return [
+            fetched[k[2]] if rows is None else rows for k, rows in zip(keys, results)
+        ]
+
+    def loadTable(self, *args, **kwargs):
+        return self.lookup.loadTable(*args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return self.lookup.intervals(*args, **kwargs)
+
+
+"""Skips the point lookups of the filter's table (dbSNP) at the positions
+   the Bloom filter bloom (see bloom.py) rules out; only the positions it
+   lets through reach lookup
+"""
+
+
+class BloomLookup(Lookup):
+    def __init__(self, lookup, bloom):
+        self.lookup = lookup
+        self.bloom = bloom
+
+    def filtered(self, table, chrom):
+        return table == self.bloom.table and chrom is not None
+
+    def overlap(
+        self,
+        table,
+        chrom,
+        lo,
+        hi=None,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        if (
+            self.filtered(table, chrom)
+            and (hi is None or hi == lo)
+            and not self.bloom.mayContain(chrom, lo)
+        ):
+            return []
+        return self.lookup.overlap(
+            table,
+            chrom,
+            lo,
+            hi,
+            chrom_col=chrom_col,
+            start_col=start_col,
+            end_col=end_col,
+            columns=columns,
+            filters=filters,
+        )
+
+    def overlapBlock(
+        self,
+        table,
+        chrom,
+        positions,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+        filters=None,
+    ):
+        keep = positions
+        if self.filtered(table, chrom):
+            keep = [pos for pos in positions if self.bloom.mayContain(chrom, pos)]
+            if len(keep) == 0:
+                return [[] for pos in positions]
+        rows = self.lookup.overlapBlock(
+            table,
+            chrom,
+            keep,
+            chrom_col=chrom_col,
+            start_col=start_col,
+            end_col=end_col,
+            columns=columns,
+            filters=filters,
+        )
+        if keep is positions:
+            return rows
+        found = dict(zip(keep, rows))
+        return [found.get(pos, []) for pos in positions]
+
+    def loadTable(self, *args, **kwargs):
+        return self.lookup.loadTable(*args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return self.lookup.intervals(*args, **kwargs)
+
+
+"""Answers the point and range lookups of a stage from streamOverlap(), so
+   a stage iterating its rows once never holds all of them; lookups the
+   wrapped lookup answers from memory (e.g. ResultCache, SweepLine) and
+   block lookups (overlapBlock), whose rows are split by position, are
+   buffered as before
+"""
+
+
+class StreamLookup(Lookup):
+    def __init__(self, lookup):
+        self.lookup = lookup
+
+    def overlap(self, *args, **kwargs):
+        return self.lookup.streamOverlap(*args, **kwargs)
+
+    def streamOverlap(self, *args, **kwargs):
+        return self.lookup.streamOverlap(*args, **kwargs)
+
+    def overlapBlock(self, *args, **kwargs):
+        return self.lookup.overlapBlock(*args, **kwargs)
+
+    def loadTable(self, *args, **kwargs):
+        return self.lookup.loadTable(*args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return self.lookup.intervals(*args, **kwargs)
+
+
+"""Lookup shared by stages running in different threads: every thread is
+   given its own backend (and so its own connection) on first use
+"""
+
+
+class ThreadLookup(Lookup):
+    def __init__(self, backend="sql"):
+        self.backend = backend
+        self.local = threading.local()
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    def lookup(self):
+        lookup = getattr(self.local, "lookup", None)
+        if lookup is None:
+            lookup = openLookup(self.backend)
+            self.local.lookup = lookup
+            with self.lock:
+                self.lookups.append(lookup)
+        return lookup
+
+    def overlap(self, *args, **kwargs):
+        return self.lookup().overlap(*args, **kwargs)
+
+    def streamOverlap(self, *args, **kwargs):
+        return self.lookup().streamOverlap(*args, **kwargs)
+
+    def overlapBlock(self, *args, **kwargs):
+        return self.lookup().overlapBlock(*args, **kwargs)
+
+    def loadTable(self, *args, **kwargs):
+        return self.lookup().loadTable(*args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return self.lookup().intervals(*args, **kwargs)
+
+    def close(self):
+        for lookup in self.lookups:
+            lookup.close()
+        self.lookups = []
+
+
+"""Messages exchanged with the lookup daemon: a JSON document prefixed by
+   its length. JSON only carries data, so a peer can at worst send wrong
+   rows, never code; tuples, bytes, decimals and dates are tagged
+   {"__t": ...} etc. so rows come back as the backends return them.
+   recvMessage returns None when the peer has closed the socket
+"""
+
+
+def encodeValue(value):
+    if isinstance(value, tuple):
+        return {"__t": [encodeValue(v) for v in value]}
+    elif isinstance(value, list):
+        return [encodeValue(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, encodeValue(v)) for k, v in value.items())
+    elif isinstance(value, (bytes, bytearray)):
+        return {"__b": base64.b64encode(value).decode("ascii")}
+    elif isinstance(value, decimal.Decimal):
+        return {"__d": str(value)}
+    elif isinstance(value, datetime.datetime):
+        return {"__dt": value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {"__date": value.isoformat()}
+    return value
+
+
+def decodeObject(obj):
+    if len(obj) == 1:
+        ((tag, value),) = obj.items()
+        if tag == "__t":
+            return tuple(value)
+        elif tag == "__b":
+            return base64.b64decode(value)
+        elif tag == "__d":
+            return decimal.Decimal(value)
+        elif tag == "__dt":
+            return datetime.datetime.fromisoformat(value)
+        elif tag == "__date":
+            return datetime.date.fromisoformat(value)
+    return obj
+
+
+def sendMessage(sock, obj):
+    data = json.dumps(encodeValue(obj), separators=(",", ":")).encode("utf-8")
+    sock.sendall(struct.pack("<Q", len(data)) + data)
+
+
+def recvExactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:])
+        if n == 0:
+            if got == 0:
+                return None
+            raise ConnectionError("Lookup daemon connection closed mid-message")
+        got = got + n
+    return data
+
+
+def recvMessage(sock):
+    header = recvExactly(sock, 8)
+    if header is None:
+        return None
+    (size,) = struct.unpack("<Q", header)
+    return json.loads(recvExactly(sock, size), object_hook=decodeObject)
+
+
+"""Refuses a socket directory another user could swap the socket in:
+   it must belong to this user (or root) and, if others may write to it,
+   be sticky like /tmp
+"""
+
+
+def checkSocketDirectory(directory):
+    st = os.stat(directory)
+    if st.st_uid not in (os.getuid(), 0):
+        raise PermissionError(f"{directory} belongs to another user")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and not st.st_mode & stat.S_ISVTX:
+        raise PermissionError(f"{directory} is writable by other users")
+
+
+"""Connects to the daemon socket at path, only if it was created, and is
+   listened on, by this user; anyone else could bind the path while the
+   daemon is down and answer with rows of their own
+"""
+
+
+def connectDaemon(path):
+    checkSocketDirectory(os.path.dirname(os.path.abspath(path)))
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError(f"Lookup daemon socket {path} belongs to another user")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            pid, uid, gid = struct.unpack("3i", creds)
+            if uid != os.getuid():
+                raise PermissionError(
+                    f"Lookup daemon on {path} runs as another user (uid {uid})"
+                )
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+"""Answers lookups through the lookup daemon (lookupd.py), which holds the
+   reference indexes, connections and result cache of every annotation run
+   on the host; a DaemonLookup is one connection to it and, like the other
+   backends, is used by one thread at a time
+"""
+
+
+class DaemonLookup(Lookup):
+    def __init__(self, path=None):
+        self.sock = connectDaemon(LOOKUPD_SOCKET if path is None else path)
+
+    def call(self, method, *args, **kwargs):
+        sendMessage(self.sock, (method, args, kwargs))
+        reply = recvMessage(self.sock)
+        if reply is None:
+            raise ConnectionError("Lookup daemon closed the connection")
+        ok, value = reply
+        if not ok:
+            raise RuntimeError("Lookup daemon: " + value)
+        return value
+
+    def overlap(self, *args, **kwargs):
+        return self.call("overlap", *args, **kwargs)
+
+    def overlapBlock(self, *args, **kwargs):
+        return self.call("overlapBlock", *args, **kwargs)
+
+    def intervals(self, *args, **kwargs):
+        return iter(self.call("intervals", *args, **kwargs))
+
+    ## the table stays in the daemon, loaded once for all runs
+    def loadTable(
+        self,
+        table,
+        chrom_col="chrom",
+        start_col="chromStart",
+        end_col="chromEnd",
+        columns="*",
+    ):
+        return DaemonTable(self, (table, chrom_col, start_col, end_col, columns))
+
+    def close(self):
+        self.sock.close()
+
+
+class DaemonTable(object):
+    def __init__(self, lookup, key):
+        self.lookup = lookup
+        self.key = key
+
+    def query(self, chrom, lo, hi=None):
+        return self.lookup.call("query", self.key, chrom, lo, hi)
+
+    def queryBlock(self, chrom, positions):
+        return self.lookup.call("queryBlock", self.key, chrom, positions)
+
+    def intervals(self, chrom):
+        return iter(self.lookup.call("tableIntervals", self.key, chrom))
+
+
+"""Opens the lookup backend named in the configuration: sql, index,
+   snapshot or daemon
+"""
+
+
+def openLookup(backend="sql"):
+    if backend == "sql":
+        return SqlLookup()
+    elif backend == "index":
+        return IndexLookup()
+    elif backend == "snapshot":
+        return SnapshotLookup()
+    elif backend == "daemon":
+        return DaemonLookup()
+    raise ValueError(f"Unknown lookup backend: {backend}")
+
+
+### EOF
@@ -0,0 +1,195 @@
+# lookupd.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Lookup daemon shared by the annotation runs of one host
+#
+# Usage: python lookupd.py [--socket PATH] [--backend index|sql|snapshot]
+#                          [--cache N]
+#
+# Serves the lookups of every annotator process on the host over a Unix
+# socket (LookupBackend = daemon, see lookup.DaemonLookup). The backend,
+# its in-memory indexes or connection pool, the tables loaded whole and an
+# LRU result cache of N lookups live here, so their memory is paid once per
+# host and they stay warm from one job to the next. Each client connection
+# is served by its own thread with its own backend lookup; block lookups
+# (overlapBlock) are answered with one message per block.
+#
+# Messages are JSON (see lookup.sendMessage). The socket is created
+# accessible to its owner only, by default in the user's runtime directory
+# ($XDG_RUNTIME_DIR) or in a 0700 directory under /tmp, and clients only
+# talk to a daemon running as their own user (lookup.connectDaemon).
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import os
+import socket
+import socketserver
+import threading
+
+import lookup as lk
+
+# Lookups kept in the shared result cache
+CACHE_SIZE = 100000
+
+"""Thread serving one client: reads (method, args, kwargs) requests and
+   answers each with (True, result) or (False, error message)
+"""
+
+
+class LookupHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        backend = lk.openLookup(server.backend)
+        lookup = backend
+        if server.cache is not None:
+            lookup = lk.CachedLookup(backend, server.cache)
+        server.connected(1)
+        try:
+            while True:
+                message = lk.recvMessage(self.request)
+                if message is None:
+                    break
+                method, args, kwargs = message
+                try:
+                    reply = (True, self.dispatch(lookup, method, args, kwargs))
+                except Exception as e:
+                    reply = (False, f"{type(e).__name__}: {e}")
+                lk.sendMessage(self.request, reply)
+        finally:
+            server.connected(-1)
+            backend.close()
+
+    def dispatch(self, lookup, method, args, kwargs):
+        server = self.server
+        if method == "overlap":
+            return list(lookup.overlap(*args, **kwargs))
+        elif method == "overlapBlock":
+            return [list(rows) for rows in lookup.overlapBlock(*args, **kwargs)]
+        elif method == "intervals":
+            return list(lookup.intervals(*args, **kwargs))
+        elif method == "query":
+            key, chrom, lo, hi = args
+            return list(server.table(lookup, key).query(chrom, lo, hi))
+        elif method == "queryBlock":
+            key, chrom, positions = args
+            return [
+                list(rows)
+                for rows in server.table(lookup, key).queryBlock(chrom, positions)
+            ]
+        elif method == "tableIntervals":
+            key, chrom = args
+            return list(server.table(lookup, key).intervals(chrom))
+        elif method == "stats":
+            return server.stats()
+        raise ValueError(f"Unknown lookup daemon method: {method}")
+
+
+class LookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, backend="index", cache_size=CACHE_SIZE):
+        if backend == "daemon":
+            raise ValueError("The lookup daemon cannot use the daemon backend")
+        self.backend = backend
+        self.cache = lk.ResultCache(cache_size) if cache_size > 0 else None
+        self.tables = lk.LoadOnce()
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.served = 0
+
+        makeSocketDirectory(path)
+        removeStaleSocket(path)
+        ## owner-only from the start, not just after a chmod
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, LookupHandler)
+        finally:
+            os.umask(umask)
+
+    def connected(self, delta):
+        with self.lock:
+            self.clients = self.clients + delta
+            if delta > 0:
+                self.served = self.served + 1
+
+    ## tables read whole are loaded once and shared by all clients; a
+    ## load only holds up the clients waiting for that same table
+    def table(self, lookup, key):
+        key = tuple(key)
+        return self.tables.get(key, lookup.loadTable, *key)
+
+    def stats(self):
+        stats = {
+            "backend": self.backend,
+            "clients": self.clients,
+            "served": self.served,
+            "tables": len(self.tables),
+        }
+        if self.cache is not None:
+            stats.update(self.cache.getCounters())
+        return stats
+
+
+"""Creates the directory of the socket, private to this user, if it is
+   missing, and refuses one another user could replace the socket in
+"""
+
+
+def makeSocketDirectory(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700)
+    lk.checkSocketDirectory(directory)
+
+
+"""Removes the socket file left by a daemon that is no longer running;
+   refuses to start a second daemon on the same socket
+"""
+
+
+def removeStaleSocket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"A lookup daemon is already listening on {path}")
+
+
+def serve(path=None, backend="index", cache_size=CACHE_SIZE):
+    path = lk.LOOKUPD_SOCKET if path is None else path
+    server = LookupServer(path, backend=backend, cache_size=cache_size)
+    print(f"Lookup daemon ({backend} backend) listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        print(f"Lookup daemon stopped: {server.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve reference lookups")
+    parser.add_argument("--socket", default=lk.LOOKUPD_SOCKET)
+    parser.add_argument(
+        "--backend", choices=["index", "sql", "snapshot"], default="index"
+    )
+    parser.add_argument("--cache", type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+
+    serve(args.socket, backend=args.backend, cache_size=args.cache)
+
+
+### EOF
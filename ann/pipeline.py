@@ -0,0 +1,315 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the annotation stages over a VCF in a single pass
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import asyncio
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+
+"""Pushes a block of records through every stage in turn
+"""
+
+
+def annotateBlock(stages, block):
+    for stage in stages:
+        stage.annotateBlock(block)
+        # the file-based passes strip every line they read; do the same
+        # between stages so both modes write identical records
+        for record in block:
+            record.stripLast()
+
+
+"""Fused mode: parses each record once, annotates it with every stage in
+   memory and writes only vcf + tmpextout and the .count.log
+"""
+
+
+def runFused(vcf, stages, tmpextout=".annot", sep="\t", block_size=1000):
+    annotateFile(vcf, stages, tmpextout=tmpextout, sep=sep, block_size=block_size)
+    writeCountLog(vcf, stages)
+
+
+def annotateFile(vcf, stages, tmpextout=".annot", sep="\t", block_size=1000):
+    fh = open(vcf)
+    fh_out = open(vcf + tmpextout, "w")
+    block = []
+    ## every stage reads the same format
+    inds = stages[0].inds
+
+    for line in fh:
+        line = line.strip()
+        if ann.isHeader(line):
+            annotateBlock(stages, block)
+            writeBlock(fh_out, block)
+            fh_out.write(line + "\n")
+        else:
+            block.append(ann.VariantRecord(line.split(sep), inds))
+            if len(block) >= block_size:
+                annotateBlock(stages, block)
+                writeBlock(fh_out, block)
+
+    annotateBlock(stages, block)
+    writeBlock(fh_out, block)
+
+    fh.close()
+    fh_out.close()
+
+
+"""Streaming mode: every stage runs in its own thread and hands blocks to
+   the next one through a bounded queue (depth blocks), so the lookups of
+   different stages overlap while each stage still sees the records in
+   order. Header lines travel through the queues as strings.
+"""
+
+
+def runStreaming(vcf, stages, tmpextout=".annot", sep="\t", block_size=1000, depth=4):
+    queues = [queue.Queue(maxsize=depth) for i in range(len(stages) + 1)]
+    errors = []
+    threads = [
+        threading.Thread(
+            target=streamStage, args=(stage, queues[i], queues[i + 1], errors)
+        )
+        for i, stage in enumerate(stages)
+    ]
+    writer = threading.Thread(
+        target=streamWriter, args=(vcf + tmpextout, queues[-1], errors)
+    )
+    for thread in threads + [writer]:
+        thread.start()
+
+    fh = open(vcf)
+    block = []
+    inds = stages[0].inds
+    try:
+        for line in fh:
+            line = line.strip()
+            if ann.isHeader(line):
+                if len(block) > 0:
+                    queues[0].put(block)
+                    block = []
+                queues[0].put(line)
+            else:
+                block.append(ann.VariantRecord(line.split(sep), inds))
+                if len(block) >= block_size:
+                    queues[0].put(block)
+                    block = []
+        if len(block) > 0:
+            queues[0].put(block)
+    finally:
+        queues[0].put(None)
+        fh.close()
+
+    for thread in threads + [writer]:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+    writeCountLog(vcf, stages)
+
+
+## After a failure blocks are passed on unannotated, so that no thread is
+## left blocked on a full queue; the error is raised once all have finished
+def streamStage(stage, q_in, q_out, errors):
+    while True:
+        item = q_in.get()
+        if item is None:
+            break
+        if isinstance(item, list) and len(errors) == 0:
+            try:
+                annotateBlock([stage], item)
+            except Exception as e:
+                errors.append(e)
+        q_out.put(item)
+    q_out.put(None)
+
+
+def streamWriter(path, q_in, errors):
+    fh_out = open(path, "w")
+    while True:
+        item = q_in.get()
+        if item is None:
+            break
+        if len(errors) > 0:
+            continue
+        try:
+            if isinstance(item, list):
+                writeBlock(fh_out, item)
+            else:
+                fh_out.write(item + "\n")
+        except Exception as e:
+            errors.append(e)
+    fh_out.close()
+
+
+"""Asynchronous mode: an event loop keeps one block in flight per chain of
+   stages in chains (each chain with its own connections), running the
+   blocking lookups on a thread per chain. Blocks are written in input
+   order as they complete, and the counters of all chains are added into
+   chains[0] for the .count.log.
+"""
+
+
+def runAsync(vcf, chains, tmpextout=".annot", sep="\t", block_size=1000):
+    asyncio.run(
+        annotateAsync(vcf, chains, tmpextout=tmpextout, sep=sep, block_size=block_size)
+    )
+
+    for stages in chains[1:]:
+        for stage, other in zip(chains[0], stages):
+            stage.addCounters(other.getCounters())
+    writeCountLog(vcf, chains[0])
+
+
+async def annotateAsync(vcf, chains, tmpextout=".annot", sep="\t", block_size=1000):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=len(chains))
+    free = asyncio.Queue()
+    for stages in chains:
+        free.put_nowait(stages)
+
+    async def annotate(block):
+        stages = await free.get()
+        try:
+            await loop.run_in_executor(executor, annotateBlock, stages, block)
+        finally:
+            free.put_nowait(stages)
+        return block
+
+    ## header lines and tasks of annotated blocks, in input order
+    pending = collections.deque()
+    fh = open(vcf)
+    fh_out = open(vcf + tmpextout, "w")
+    block = []
+    inds = chains[0][0].inds
+
+    try:
+        for line in fh:
+            line = line.strip()
+            if ann.isHeader(line):
+                if len(block) > 0:
+                    pending.append(asyncio.create_task(annotate(block)))
+                    block = []
+                pending.append(line)
+            else:
+                block.append(ann.VariantRecord(line.split(sep), inds))
+                if len(block) >= block_size:
+                    pending.append(asyncio.create_task(annotate(block)))
+                    block = []
+            while len(pending) > 2 * len(chains):
+                await writeNext(fh_out, pending)
+
+        if len(block) > 0:
+            pending.append(asyncio.create_task(annotate(block)))
+        while len(pending) > 0:
+            await writeNext(fh_out, pending)
+
+    finally:
+        for item in pending:
+            if not isinstance(item, str):
+                item.cancel()
+        executor.shutdown(wait=True)
+        fh.close()
+        fh_out.close()
+
+
+async def writeNext(fh_out, pending):
+    item = pending.popleft()
+    if isinstance(item, str):
+        fh_out.write(item + "\n")
+    else:
+        writeBlock(fh_out, await item)
+
+
+def writeCountLog(vcf, stages):
+    fh_log = open(vcf + ".count.log", "w")
+    for stage in stages:
+        stage.writeLog(fh_log)
+    fh_log.close()
+
+
+def writeBlock(fh_out, block):
+    for record in block:
+        fh_out.write(record.line() + "\n")
+    del block[:]
+
+
+"""Chromosome shards: the records of each CHROM are written to their own
+   file, vcf + .shard<n>, in the order the chromosomes first appear.
+   Header lines stay in vcf and are put back in place by mergeShards.
+"""
+
+
+def shardKey(line, sep="\t"):
+    return line.split(sep, 1)[0].strip()
+
+
+def splitShards(vcf, sep="\t"):
+    fh = open(vcf)
+    shards = {}
+    handles = {}
+    sizes = {}
+
+    for line in fh:
+        line = line.strip()
+        if ann.isHeader(line):
+            continue
+        key = shardKey(line, sep)
+        fh_shard = handles.get(key)
+        if fh_shard is None:
+            shards[key] = vcf + ".shard" + str(len(shards))
+            fh_shard = open(shards[key], "w")
+            handles[key] = fh_shard
+            sizes[key] = 0
+        fh_shard.write(line + "\n")
+        sizes[key] = sizes[key] + 1
+
+    for fh_shard in handles.values():
+        fh_shard.close()
+    fh.close()
+
+    ## largest shards first, so the long ones do not start last
+    return [
+        (shards[key], sizes[key]) for key in sorted(shards, key=lambda k: -sizes[k])
+    ]
+
+
+"""Writes vcf + tmpextout by walking vcf again and taking each record from
+   the annotated shard (shard + tmpextin) of its chromosome, so records and
+   headers come out in their original order
+"""
+
+
+def mergeShards(vcf, tmpextin=".annot", tmpextout=".annot", sep="\t"):
+    fh = open(vcf)
+    fh_out = open(vcf + tmpextout, "w")
+    shards = {}
+
+    for line in fh:
+        line = line.strip()
+        if ann.isHeader(line):
+            fh_out.write(line + "\n")
+            continue
+        key = shardKey(line, sep)
+        fh_shard = shards.get(key)
+        if fh_shard is None:
+            fh_shard = open(vcf + ".shard" + str(len(shards)) + tmpextin)
+            shards[key] = fh_shard
+        fh_out.write(fh_shard.readline())
+
+    for fh_shard in shards.values():
+        fh_shard.close()
+    fh.close()
+    fh_out.close()
+
+
+### EOF
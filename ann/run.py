@@ -29,6 +29,26 @@ config.read('annotator_config.ini')
 
 s3_region_name = config['aws']['AwsRegionName']
 annot_table_name = config['gas']['AnnotationsTable']
+batch_size = config['ann'].getint('BatchSize', 0)
+lookup_backend = config['ann'].get('LookupBackend', 'sql')
+fused_pipeline = config['ann'].getboolean('FusedPipeline', False)
+workers = config['ann'].getint('Workers', 1)
+streaming_pipeline = config['ann'].getboolean('StreamingPipeline', False)
+queue_depth = config['ann'].getint('QueueDepth', 4)
+concurrency = config['ann'].getint('Concurrency', 1)
+sweep_line = config['ann'].getboolean('SweepLine', False)
+result_cache = config['ann'].getint('ResultCache', 0)
+sort_input = config['ann'].getboolean('SortInput', False)
+dbsnp_bloom = config['ann'].get('DbSnpBloom', '') or None
+stream_rows = config['ann'].getboolean('StreamRows', False)
+tfbs_index = config['ann'].getboolean('TfbsIndex', False)
+database_backend = config['ann'].get('DatabaseBackend', 'mysql')
+database_path = config['ann'].get('DatabasePath', '')
+
+# Read by utils.open_db_connection, in this and the worker processes
+os.environ['ANN_DB_BACKEND'] = database_backend
+if database_path:
+    os.environ['ANN_DB_PATH'] = database_path
 
 
 dynamo = boto3.resource('dynamodb', region_name = s3_region_name)
@@ -97,7 +117,23 @@ if __name__ == "__main__":
     if len(sys.argv) == 4:
         print("Command Line Arguments:", sys.argv)
         with Timer():
-            driver.run(sys.argv[1], "vcf")
+            driver.run(
+                sys.argv[1],
+                "vcf",
+                batch_size=batch_size,
+                lookup=lookup_backend,
+                fused=fused_pipeline,
+                workers=workers,
+                streaming=streaming_pipeline,
+                queue_depth=queue_depth,
+                concurrency=concurrency,
+                sweep=sweep_line,
+                cache_size=result_cache,
+                sort=sort_input,
+                bloom=dbsnp_bloom,
+                stream_rows=stream_rows,
+                tfbs_index=tfbs_index,
+            )
 
         # Add code here:
         input_file_name = sys.argv[1]
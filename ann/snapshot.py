@@ -0,0 +1,445 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Local snapshots of the reference tables
+#
+# Usage: python snapshot.py [--dir DIR] [table ...]
+#
+# Exports the reference tables (all of SNAPSHOT_TABLES by default) from the
+# database to one <table>.snap file each. The lookup backend "snapshot"
+# answers the annotation lookups from these files without the database.
+#
+# A snapshot file is:
+#   MAGIC, the header length (8 bytes), a JSON header padded to 8 bytes and
+#   the sections listed in the header, each at an offset from the end of
+#   the header:
+#     starts, ends, maxends, rowids - int64 arrays sorted by chromosome and
+#       start; header["chroms"] gives the [lo, hi) range of each chromosome
+#     offsets - int64 array, row i is pool[offsets[i]:offsets[i + 1]]
+#     pool - the rows in table order, cells separated by SEP, NULL as NUL
+#   Arrays are in the byte order of the instance that wrote them.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import bisect
+import datetime
+import decimal
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+from array import array
+
+import pymysql
+
+import intervals as iv
+import utils as u
+
+# Directory of the snapshot files
+SNAPSHOT_DIR = os.environ.get("ANN_SNAPSHOT_DIR", "snapshot")
+
+MAGIC = b"ANNSNAP1"
+SUFFIX = ".snap"
+SEP = b"\x1f"
+NULL = b"\x00"
+SECTIONS = ["starts", "ends", "maxends", "rowids", "offsets", "pool"]
+
+"""Tables read by annotate.py as (table, chrom_col, start_col, end_col),
+   keyed the way the stages look them up; the per-chromosome
+   tfbsConsSites tables are queried without a chromosome
+"""
+
+SNAPSHOT_TABLES = [
+    ("dbSNP", "CHR", "POS", "POS"),
+    ("chrom_pos_equal_base", "CHR", "start", "start"),
+    ("chrom_pos_equal_nobase", "CHR", "start", "start"),
+    ("chrom_pos_unequal", "CHR", "start", "end"),
+    ("refGene", "chrom", "txStart", "txEnd"),
+    ("cpgIslandExt", "chrom", "chromStart", "chromEnd"),
+    ("cytoBand", "chrom", "chromStart", "chromEnd"),
+    ("gadAll", "chromosome", "chromStart", "chromEnd"),
+    ("gwasCatalog", "chrom", "chromEnd", "chromEnd"),
+    ("targetScanS", "chrom", "chromStart", "chromEnd"),
+    ("hugo", "chrom", "chromStart", "chromEnd"),
+    ("dgv_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("abParts_IG_T_CelReceptors", "chrom", "chromStart", "chromEnd"),
+    ("mcCarroll_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("conrad_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("genomicSuperDups", "chrom", "chromStart", "chromEnd"),
+] + [
+    ("tfbsConsSites" + c, None, "chromStart", "chromEnd")
+    for c in [str(i) for i in range(1, 23)] + ["X", "Y"]
+]
+
+"""Cell encoding by column type
+"""
+
+TYPES = [
+    ("int", int),
+    ("float", float),
+    ("decimal", decimal.Decimal),
+    ("bytes", bytes),
+    ("str", str),
+    ("datetime", datetime.datetime),
+    ("date", datetime.date),
+]
+
+DECODERS = {
+    "int": int,
+    "float": float,
+    "decimal": lambda c: decimal.Decimal(c.decode("utf-8")),
+    "bytes": bytes,
+    "str": lambda c: c.decode("utf-8"),
+    "datetime": lambda c: datetime.datetime.fromisoformat(c.decode("utf-8")),
+    "date": lambda c: datetime.date.fromisoformat(c.decode("utf-8")),
+}
+
+
+def columnType(value):
+    for name, t in TYPES:
+        if isinstance(value, t) and not isinstance(value, bool):
+            return name
+    raise ValueError(f"Cannot snapshot values of type {type(value).__name__}")
+
+
+def encodeCell(value):
+    if value is None:
+        return NULL
+    if isinstance(value, (bytes, bytearray)):
+        cell = bytes(value)
+    elif isinstance(value, datetime.date):
+        cell = value.isoformat().encode("utf-8")
+    else:
+        cell = str(value).encode("utf-8")
+    if SEP in cell or cell == NULL:
+        raise ValueError(f"Cannot snapshot value {value!r}")
+    return cell
+
+
+"""Key of a chromosome in a snapshot: chromosomes are kept as strings,
+   like the VCF has them, and lower-cased, as MySQL compares them without
+   regard to case
+"""
+
+
+def chromKey(chrom):
+    return None if chrom is None else str(chrom).lower()
+
+
+"""Reader of one snapshot file
+
+   query() answers chrom_col = chrom AND start <= hi AND lo <= end like
+   intervals.ChromIntervals, straight from the mapped arrays, and returns
+   the rows in table order projected to columns
+"""
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+
+        (header_len,) = struct.unpack("<Q", self.mm[8:16])
+        header = json.loads(self.mm[16 : 16 + header_len].decode("utf-8"))
+        base = 16 + header_len
+        view = memoryview(self.mm)
+
+        sections = {}
+        for name in SECTIONS:
+            offset, length = header["sections"][name]
+            sections[name] = view[base + offset : base + offset + length]
+
+        self.table = header["table"]
+        self.chrom_col = header["chrom_col"]
+        self.start_col = header["start_col"]
+        self.end_col = header["end_col"]
+        self.columns = header["columns"]
+        self.decoders = [DECODERS[t] for t in header["types"]]
+        self.count = header["count"]
+        self.chroms = dict((chromKey(c), (lo, hi)) for c, lo, hi in header["chroms"])
+        self.starts = sections["starts"].cast("q")
+        self.ends = sections["ends"].cast("q")
+        self.maxends = sections["maxends"].cast("q")
+        self.rowids = sections["rowids"].cast("q")
+        self.offsets = sections["offsets"].cast("q")
+        self.pool = sections["pool"]
+        self.projections = {}
+
+    def checkKey(self, chrom_col, start_col, end_col):
+        if (chrom_col, start_col, end_col) != (
+            self.chrom_col,
+            self.start_col,
+            self.end_col,
+        ):
+            raise ValueError(
+                f"Snapshot of {self.table} is keyed by "
+                + f"{self.chrom_col}, {self.start_col}, {self.end_col}"
+            )
+
+    def projection(self, columns):
+        indices = self.projections.get(columns)
+        if indices is None:
+            names = [c.lower() for c in self.columns]
+            indices = []
+            for column in columns.split(","):
+                column = column.strip()
+                if column == "*" or column.endswith(".*"):
+                    indices.extend(range(len(names)))
+                elif column.lower() in names:
+                    indices.append(names.index(column.lower()))
+                else:
+                    raise ValueError(f"Snapshot of {self.table} has no {column}")
+            self.projections[columns] = indices
+        return indices
+
+    def row(self, rowid):
+        cells = bytes(self.pool[self.offsets[rowid] : self.offsets[rowid + 1]])
+        return [
+            None if cell == NULL else decode(cell)
+            for cell, decode in zip(cells.split(SEP), self.decoders)
+        ]
+
+    def query(self, chrom, lo, hi, columns="*"):
+        span = self.chroms.get(chromKey(chrom))
+        if span is None:
+            return []
+        first, last = span
+
+        hits = []
+        i = bisect.bisect_right(self.starts, hi, first, last) - 1
+        while i >= first and self.maxends[i] >= lo:
+            if self.ends[i] >= lo:
+                hits.append(self.rowids[i])
+            i = i - 1
+        hits.sort()
+
+        return self.rows(hits, columns)
+
+    def rows(self, rowids, columns):
+        indices = self.projection(columns)
+        rows = []
+        for rowid in rowids:
+            row = self.row(rowid)
+            rows.append(tuple([row[i] for i in indices]))
+        return rows
+
+    ## Point lookups for a block of positions with the batch kernel of
+    ## intervals.py, run on the mapped arrays without copying them
+    def queryBlock(self, chrom, positions, columns="*"):
+        if iv.np is None or len(positions) < iv.KERNEL_MIN_BLOCK:
+            return [self.query(chrom, pos, pos, columns) for pos in positions]
+
+        span = self.chroms.get(chromKey(chrom))
+        if span is None:
+            return [[] for pos in positions]
+        first, last = span
+
+        np = iv.np
+        starts, ends, maxends, rowids = [
+            np.frombuffer(a, dtype=np.int64)[first:last]
+            for a in (self.starts, self.ends, self.maxends, self.rowids)
+        ]
+        hits, bounds = iv.blockHits(starts, ends, maxends, positions)
+        hits = rowids[hits]
+        return [
+            self.rows(np.sort(hits[bounds[i] : bounds[i + 1]]).tolist(), columns)
+            for i in range(len(positions))
+        ]
+
+    ## (start, end, rowid, row) of the intervals of chrom, sorted by start
+    def intervals(self, chrom, columns="*"):
+        span = self.chroms.get(chromKey(chrom))
+        if span is None:
+            return
+        first, last = span
+        indices = self.projection(columns)
+        for i in range(first, last):
+            row = self.row(self.rowids[i])
+            yield (
+                self.starts[i],
+                self.ends[i],
+                self.rowids[i],
+                tuple([row[j] for j in indices]),
+            )
+
+
+"""Snapshots opened by this process, keyed by path
+"""
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def openSnapshot(directory, table):
+    path = os.path.join(directory, table + SUFFIX)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is None:
+            snapshot = Snapshot(path)
+            _snapshots[path] = snapshot
+            print(f"Opened snapshot of {table} ({str(snapshot.count)} rows)")
+    return snapshot
+
+
+"""Writes the starts, ends, maxends and rowids of one chromosome, sorted
+   by start; the sort is stable, so rows with equal starts stay in table
+   order. With NumPy the sort works on the array buffers directly and
+   takes 8 bytes per row for the order, instead of lists of Python ints.
+"""
+
+
+def writeSorted(files, starts, ends, count):
+    if len(starts) == 0:
+        return
+    if iv.np is not None:
+        np = iv.np
+        starts = np.frombuffer(starts, dtype=np.int64)
+        ends = np.frombuffer(ends, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        starts[order].tofile(files["starts"])
+        sorted_ends = ends[order]
+        sorted_ends.tofile(files["ends"])
+        np.maximum.accumulate(sorted_ends).tofile(files["maxends"])
+        del sorted_ends
+        order += count
+        order.tofile(files["rowids"])
+        return
+
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    maxends = array("q")
+    maxend = None
+    for i in order:
+        maxend = ends[i] if maxend is None else max(maxend, ends[i])
+        maxends.append(maxend)
+    array("q", [starts[i] for i in order]).tofile(files["starts"])
+    array("q", [ends[i] for i in order]).tofile(files["ends"])
+    maxends.tofile(files["maxends"])
+    array("q", [count + i for i in order]).tofile(files["rowids"])
+
+
+"""Writes directory/<table>.snap
+
+   Rows are streamed one chromosome at a time, so only the start/end
+   arrays of one chromosome are held in memory while they are sorted.
+   The file is written under a temporary name and renamed when complete.
+"""
+
+
+def exportTable(directory, table, chrom_col, start_col, end_col):
+    path = os.path.join(directory, table + SUFFIX)
+    tmp = path + ".tmp"
+    files = dict((name, open(tmp + "." + name, "wb")) for name in SECTIONS)
+
+    conn = u.open_db_connection()
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+
+    ## the spellings of each chromosome, read together in table order
+    chroms = {}
+    if chrom_col is None:
+        chroms[None] = []
+    else:
+        cursor.execute("select distinct " + chrom_col + " from " + table)
+        for r in cursor.fetchall():
+            if r[0] is not None:
+                chroms.setdefault(chromKey(r[0]), []).append(r[0])
+
+    cursor.execute("select * from " + table + " limit 0")
+    columns = [d[0] for d in cursor.description]
+    cursor.fetchall()
+    types = [None] * len(columns)
+    ranges = []
+    count = 0
+    pool_size = 0
+    array("q", [0]).tofile(files["offsets"])
+
+    for chrom in sorted(chroms, key=lambda c: "" if c is None else c):
+        names = chroms[chrom]
+        sql = "select " + start_col + ", " + end_col + ", " + table + ".* from " + table
+        if chrom is None:
+            cursor.execute(sql)
+        else:
+            sql = sql + " where " + chrom_col + " IN (" + ", ".join(["%s"] * len(names))
+            cursor.execute(sql + ")", names)
+
+        starts = array("q")
+        ends = array("q")
+        offsets = array("q")
+        for r in cursor:
+            cells = []
+            for i, value in enumerate(r[2:]):
+                if value is not None and types[i] is None:
+                    types[i] = columnType(value)
+                cells.append(encodeCell(value))
+            row = SEP.join(cells)
+            files["pool"].write(row)
+            pool_size = pool_size + len(row)
+            offsets.append(pool_size)
+            starts.append(int(r[0]))
+            ends.append(int(r[1]))
+        offsets.tofile(files["offsets"])
+
+        writeSorted(files, starts, ends, count)
+
+        ranges.append([chrom, count, count + len(starts)])
+        count = count + len(starts)
+
+    cursor.close()
+    conn.close()
+
+    sections = {}
+    offset = 0
+    for name in SECTIONS:
+        files[name].close()
+        length = os.path.getsize(tmp + "." + name)
+        sections[name] = [offset, length]
+        offset = offset + length + (-length % 8)
+
+    header = json.dumps(
+        {
+            "table": table,
+            "chrom_col": chrom_col,
+            "start_col": start_col,
+            "end_col": end_col,
+            "columns": columns,
+            "types": [t if t is not None else "str" for t in types],
+            "count": count,
+            "chroms": ranges,
+            "sections": sections,
+        }
+    ).encode("utf-8")
+    header = header + b" " * (-len(header) % 8)
+
+    fh_out = open(tmp, "wb")
+    fh_out.write(MAGIC + struct.pack("<Q", len(header)) + header)
+    for name in SECTIONS:
+        fh = open(tmp + "." + name, "rb")
+        shutil.copyfileobj(fh, fh_out)
+        fh.close()
+        fh_out.write(b"\0" * (-sections[name][1] % 8))
+        os.remove(tmp + "." + name)
+    fh_out.close()
+
+    os.rename(tmp, path)
+    print(f"Exported {str(count)} rows of {table} to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export reference snapshots")
+    parser.add_argument("tables", nargs="*")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    for table, chrom_col, start_col, end_col in SNAPSHOT_TABLES:
+        if len(args.tables) == 0 or table in args.tables:
+            exportTable(args.dir, table, chrom_col, start_col, end_col)
+
+
+### EOF
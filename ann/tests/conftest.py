@@ -0,0 +1,434 @@
+# conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Fixtures of the annotator regression tests
+#
+# The tests need neither RDS nor AWS: a small reference database is
+# generated into a local SQLite file (see localdb.py) with the tables
+# annotate.py reads, around the positions of the test_files VCFs, and the
+# annotator is pointed at it with ANN_DB_BACKEND / ANN_DB_PATH. The inputs
+# are the test_files VCFs cut to RECORDS_PER_CHROM records per chromosome.
+#
+# The modes of driver.run() are checked against the default per-file
+# pipeline (the baseline fixture): the same annotated files and .count.log,
+# byte for byte, but for the VARIABLE_LINES only some modes write.
+# test_golden.py in turn pins that pipeline to the output of the original
+# annotator.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import glob
+import os
+import random
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+ANN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ANN_DIR)
+
+import driver
+import intervals as iv
+
+TEST_FILES = os.path.join(os.path.dirname(ANN_DIR), "test_files")
+
+# Records kept of each chromosome of a test file; premium_3.vcf keeps more
+# than one block of 1000 records, for the streaming and async engines
+RECORDS_PER_CHROM = 60
+
+# Seed of the generated reference rows
+SEED = 7
+
+# Variants per window of the batched modes; small, so the test inputs span
+# several windows
+BATCH_SIZE = 50
+
+# Lines of the .count.log that differ from one run to the next or that only
+# some modes write
+VARIABLE_LINES = ("Peak RSS", "Result cache")
+
+CHROMOSOMES = [str(i) for i in range(1, 23)] + ["X", "Y"]
+CNV_TABLES = ["dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv"]
+COMPLEMENT = {"A": "T", "T": "A", "G": "C", "C": "G"}
+
+"""Writes the records of vcf, at most RECORDS_PER_CHROM per chromosome
+   and with its header, to path
+"""
+
+
+def cutVcf(vcf, path):
+    kept = {}
+    fh_out = open(path, "w")
+    with open(vcf) as fh:
+        for line in fh:
+            if not line.startswith("#"):
+                chrom = line.split("\t", 1)[0]
+                kept[chrom] = kept.get(chrom, 0) + 1
+                if kept[chrom] > RECORDS_PER_CHROM:
+                    continue
+            fh_out.write(line)
+    fh_out.close()
+
+
+"""Smallest UCSC bin holding the feature [start, end)
+"""
+
+
+def binFromRange(start, end):
+    start = max(start, 0) >> iv.BIN_FIRST_SHIFT
+    end = max(end - 1, 0) >> iv.BIN_FIRST_SHIFT
+    for offset in iv.BIN_OFFSETS:
+        if start == end:
+            return offset + start
+        start = start >> iv.BIN_NEXT_SHIFT
+        end = end >> iv.BIN_NEXT_SHIFT
+    return 0
+
+
+def createTables(cursor):
+    cursor.execute("create table dbSNP(CHR, POS int, X, ID, REF, ALT, INFO, GMAF)")
+    cursor.execute(
+        "create table chrom_pos_equal_base(id, CHR, start int, end int,"
+        + " haplotypeReference, haplotypeAlternate, name, name2,"
+        + " transcriptStrand, positionType, frame, mrnaCoord, codonCoord,"
+        + " spliceDist, referenceCodon, referenceAA, variantCodon, variantAA,"
+        + " changesAA, functionalClass, codingCoordStr, proteinCoordStr,"
+        + " inCodingRegion, spliceInfo, uorfChange)"
+    )
+    for table in ["chrom_pos_equal_nobase", "chrom_pos_unequal"]:
+        cursor.execute(f"create table {table} as select * from chrom_pos_equal_base")
+    cursor.execute(
+        "create table refGene(bin int, name, chrom, strand, txStart int,"
+        + " txEnd int, cdsStart int, cdsEnd int, exonCount int, exonStarts blob,"
+        + " exonEnds blob, score int, name2, cdsStartStat, cdsEndStat,"
+        + " exonFrames)"
+    )
+    cursor.execute(
+        "create table cpgIslandExt(bin int, chrom, chromStart int,"
+        + " chromEnd int, name, length int)"
+    )
+    cursor.execute(
+        "create table cytoBand(chrom, chromStart int, chromEnd int, name, gieStain)"
+    )
+    cursor.execute(
+        "create table gadAll(id, chromosome, chromStart int, chromEnd int, disease)"
+    )
+    cursor.execute(
+        "create table gwasCatalog(bin int, chrom, chromStart int, chromEnd int,"
+        + " name, pubMedID, author, pubDate, journal, title, trait)"
+    )
+    cursor.execute(
+        "create table hugo(bin int, chrom, chromStart int, chromEnd int, name,"
+        + " symbol, descr)"
+    )
+    cursor.execute(
+        "create table genomicSuperDups(bin int, chrom, chromStart int,"
+        + " chromEnd int, name, score, strand, otherChrom, otherStart int,"
+        + " otherEnd int)"
+    )
+    cursor.execute(
+        "create table targetScanS(bin int, chrom, chromStart int, chromEnd int,"
+        + " name, score)"
+    )
+    for table in CNV_TABLES:
+        cursor.execute(
+            f"create table {table}(bin int, chrom, chromStart int, chromEnd int,"
+            + " name)"
+        )
+    for chrom in CHROMOSOMES:
+        cursor.execute(
+            f"create table tfbsConsSites{chrom}(chrom, chromStart int,"
+            + " chromEnd int, name, score)"
+        )
+
+
+def insert(cursor, table, row):
+    cursor.execute(
+        f"insert into {table} values ({', '.join(['?'] * len(row))})", tuple(row)
+    )
+
+
+"""Generates the reference tables around the positions of the variants
+   in vcfs: dbSNP and bigRefGene rows at (or, on other alleles, near) them,
+   genes with exons and CpG islands at their ends, and intervals of the
+   overlap tables containing them
+"""
+
+
+def makeReferenceDb(path, vcfs):
+    rng = random.Random(SEED)
+    variants = {}
+    for vcf in vcfs:
+        with open(vcf) as fh:
+            for line in fh:
+                if not line.startswith("#"):
+                    f = line.split("\t")
+                    variants.setdefault(f[0], set()).add((int(f[1]), f[3], f[4]))
+
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    createTables(cursor)
+
+    for chrom in sorted(variants):
+        known = sorted(variants[chrom])
+        ucsc = "chr" + chrom
+
+        def near():
+            return rng.choice(known)
+
+        def intervals(table, count, width, row):
+            for i in range(count):
+                pos = near()[0]
+                start = pos - rng.randint(0, width)
+                end = pos + rng.randint(0, width)
+                insert(cursor, table, row(i, start, end))
+
+        for i in range(len(known) // 2):
+            pos, ref, alt = near()
+            if rng.random() >= 0.7:
+                ref = COMPLEMENT.get(ref, ref)
+            insert(
+                cursor,
+                "dbSNP",
+                [
+                    chrom,
+                    pos,
+                    0,
+                    "rs" + str(rng.randint(1, 10**7)),
+                    ref,
+                    alt,
+                    rng.choice(["SNV", "SNV", "DIV"]),
+                    rng.choice([".", "0.12", "0.3"]),
+                ],
+            )
+
+        for table, every in [
+            ("chrom_pos_equal_base", 3),
+            ("chrom_pos_equal_nobase", 4),
+            ("chrom_pos_unequal", 5),
+        ]:
+            for i in range(len(known) // every):
+                pos, ref, alt = near()
+                start, end = pos, pos
+                if table == "chrom_pos_unequal":
+                    start = pos - rng.randint(0, 50)
+                    end = pos + rng.randint(0, 50)
+                insert(
+                    cursor,
+                    table,
+                    [i, chrom, start, end, ref, alt, "NM_" + str(i), "G" + str(i % 7)]
+                    + [rng.choice("+-"), rng.choice(["CDS", "intron", "utr5"])]
+                    + ["0", "12", "4", "0", "ACG", "T", "ACA", "T"]
+                    + [rng.choice(["0", "Y"]), "missense", "c.1", "p.1", "1", "", "0"],
+                )
+
+        for i in range(len(known) // 10 + 1):
+            pos = near()[0]
+            tx_start = pos - rng.randint(-600, 20000)
+            tx_end = tx_start + rng.randint(100, 40000)
+            exons = rng.randint(1, 6)
+            bounds = sorted(rng.sample(range(tx_start, tx_end), 2 * exons))
+            if rng.random() < 0.2:
+                cds_start = cds_end = tx_end
+            else:
+                cds_start = tx_start + (tx_end - tx_start) // 5
+                cds_end = tx_end - (tx_end - tx_start) // 5
+            insert(
+                cursor,
+                "refGene",
+                [
+                    binFromRange(tx_start, tx_end),
+                    "NM_" + str(i),
+                    ucsc,
+                    rng.choice("+-"),
+                    tx_start,
+                    tx_end,
+                    cds_start,
+                    cds_end,
+                    exons,
+                    ("".join([str(b) + "," for b in bounds[0::2]])).encode(),
+                    ("".join([str(b) + "," for b in bounds[1::2]])).encode(),
+                    0,
+                    "GENE" + str(i),
+                    "cmpl",
+                    "cmpl",
+                    "",
+                ],
+            )
+            for n, (start, end) in enumerate(
+                [(tx_start - 600, tx_start + 10), (tx_end - 10, tx_end + 600)]
+            ):
+                insert(
+                    cursor,
+                    "cpgIslandExt",
+                    [binFromRange(start, end), ucsc, start, end, f"CpG: {i + n}", 5],
+                )
+
+        length = known[-1][0] + 1000
+        step = max(1, length // 20)
+        for k, start in enumerate(range(0, length, step)):
+            end = start + step + (5 if k % 3 == 0 else 0)
+            insert(cursor, "cytoBand", [ucsc, start, end, "p" + str(k), "gneg"])
+
+        intervals(
+            "gadAll",
+            len(known) // 4,
+            3000,
+            lambda i, s, e: [i, chrom, s, e, "disease " + str(i % 5)],
+        )
+        for i in range(len(known) // 6):
+            pos = near()[0]
+            insert(
+                cursor,
+                "gwasCatalog",
+                [binFromRange(pos - 1, pos), ucsc, pos - 1, pos, "rs1", str(i)]
+                + ["a", "d", "j", "t", "trait " + str(i % 4)],
+            )
+        intervals(
+            "hugo",
+            len(known) // 5,
+            5000,
+            lambda i, s, e: [binFromRange(s, e), ucsc, s, e, "h"]
+            + ["SYM" + str(i % 9), "desc; x " + str(i)],
+        )
+        intervals(
+            "genomicSuperDups",
+            len(known) // 5,
+            2000,
+            lambda i, s, e: [binFromRange(s, e), ucsc, s, e, "n", 1, "+", "chr9"]
+            + [s * 2, e * 2],
+        )
+        intervals(
+            "targetScanS",
+            len(known) // 5,
+            200,
+            lambda i, s, e: [binFromRange(s, e), ucsc, s, e, "miR-" + str(i), 1],
+        )
+        for table in CNV_TABLES:
+            intervals(
+                table,
+                len(known) // 8 + 1,
+                20000,
+                lambda i, s, e: [binFromRange(s, e), ucsc, s, e, "cnv" + str(i)],
+            )
+        if chrom in CHROMOSOMES:
+            intervals(
+                "tfbsConsSites" + chrom,
+                len(known) // 3,
+                100,
+                lambda i, s, e: [ucsc, s, e, f"V$TF{i} ", 1],
+            )
+
+    conn.commit()
+    conn.close()
+
+
+"""Annotates a copy of every input in directory with driver.run(**kwargs);
+   returns {file name: (annotated file, .count.log)}
+"""
+
+
+def annotate(inputs, directory, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+    results = {}
+    for name, vcf in inputs.items():
+        path = os.path.join(directory, name)
+        shutil.copy(vcf, path)
+        driver.run(path, "vcf", **kwargs)
+        with open(path.replace(".vcf", ".annot.vcf")) as fh:
+            annotated = fh.read()
+        with open(path + ".count.log") as fh:
+            log = [l for l in fh if not l.startswith(VARIABLE_LINES)]
+        results[name] = (annotated, "".join(log))
+    return results
+
+
+def assertSame(results, expected):
+    assert sorted(results) == sorted(expected)
+    for name in expected:
+        annotated, log = results[name]
+        assert annotated == expected[name][0], f"{name} annotated differently"
+        assert log == expected[name][1], f"{name}.count.log differs"
+
+
+"""Writes vcf to path with its records in a random order (seeded with
+   seed), its header first
+"""
+
+
+def shuffleVcf(vcf, path, seed):
+    with open(vcf) as fh:
+        lines = fh.readlines()
+    headers = [l for l in lines if l.startswith("#")]
+    records = [l for l in lines if not l.startswith("#")]
+    random.Random(seed).shuffle(records)
+    with open(path, "w") as fh:
+        fh.writelines(headers + records)
+
+
+"""Inputs of the tests: the test_files VCFs, cut; keyed by file name
+"""
+
+
+@pytest.fixture(scope="session")
+def inputs(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("inputs")
+    files = {}
+    for vcf in sorted(glob.glob(os.path.join(TEST_FILES, "*.vcf"))):
+        path = str(directory / os.path.basename(vcf))
+        cutVcf(vcf, path)
+        files[os.path.basename(vcf)] = path
+    return files
+
+
+"""Generated reference database, opened by every connection the annotator
+   makes for as long as the tests run
+"""
+
+
+@pytest.fixture(scope="session")
+def reference_db(tmp_path_factory, inputs):
+    path = str(tmp_path_factory.mktemp("reference") / "annotator.db")
+    makeReferenceDb(path, list(inputs.values()))
+
+    saved = dict((k, os.environ.get(k)) for k in ("ANN_DB_BACKEND", "ANN_DB_PATH"))
+    os.environ["ANN_DB_BACKEND"] = "sqlite"
+    os.environ["ANN_DB_PATH"] = path
+    yield path
+    for k, value in saved.items():
+        if value is None:
+            os.environ.pop(k, None)
+        else:
+            os.environ[k] = value
+
+
+"""Output of the default per-file pipeline, the reference of every mode
+"""
+
+
+@pytest.fixture(scope="session")
+def baseline(reference_db, inputs, tmp_path_factory):
+    return annotate(inputs, str(tmp_path_factory.mktemp("baseline")))
+
+
+"""The inputs with their records shuffled, for the modes needing sorted
+   input
+"""
+
+
+@pytest.fixture(scope="session")
+def shuffled(inputs, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("shuffled")
+    files = {}
+    for name, vcf in inputs.items():
+        files[name] = str(directory / name)
+        shuffleVcf(vcf, files[name], name)
+    return files
+
+
+### EOF
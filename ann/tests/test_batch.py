@@ -0,0 +1,59 @@
+# test_batch.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the per-chromosome window lookups (batch_size > 0)
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import shutil
+
+import pytest
+
+import annotate as ann
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.mark.parametrize("batch_size", [1, BATCH_SIZE, 1000])
+def testBatchedMatchesPerFilePipeline(batch_size, inputs, baseline, tmp_path):
+    assertSame(annotate(inputs, str(tmp_path), batch_size=batch_size), baseline)
+
+
+"""The CNV stage alone, per variant and per window
+"""
+
+
+@pytest.mark.parametrize("table", ["dgv_Cnv", "conrad_Cnv"])
+def testCnvWindows(table, reference_db, inputs, tmp_path):
+    vcf = str(tmp_path / "premium_3.vcf")
+    shutil.copy(inputs["premium_3.vcf"], vcf)
+
+    ann.addOverlapWithCnvDatabase(vcf, table=table, tmpextout=".rows")
+    ann.addOverlapWithCnvDatabase(
+        vcf, table=table, tmpextout=".windows", batch_size=BATCH_SIZE
+    )
+    with open(vcf + ".rows") as fh:
+        rows = fh.read()
+    with open(vcf + ".windows") as fh:
+        windows = fh.read()
+    assert rows == windows
+    assert table + "=True" in rows
+
+
+def testPositionWindows():
+    positions = [1, 2, 3, 10, ann.WINDOW_SPAN + 2, ann.WINDOW_SPAN + 3]
+    assert list(ann.positionWindows(positions, 2)) == [
+        [1, 2],
+        [3, 10],
+        [ann.WINDOW_SPAN + 2, ann.WINDOW_SPAN + 3],
+    ]
+    assert list(ann.positionWindows(positions, 10)) == [
+        [1, 2, 3, 10],
+        [ann.WINDOW_SPAN + 2, ann.WINDOW_SPAN + 3],
+    ]
+    assert list(ann.positionWindows([], 10)) == []
+
+
+### EOF
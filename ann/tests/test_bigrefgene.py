@@ -0,0 +1,67 @@
+# test_bigrefgene.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the bigRefGene stage resolving its three tiers per block
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import shutil
+
+import pytest
+
+import annotate as ann
+import lookup as lk
+from conftest import BATCH_SIZE
+
+"""Lookup counting the block lookups it passes on
+"""
+
+
+class CountingLookup(lk.Lookup):
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.blocks = 0
+
+    def overlap(self, *args, **kwargs):
+        return self.lookup.overlap(*args, **kwargs)
+
+    def overlapBlock(self, *args, **kwargs):
+        self.blocks = self.blocks + 1
+        return self.lookup.overlapBlock(*args, **kwargs)
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, BATCH_SIZE])
+def testTiersPerBlock(batch_size, reference_db, inputs, tmp_path):
+    vcf = str(tmp_path / "premium_3.vcf")
+    shutil.copy(inputs["premium_3.vcf"], vcf)
+    ann.getBigRefGene(vcf, tmpextin="", tmpextout=".rows")
+
+    sql = lk.SqlLookup()
+    lookup = CountingLookup(sql)
+    stage = ann.BigRefGeneStage(lookup, batch_size=batch_size)
+    ann.runStage(vcf, stage, tmpextout=".blocks")
+    sql.close()
+
+    with open(vcf + ".rows") as fh:
+        rows = fh.read()
+    with open(vcf + ".blocks") as fh:
+        assert fh.read() == rows
+
+    ## at most one lookup per tier and window of a block
+    records = [l.split("\t") for l in rows.splitlines() if not ann.isHeader(l)]
+    windows = 0
+    for i in range(0, len(records), 1000):
+        keys = {}
+        for fields in records[i : i + 1000]:
+            keys.setdefault(fields[0], set()).add(int(fields[1]))
+        for positions in keys.values():
+            windows = windows + len(
+                list(ann.positionWindows(sorted(positions), batch_size))
+            )
+    assert 0 < lookup.blocks <= 3 * windows
+
+
+### EOF
@@ -0,0 +1,83 @@
+# test_bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the dbSNP Bloom filter
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import bloom as bl
+import utils as u
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.fixture(scope="session")
+def bloom_filter(reference_db, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("bloom") / "dbSNP.bloom")
+    bl.buildFilter(path)
+    return path
+
+
+"""Every (CHR, POS) key of dbSNP, read straight from the database
+"""
+
+
+def dbSnpKeys():
+    conn = u.open_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("select CHR, POS from dbSNP")
+    keys = [row for row in cursor.fetchall() if None not in row]
+    cursor.close()
+    conn.close()
+    return keys
+
+
+def testNoFalseNegatives(bloom_filter):
+    bloom = bl.openFilter(bloom_filter)
+    keys = dbSnpKeys()
+    assert bloom.count == len(keys) > 0
+    for chrom, pos in keys:
+        assert bloom.mayContain(chrom, pos)
+        ## the server ignores case and trailing blanks of the chromosome
+        assert bloom.mayContain(" " + str(chrom).lower() + " ", str(pos))
+
+
+@pytest.mark.parametrize("rate", [bl.FALSE_POSITIVE_RATE, 0.1])
+def testFalsePositiveRate(rate):
+    rng = random.Random(3)
+    bloom = bl.newFilter(20000, rate)
+    for i in range(20000):
+        bloom.add(str(rng.randint(1, 22)), rng.randrange(1 << 30))
+    ## sized for rate; 20000 keys leave some room for the variance
+    assert bl.measureFalsePositives(bloom, probes=20000) < rate * 1.5
+
+
+def testFilterFileRoundTrip(tmp_path):
+    bloom = bl.newFilter(100)
+    for pos in range(100):
+        bloom.add("1", pos)
+    path = str(tmp_path / "test.bloom")
+    bloom.write(path, "dbSNP")
+    opened = bl.openFilter(path)
+    assert (opened.bits, opened.hashes, opened.count) == (bloom.bits, bloom.hashes, 100)
+    assert opened.table == "dbSNP"
+    assert bytes(opened.data) == bytes(bloom.data)
+
+    with open(str(tmp_path / "bad.bloom"), "wb") as fh:
+        fh.write(b"NOTBLOOM" + bytes(16))
+    with pytest.raises(ValueError):
+        bl.openFilter(str(tmp_path / "bad.bloom"))
+
+
+def testBloomFilter(inputs, baseline, bloom_filter, tmp_path):
+    results = annotate(inputs, str(tmp_path), bloom=bloom_filter, batch_size=BATCH_SIZE)
+    assertSame(results, baseline)
+
+
+### EOF
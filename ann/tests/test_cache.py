@@ -0,0 +1,85 @@
+# test_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the per-job lookup result cache (ResultCache)
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import re
+
+import pytest
+
+import lookup as lk
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [dict(), dict(fused=True, batch_size=BATCH_SIZE), dict(workers=2)],
+    ids=["per-file", "fused-batched", "parallel"],
+)
+def testCachedMatchesPerFilePipeline(kwargs, inputs, baseline, tmp_path):
+    results = annotate(inputs, str(tmp_path), cache_size=1000, **kwargs)
+    assertSame(results, baseline)
+
+
+"""Records repeating a position, as multi-allelic sites split over several
+   lines are, are answered from the cache
+"""
+
+
+def testRepeatedPositionsHitCache(reference_db, inputs, tmp_path):
+    vcf = str(tmp_path / "repeated.vcf")
+    with open(inputs["premium_3.vcf"]) as fh:
+        lines = fh.readlines()
+    with open(vcf, "w") as fh:
+        for line in lines:
+            fh.write(line)
+            if not line.startswith("#"):
+                fh.write(line)
+    repeated = {"repeated.vcf": vcf}
+
+    expected = annotate(repeated, str(tmp_path / "per-file"))
+    results = annotate(repeated, str(tmp_path / "cached"), cache_size=100000)
+    assertSame(results, expected)
+
+    with open(str(tmp_path / "cached" / "repeated.vcf.count.log")) as fh:
+        log = fh.read()
+    hits, misses = [
+        int(n) for n in re.search(r"(\d+) hits, (\d+) misses", log).groups()
+    ]
+    ## every lookup of the second copy of a record is a hit
+    assert hits > misses // 2 > 0
+
+
+def testLeastRecentlyUsedEvicted():
+    cache = lk.ResultCache(2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1]
+    assert cache.get("c") == [3]
+    assert cache.getCounters() == {"hits": 3, "misses": 1}
+
+
+"""Results are copied in and out, so a stage changing the rows it was
+   given cannot change the cached ones
+"""
+
+
+def testCachedRowsCopied():
+    cache = lk.ResultCache(2)
+    rows = [(1,), (2,)]
+    cache.put("a", rows)
+    rows.append((3,))
+    got = cache.get("a")
+    got.append((4,))
+    assert cache.get("a") == [(1,), (2,)]
+
+
+### EOF
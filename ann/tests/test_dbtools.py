@@ -0,0 +1,149 @@
+# test_dbtools.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the index provisioning and query-plan checks of dbtools.py
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import dbtools
+import lookup as lk
+
+"""Cursor answering EXPLAIN with the rows MySQL gives for a range lookup
+"""
+
+EXPLAIN_COLUMNS = ("id", "select_type", "table", "type", "possible_keys", "key")
+EXPLAIN_COLUMNS = EXPLAIN_COLUMNS + ("key_len", "ref", "rows", "Extra")
+
+
+class MySqlExplainCursor(object):
+    def __init__(self):
+        self.executed = []
+        self.description = None
+
+    def execute(self, sql, args=None):
+        self.executed.append((sql, args))
+        self.description = [(name,) for name in EXPLAIN_COLUMNS]
+
+    def fetchall(self):
+        row = (1, "SIMPLE", "refGene", "range", "ann_chrom_bin", "ann_chrom_bin")
+        return [row + ("11", None, 42, "Using index condition; Using where")]
+
+
+def testExplainRowsByColumn():
+    cursor = dbtools.ExplainCursor(MySqlExplainCursor())
+    cursor.plans = []
+    cursor.execute("select * from refGene where chrom = %s", ("chr1",))
+    assert cursor.fetchall() == ()
+    assert cursor.cursor.executed == [
+        ("EXPLAIN select * from refGene where chrom = %s", ("chr1",))
+    ]
+    ((sql, rows),) = cursor.plans
+    assert sql == "select * from refGene where chrom = %s"
+    assert rows == [
+        {
+            "id": 1,
+            "select_type": "SIMPLE",
+            "table": "refGene",
+            "type": "range",
+            "possible_keys": "ann_chrom_bin",
+            "key": "ann_chrom_bin",
+            "key_len": "11",
+            "ref": None,
+            "rows": 42,
+            "Extra": "Using index condition; Using where",
+        }
+    ]
+    assert dbtools.planProblems(rows, {"refGene": ["ann_chrom_bin"]}) == []
+
+
+def plan(table="refGene", type="range", key="ann_chrom_bin", rows=10):
+    return dict(table=table, type=type, key=key, rows=rows)
+
+
+EXPECTED = {"refGene": ["ann_chrom_txStart_txEnd", "ann_chrom_bin"]}
+
+
+@pytest.mark.parametrize(
+    "row, flagged",
+    [
+        (plan(), False),
+        (plan(type="ref", key="ann_chrom_txStart_txEnd"), False),
+        ## small tables may be scanned, however they are indexed
+        (plan(type="ALL", key=None, rows=dbtools.SCAN_ROWS), False),
+        (plan(type="index", key="PRIMARY", rows="12"), False),
+        (plan(type="ALL", key=None, rows=dbtools.SCAN_ROWS + 1), True),
+        (plan(type="index", key="PRIMARY", rows=str(10**6)), True),
+        ## an index exists for the lookup, but another one is read
+        (plan(type="ref", key="name"), True),
+        (plan(type="ref", key=None), True),
+        ## no index provisioned for the table: only scans count
+        (plan(table="hugo", type="ref", key="chrom"), False),
+        (plan(table="hugo", type="ALL", key=None, rows=None), False),
+        (dict(id=1, table=None, type=None, key=None, rows=None), False),
+    ],
+)
+def testPlanProblems(row, flagged):
+    assert (len(dbtools.planProblems([row], EXPECTED)) > 0) == flagged
+
+
+def testMatchingIndexes():
+    existing = {
+        "PRIMARY": ("name",),
+        "chrom": ("chrom", "bin"),
+        "ann_chrom_txStart_txEnd": ("chrom", "txstart", "txend"),
+    }
+    assert dbtools.matchingIndexes(existing, ("chrom", "bin")) == ["chrom"]
+    assert dbtools.matchingIndexes(existing, ("chrom", "txStart")) == [
+        "ann_chrom_txStart_txEnd"
+    ]
+    assert dbtools.matchingIndexes(existing, ("chrom", "txEnd")) == []
+
+
+def testRequiredIndexes(reference_db):
+    sql_lookup = lk.SqlLookup()
+    try:
+        required = dbtools.requiredIndexes(sql_lookup)
+    finally:
+        sql_lookup.close()
+    assert required["dbSNP"] == [("CHR", "POS")]
+    assert ("chrom", "bin") in required["refGene"]
+    assert ("chrom", "txStart", "txEnd") in required["refGene"]
+    assert ("chrom", "chromStart", "chromEnd") in required["cpgIslandExt"]
+
+
+"""Statements are explained instead of run, once per text, with the stages
+   sending them; the bin column check is not explained
+"""
+
+
+def testExplainLookupRecordsPlans(reference_db):
+    explain_lookup = dbtools.ExplainLookup()
+    genes = dict(start_col="txStart", end_col="txEnd")
+    try:
+        explain_lookup.stage = "Genes"
+        assert explain_lookup.overlap("refGene", "chr1", 1000, 2000, **genes) == []
+        explain_lookup.stage = "Genes (batched)"
+        explain_lookup.overlap("refGene", "chr1", 5000, 6000, **genes)
+        assert explain_lookup.overlapBlock(
+            "dbSNP", "1", [5, 9], "CHR", "POS", "POS"
+        ) == [
+            [],
+            [],
+        ]
+    finally:
+        explain_lookup.close()
+    plans = list(explain_lookup.plans.items())
+    assert len(plans) == 2
+    sql, (stages, rows) = plans[0]
+    assert sql.startswith("select * from refGene where chrom = %s AND bin IN (")
+    assert stages == ["Genes", "Genes (batched)"]
+    assert len(rows) > 0 and all(isinstance(r, dict) for r in rows)
+    assert "limit 0" not in " ".join(explain_lookup.plans)
+
+
+### EOF
@@ -0,0 +1,104 @@
+# test_genes.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the exon index and the CpG island cache of the gene stages
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import annotate as ann
+import lookup as lk
+import utils as u
+
+"""Exon numbers of pos the way the gene stages found them before the
+   index: every exon scanned with utils.isBetween
+"""
+
+
+def scannedExonNumbers(count, starts, ends, pos, strand):
+    starts = [int(x) for x in starts.split(",")[0:count]]
+    ends = [int(x) for x in ends.split(",")[0:count]]
+    hits = [e for e in range(count) if u.isBetween(pos, starts[e], ends[e])]
+    if strand == "-":
+        return [count - e for e in hits]
+    return [e + 1 for e in hits]
+
+
+TRANSCRIPTS = [
+    ## sorted exons, exonStarts/exonEnds with the trailing comma of refGene
+    (3, "100,200,300,", "150,250,350,"),
+    ## exons touching: 150 is the end of one and the start of the next
+    (3, "100,150,300,", "150,250,350,"),
+    ## one-base exons
+    (2, "100,101,", "100,101,"),
+    ## not in order, scanned
+    (3, "300,100,200,", "350,150,250,"),
+    ## nested exons, scanned
+    (2, "100,120,", "200,130,"),
+]
+
+
+@pytest.mark.parametrize("count, starts, ends", TRANSCRIPTS)
+@pytest.mark.parametrize("strand", ["+", "-"])
+def testExonNumbersAtBoundaries(count, starts, ends, strand):
+    index = ann.ExonIndex(count, starts, ends)
+    bounds = [int(x) for x in (starts + ends).split(",") if x != ""]
+    positions = set([0, 99, 10**6])
+    for b in bounds:
+        positions.update([b - 1, b, b + 1])
+    for pos in sorted(positions):
+        assert index.exonNumbers(pos, strand) == scannedExonNumbers(
+            count, starts, ends, pos, strand
+        ), pos
+
+
+def testExonIndexCachedPerTranscript():
+    row = (0, "NM_1", "chr1", "+", 100, 400, 120, 380, 2, b"100,300,", b"150,400,")
+    cache = {}
+    exons = ann.getExonIndex(cache, row)
+    assert ann.getExonIndex(cache, row) is exons
+    assert exons.exonNumbers(300, "+") == [2]
+    other = row[:1] + ("NM_2",) + row[2:]
+    assert ann.getExonIndex(cache, other) is not exons
+
+
+"""Lookup counting the lookups it passes on
+"""
+
+
+class CountingLookup(lk.Lookup):
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.count = 0
+
+    def overlap(self, *args, **kwargs):
+        self.count = self.count + 1
+        return self.lookup.overlap(*args, **kwargs)
+
+
+def testCpgIslandsCached(reference_db):
+    with u.db_cursor() as cursor:
+        cursor.execute("select chrom, chromStart from cpgIslandExt limit 3")
+        islands = [(r[0], int(r[1])) for r in cursor.fetchall()]
+
+    sql = lk.SqlLookup()
+    lookup = CountingLookup(sql)
+    cpg = ann.CpgIslands(lookup, size=2)
+    for chrom, start in islands[:2]:
+        assert cpg.get(chrom, start) is not None
+        assert cpg.get(chrom, start) == cpg.get(chrom, start)
+    assert cpg.get("chr1", -10) is None
+    assert cpg.get("chr1", -10) is None
+    assert lookup.count == 3
+
+    ## the oldest position was evicted
+    cpg.get(*islands[0])
+    assert lookup.count == 4
+    sql.close()
+
+
+### EOF
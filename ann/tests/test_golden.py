@@ -0,0 +1,120 @@
+# test_golden.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Golden-output test against the annotator as it was before the lookup,
+# batching and pipeline rework
+#
+# The files in golden/ are the .annot.vcf and .count.log (gzipped) the
+# original per-stage annotate.py wrote for the cut test inputs over the
+# generated reference database of conftest.py. The other tests only compare the
+# modes of the current code with each other; this one pins all of them to
+# the output the annotator had to begin with.
+#
+# The genes stages join sets of names, whose order depends on the string
+# hash seed, so both runs set PYTHONHASHSEED to HASH_SEED. To regenerate
+# the files (after a change to the reference generator of conftest.py),
+# check out the baseline commit and run, from this directory:
+#
+#   git worktree add /tmp/baseline 3861e21
+#   python test_golden.py /tmp/baseline/ann
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import glob
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from conftest import (
+    ANN_DIR,
+    TEST_FILES,
+    VARIABLE_LINES,
+    cutVcf,
+    makeReferenceDb,
+)
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+HASH_SEED = "0"
+
+"""Annotates the inputs with the driver of ann_dir; the original code has
+   no local database backend, so its db_connect() is pointed at the SQLite
+   file with localdb.py of this tree
+"""
+RUNNER = """
+import sys
+ann_dir, ann_local, path = sys.argv[1:4]
+sys.path[:0] = [ann_dir, ann_local]
+import driver, localdb, utils
+if not hasattr(utils, "open_db_connection"):
+    utils.db_connect = lambda: localdb.connect("sqlite", path)
+for vcf in sys.argv[4:]:
+    driver.run(vcf, "vcf")
+"""
+
+
+def runDriver(ann_dir, db_path, vcfs):
+    env = dict(os.environ)
+    env.update(PYTHONHASHSEED=HASH_SEED, ANN_DB_BACKEND="sqlite", ANN_DB_PATH=db_path)
+    subprocess.run(
+        [sys.executable, "-c", RUNNER, ann_dir, ANN_DIR, db_path] + vcfs,
+        env=env,
+        cwd=os.path.dirname(vcfs[0]),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+"""Cuts the test inputs into directory, generates their reference database
+   and annotates them with the driver of ann_dir; returns {output file
+   name: text}, without the VARIABLE_LINES of the logs
+"""
+
+
+def annotateInputs(ann_dir, directory):
+    vcfs = []
+    for vcf in sorted(glob.glob(os.path.join(TEST_FILES, "*.vcf"))):
+        vcfs.append(os.path.join(directory, os.path.basename(vcf)))
+        cutVcf(vcf, vcfs[-1])
+    db_path = os.path.join(directory, "annotator.db")
+    makeReferenceDb(db_path, vcfs)
+    runDriver(ann_dir, db_path, vcfs)
+
+    outputs = {}
+    for vcf in vcfs:
+        for path in [vcf.replace(".vcf", ".annot.vcf"), vcf + ".count.log"]:
+            with open(path) as fh:
+                lines = [l for l in fh if not l.startswith(VARIABLE_LINES)]
+            outputs[os.path.basename(path)] = "".join(lines)
+    return outputs
+
+
+def testMatchesOriginalAnnotator(tmp_path):
+    outputs = annotateInputs(ANN_DIR, str(tmp_path))
+    assert sorted([name + ".gz" for name in outputs]) == sorted(os.listdir(GOLDEN_DIR))
+    for name, text in sorted(outputs.items()):
+        with gzip.open(os.path.join(GOLDEN_DIR, name + ".gz"), "rt") as fh:
+            assert text == fh.read(), f"{name} differs from the original annotator"
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        outputs = annotateInputs(os.path.abspath(sys.argv[1]), directory)
+    finally:
+        shutil.rmtree(directory)
+    shutil.rmtree(GOLDEN_DIR, ignore_errors=True)
+    os.makedirs(GOLDEN_DIR)
+    for name, text in outputs.items():
+        with open(os.path.join(GOLDEN_DIR, name + ".gz"), "wb") as fh:
+            fh.write(gzip.compress(text.encode("utf-8"), mtime=0))
+    print(f"Wrote {str(len(outputs))} files to {GOLDEN_DIR}")
+
+
+### EOF
@@ -0,0 +1,152 @@
+# test_intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the in-memory interval indexes and the index lookup backend
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import intervals as iv
+from conftest import BATCH_SIZE, annotate, assertSame, binFromRange
+
+"""Random intervals on two chromosomes, as (chrom, start, end, row) in
+   table order, the row being the position in the table
+"""
+
+
+def randomIntervals(count, seed=1):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        start = rng.randint(0, 5000)
+        end = start + rng.choice([0, 0, 1, 10, 100, 2000])
+        entries.append((rng.choice(["chr1", "chr2"]), start, end, (i,)))
+    return entries
+
+
+def buildIndex(entries):
+    index = iv.IntervalIndex()
+    for chrom, start, end, row in entries:
+        index.add(chrom, start, end, row)
+    return index.freeze()
+
+
+def bruteForce(entries, chrom, lo, hi):
+    return [e[3] for e in entries if e[0] == chrom and e[1] <= hi and lo <= e[2]]
+
+
+def testQueryMatchesBruteForce():
+    entries = randomIntervals(400)
+    index = buildIndex(entries)
+    rng = random.Random(2)
+    for i in range(500):
+        lo = rng.randint(-10, 7200)
+        hi = lo + rng.choice([0, 0, 5, 300])
+        for chrom in ["chr1", "chr2"]:
+            assert index.query(chrom, lo, hi) == bruteForce(entries, chrom, lo, hi)
+    assert index.query("chr3", 10) == []
+
+
+def testQueryBlockMatchesQuery():
+    entries = randomIntervals(400)
+    index = buildIndex(entries)
+    positions = sorted(random.Random(3).sample(range(0, 7200), 200))
+    expected = [index.query("chr1", pos) for pos in positions]
+    assert index.queryBlock("chr1", positions) == expected
+    assert index.queryBlock("chr1", positions[:3]) == expected[:3]
+    assert index.queryBlock("chr3", positions) == [[] for pos in positions]
+
+
+def testIntervalsInStartOrder():
+    entries = randomIntervals(100)
+    index = buildIndex(entries)
+    intervals = list(index.intervals("chr2"))
+    assert [i[0] for i in intervals] == sorted(i[0] for i in intervals)
+    assert sorted(i[3] for i in intervals) == sorted(
+        e[3] for e in entries if e[0] == "chr2"
+    )
+    assert list(index.intervals("chr3")) == []
+
+
+"""The batch kernel finds, for every position, the intervals containing it
+"""
+
+
+def testBlockHitsMatchesBruteForce():
+    np = iv.np
+    entries = sorted(randomIntervals(300), key=lambda e: e[1])
+    starts = np.array([e[1] for e in entries], dtype=np.int64)
+    ends = np.array([e[2] for e in entries], dtype=np.int64)
+    maxends = np.maximum.accumulate(ends)
+    positions = [-5, 0, 3, 3, 2500, 5000, 7001, 7200]
+    positions = positions + random.Random(4).sample(range(0, 7200), 100)
+
+    hits, bounds = iv.blockHits(starts, ends, maxends, positions)
+    for i, pos in enumerate(positions):
+        expected = [j for j, e in enumerate(entries) if e[1] <= pos <= e[2]]
+        assert sorted(hits[bounds[i] : bounds[i + 1]].tolist()) == expected
+
+
+def testQueryBlockWithoutNumpy(monkeypatch):
+    index = buildIndex(randomIntervals(400))
+    positions = sorted(random.Random(5).sample(range(0, 7200), 100))
+    expected = index.queryBlock("chr2", positions)
+    monkeypatch.setattr(iv, "np", None)
+    assert buildIndex(randomIntervals(400)).queryBlock("chr2", positions) == expected
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [dict(), dict(batch_size=BATCH_SIZE, fused=True)],
+    ids=["rows", "batched"],
+)
+def testIndexBackend(kwargs, inputs, baseline, tmp_path):
+    results = annotate(inputs, str(tmp_path), lookup="index", **kwargs)
+    assertSame(results, baseline)
+
+
+def testIndexBackendWithoutNumpy(inputs, baseline, tmp_path, monkeypatch):
+    monkeypatch.setattr(iv, "np", None)
+    results = annotate(inputs, str(tmp_path), lookup="index", batch_size=BATCH_SIZE)
+    assertSame(results, baseline)
+
+
+"""Every bin of every level whose span meets the bases [lo, hi], found by
+   walking all the bins of the 512 Mb the scheme covers
+"""
+
+
+def bruteForceBins(lo, hi):
+    bins = []
+    shift = iv.BIN_FIRST_SHIFT
+    for offset in iv.BIN_OFFSETS:
+        for k in range((1 << 29) >> shift):
+            if k << shift <= hi and lo < (k + 1) << shift:
+                bins.append(offset + k)
+        shift = shift + iv.BIN_NEXT_SHIFT
+    return bins
+
+
+def testBinsOverlappingMatchesBruteForce():
+    rng = random.Random(5)
+    ranges = [(0, 0), (0, 1 << 17), ((1 << 17) - 1, 1 << 17), (-10, 5)]
+    for i in range(200):
+        lo = rng.randrange(1 << 28)
+        ranges.append((lo, lo + rng.choice([0, 1, 100, 1 << 17, 1 << 20, 1 << 26])))
+    for lo, hi in ranges:
+        bins = iv.binsOverlapping(lo, hi)
+        assert sorted(bins) == sorted(bruteForceBins(max(lo, 0), hi))
+        ## the bin of any feature overlapping the range is among them
+        for start in [lo - 1000, lo - 1, lo, hi]:
+            for size in [1, 100, 1 << 17, 1 << 20]:
+                if start >= 0 and start < hi + 1 and lo < start + size:
+                    assert binFromRange(start, start + size) in bins
+
+
+### EOF
@@ -0,0 +1,145 @@
+# test_localdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the import of MySQL dumps into a local database file
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import gzip
+
+import pytest
+
+import localdb
+
+CREATE = """CREATE TABLE `refGene` (
+  `bin` smallint(5) unsigned NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `chrom` varchar(255) NOT NULL,
+  `txStart` int(10) unsigned NOT NULL,
+  `score` double DEFAULT NULL,
+  `exonStarts` longblob NOT NULL,
+  PRIMARY KEY (`name`,`chrom`),
+  KEY `chrom` (`chrom`,`bin`),
+  UNIQUE KEY `tx` (`txStart`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
+"""
+
+INSERT = (
+    "INSERT INTO `refGene` VALUES "
+    + "(585,'NM_1','chr1',1000,-1.5,'1,2,'),"
+    + "(73,'O\\'Brien (it''s)','chr1',2000,NULL,'a\\\\b\\n'),\n"
+    + "(9,'NULL','chrX',3000,2e3,'),(')"
+    + ";\n"
+)
+
+
+def testParseCreate():
+    columns, keys = localdb.parseCreate(CREATE)
+    assert columns == [
+        ("bin", "smallint"),
+        ("name", "varchar"),
+        ("chrom", "varchar"),
+        ("txStart", "int"),
+        ("score", "double"),
+        ("exonStarts", "longblob"),
+    ]
+    assert keys == [
+        ("primary", ["name", "chrom"]),
+        ("chrom", ["chrom", "bin"]),
+        ("tx", ["txStart"]),
+    ]
+
+
+def testParseInsert():
+    assert localdb.parseInsert(INSERT) == [
+        ["585", "NM_1", "chr1", "1000", "-1.5", "1,2,"],
+        ["73", "O'Brien (it's)", "chr1", "2000", None, "a\\b\n"],
+        ## a quoted NULL is a string, and parentheses in strings are text
+        ["9", "NULL", "chrX", "3000", "2e3", "),("],
+    ]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("plain", "plain"),
+        ("tab\\there", "tab\there"),
+        ("nul\\0 \\Z", "nul\0 \x1a"),
+        ("quote\\'s and ''", "quote's and '"),
+        ("back\\\\slash \\%", "back\\slash %"),
+    ],
+)
+def testUnescape(text, expected):
+    assert localdb.unescape(text) == expected
+
+
+def testReadTabRows(tmp_path):
+    path = str(tmp_path / "refGene.txt.gz")
+    with gzip.open(path, "wt") as fh:
+        fh.write("585\tNM_1\tchr1\t1000\t\\N\t1,2,\n")
+        fh.write("73\tit's\\ta\\\\N\tchr1\t2000\t0.5\t\\\\N\n")
+    assert list(localdb.readTabRows(path)) == [
+        ["585", "NM_1", "chr1", "1000", None, "1,2,"],
+        ## only a field that is exactly \N is NULL, an escaped one is text
+        ["73", "it's\ta\\N", "chr1", "2000", "0.5", "\\N"],
+    ]
+
+
+def testReadStatements(tmp_path):
+    path = str(tmp_path / "dump.sql")
+    with open(path, "w") as fh:
+        fh.write("-- MySQL dump\n/*!40101 SET NAMES utf8 */;\n")
+        fh.write("DROP TABLE IF EXISTS `refGene`;\n" + CREATE)
+        fh.write("LOCK TABLES `refGene` WRITE;\n" + INSERT + "UNLOCK TABLES;\n")
+    assert list(localdb.readStatements(path)) == [CREATE, INSERT]
+
+
+"""A mysqldump file and a --tab pair imported into one database: values
+   keep their types, keys become indexes and text compares without case
+"""
+
+
+def testImportDumps(tmp_path):
+    dump = str(tmp_path / "dump.sql.gz")
+    with gzip.open(dump, "wt") as fh:
+        fh.write(CREATE + INSERT)
+    with open(str(tmp_path / "hugo.sql"), "w") as fh:
+        fh.write("CREATE TABLE `hugo` (\n  `chrom` varchar(255),\n")
+        fh.write("  `chromStart` int(10),\n  `name` varchar(255),\n")
+        fh.write("  KEY `chrom` (`chrom`,`chromStart`)\n);\n")
+    with open(str(tmp_path / "hugo.txt"), "w") as fh:
+        fh.write("chr1\t10\tA1BG\nchr2\t\\N\tA2M\n")
+    skipped = str(tmp_path / "skipped.sql")
+    with open(skipped, "w") as fh:
+        fh.write("CREATE TABLE `skipped` (\n  `x` int(10)\n);\n")
+        fh.write("INSERT INTO `skipped` VALUES (1);\n")
+
+    path = str(tmp_path / "local.db")
+    dumps = [dump, str(tmp_path / "hugo.sql"), skipped]
+    localdb.importDumps(path, dumps, tables={"refGene", "hugo"})
+
+    conn = localdb.connect("sqlite", path)
+    cursor = conn.cursor()
+    cursor.execute("select * from refGene where chrom = %s order by bin", ("CHR1",))
+    assert cursor.fetchall() == (
+        (73, "O'Brien (it's)", "chr1", 2000, None, b"a\\b\n"),
+        (585, "NM_1", "chr1", 1000, -1.5, b"1,2,"),
+    )
+    cursor.execute("select * from hugo")
+    assert cursor.fetchall() == (("chr1", 10, "A1BG"), ("chr2", None, "A2M"))
+    cursor.execute("select name from sqlite_master where type = 'index' order by name")
+    assert [r[0] for r in cursor.fetchall()] == [
+        "hugo_chrom",
+        "refGene_chrom",
+        "refGene_primary",
+        "refGene_tx",
+    ]
+    cursor.execute("select name from sqlite_master where name = 'skipped'")
+    assert cursor.fetchall() == ()
+    conn.close()
+
+
+### EOF
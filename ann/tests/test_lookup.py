@@ -0,0 +1,131 @@
+# test_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the SQL lookups of lookup.py against the generated reference
+# database
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import shutil
+
+import pytest
+
+import annotate as ann
+import lookup as lk
+import utils as u
+from conftest import BATCH_SIZE, annotate, assertSame
+
+DBSNP = dict(chrom_col="CHR", start_col="POS", end_col="POS")
+
+
+@pytest.fixture
+def sql(reference_db):
+    lookup = lk.SqlLookup()
+    yield lookup
+    lookup.close()
+
+
+def dbSnpPositions(chrom, count):
+    with u.db_cursor() as cursor:
+        cursor.execute(
+            "select distinct POS from dbSNP where CHR = %s order by POS", (chrom,)
+        )
+        return [int(r[0]) for r in cursor.fetchall()][:count]
+
+
+"""Values are sent as parameters, never spliced into the statement text
+"""
+
+
+def testValuesAreParameters(sql):
+    hostile = '1" OR "1" = "1'
+    assert list(sql.overlap("dbSNP", hostile, 1, **DBSNP)) == []
+    assert list(sql.overlap("dbSNP", "1'; delete from dbSNP; --", 1, **DBSNP)) == []
+    filters = ((("REF",), [("A' OR '1' = '1",)]),)
+    pos = dbSnpPositions("1", 1)[0]
+    assert list(sql.overlap("dbSNP", "1", pos, filters=filters, **DBSNP)) == []
+    assert len(sql.overlap("dbSNP", "1", pos, **DBSNP)) > 0
+
+
+def testStatementReusedAcrossValues(sql):
+    for pos in dbSnpPositions("1", 5):
+        sql.overlap("dbSNP", "1", pos, **DBSNP)
+        sql.overlap("cytoBand", "chr1", pos)
+    assert len(sql.statements) == 2
+
+
+### EOF
+
+
+"""A block lookup returns, for every position given, the rows a lookup of
+   that position alone returns; repeated and missing positions included
+"""
+
+
+def testBlockMatchesPointLookups(sql):
+    positions = dbSnpPositions("1", 20)
+    positions = positions + positions[:3] + [1, positions[-1] + 1]
+    filters = ((("INFO",), (("SNV",),)),)
+    block = sql.overlapBlock("dbSNP", "1", positions, filters=filters, **DBSNP)
+    assert len(block) == len(positions)
+    for pos, rows in zip(positions, block):
+        point = sql.overlap("dbSNP", "1", pos, filters=filters, **DBSNP)
+        assert [tuple(r) for r in rows] == [tuple(r) for r in point]
+    assert sum(len(rows) for rows in block) > 0
+
+
+def testDbSnpStageBlocks(reference_db, inputs, tmp_path):
+    vcf = str(tmp_path / "premium_3.vcf")
+    shutil.copy(inputs["premium_3.vcf"], vcf)
+    ann.getSnpsFromDbSnp(vcf, tmpextout=".rows")
+    ann.getSnpsFromDbSnp(vcf, tmpextout=".blocks", batch_size=BATCH_SIZE)
+    with open(vcf + ".rows") as fh:
+        rows = fh.read()
+    with open(vcf + ".blocks") as fh:
+        assert fh.read() == rows
+    assert ";DB" in rows or "\tDB" in rows
+
+
+"""The bin clause only narrows the rows read: every bin table answers the
+   same rows, in the same order, with and without it
+"""
+
+
+@pytest.mark.parametrize(
+    "table, start_col, end_col",
+    [
+        ("refGene", "txStart", "txEnd"),
+        ("cpgIslandExt", "chromStart", "chromEnd"),
+        ("gwasCatalog", "chromStart", "chromEnd"),
+    ],
+)
+def testBinsKeepRowsAndOrder(table, start_col, end_col, sql, monkeypatch):
+    unbinned = lk.SqlLookup()
+    monkeypatch.setattr(unbinned, "bins", False)
+    try:
+        assert sql.hasBin(table)
+        with u.db_cursor() as cursor:
+            cursor.execute(f"select chrom, {start_col}, {end_col} from {table}")
+            features = cursor.fetchall()
+        kwargs = dict(start_col=start_col, end_col=end_col)
+        found = 0
+        for chrom, start, end in features[::7]:
+            for lo, hi in [(start, None), (end, None), (start - 5000, end + 5000)]:
+                rows = sql.overlap(table, chrom, lo, hi, **kwargs)
+                assert rows == unbinned.overlap(table, chrom, lo, hi, **kwargs)
+                found = found + len(rows)
+            positions = [start - 1, start, (start + end) // 2, end, end + 1]
+            assert sql.overlapBlock(
+                table, chrom, positions, **kwargs
+            ) == unbinned.overlapBlock(table, chrom, positions, **kwargs)
+        assert found > 0
+    finally:
+        unbinned.close()
+
+
+def testAnnotationWithoutBins(inputs, baseline, tmp_path, monkeypatch):
+    monkeypatch.setattr(lk.SqlLookup, "bins", False)
+    assertSame(annotate(inputs, str(tmp_path)), baseline)
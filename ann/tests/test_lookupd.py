@@ -0,0 +1,100 @@
+# test_lookupd.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the host-wide lookup daemon and its messages
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import datetime
+import decimal
+import os
+import socket
+import threading
+
+import pytest
+
+import lookup as lk
+import lookupd
+from conftest import BATCH_SIZE, annotate, assertSame
+
+"""Lookup daemon serving the index backend from a thread, on a socket in a
+   private directory
+"""
+
+
+@pytest.fixture
+def daemon(reference_db, tmp_path, monkeypatch):
+    directory = tmp_path / "run"
+    directory.mkdir(mode=0o700)
+    path = str(directory / "lookupd.sock")
+    server = lookupd.LookupServer(path, backend="index", cache_size=1000)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(lk, "LOOKUPD_SOCKET", path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("batch_size", [0, BATCH_SIZE])
+def testDaemonBackend(batch_size, inputs, baseline, daemon, tmp_path):
+    results = annotate(inputs, str(tmp_path), lookup="daemon", batch_size=batch_size)
+    assertSame(results, baseline)
+    assert daemon.stats()["served"] > 0
+
+
+"""Rows come back from a message with the types the backends return
+"""
+
+
+def testMessageRoundTrip():
+    message = (
+        "overlap",
+        ("refGene", "chr1", 5),
+        {"filters": [(("name",), [("NM_1",)])], "hi": None},
+        [
+            (1, 2.5, "text", b"\x00\xff", decimal.Decimal("0.10")),
+            (datetime.date(2019, 1, 2), datetime.datetime(2019, 1, 2, 3, 4, 5)),
+        ],
+        {"__t": "a dict with a tag-like key and another", "x": 1},
+    )
+    left, right = socket.socketpair()
+    try:
+        lk.sendMessage(left, message)
+        assert lk.recvMessage(right) == message
+        left.close()
+        assert lk.recvMessage(right) is None
+    finally:
+        left.close()
+        right.close()
+
+
+def testTruncatedMessage():
+    left, right = socket.socketpair()
+    try:
+        left.sendall(b"\x10\x00\x00\x00\x00\x00\x00\x00{")
+        left.close()
+        with pytest.raises(ConnectionError):
+            lk.recvMessage(right)
+    finally:
+        right.close()
+
+
+@pytest.mark.parametrize(
+    "mode, allowed", [(0o700, True), (0o1777, True), (0o777, False), (0o770, False)]
+)
+def testSocketDirectory(mode, allowed, tmp_path):
+    directory = str(tmp_path / "run")
+    os.mkdir(directory)
+    os.chmod(directory, mode)
+    if allowed:
+        lk.checkSocketDirectory(directory)
+    else:
+        with pytest.raises(PermissionError):
+            lk.checkSocketDirectory(directory)
+
+
+### EOF
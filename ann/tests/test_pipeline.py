@@ -0,0 +1,172 @@
+# test_pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the engines of driver.run(): every one must annotate like the
+# per-file pipeline
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+import shutil
+import time
+
+import pytest
+
+import annotate as ann
+import lookup as lk
+import pipeline as pl
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.mark.parametrize("batch_size", [0, BATCH_SIZE])
+def testFusedPipeline(batch_size, inputs, baseline, tmp_path):
+    results = annotate(inputs, str(tmp_path), fused=True, batch_size=batch_size)
+    assertSame(results, baseline)
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def testParallelPipeline(workers, inputs, baseline, tmp_path):
+    results = annotate(inputs, str(tmp_path), workers=workers, batch_size=BATCH_SIZE)
+    assertSame(results, baseline)
+
+
+"""Shards of a file whose chromosomes are interleaved and whose header
+   lines are not all at the top merge back into the same file
+"""
+
+
+def testShardsMergeInOriginalOrder(tmp_path):
+    vcf = str(tmp_path / "mixed.vcf")
+    lines = [
+        "##fileformat=VCFv4.1",
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO",
+        "1\t10\t.\tA\tG\t.\t.\t.",
+        "2\t5\t.\tC\tT\t.\t.\t.",
+        "1\t20\t.\tA\tG\t.\t.\t.",
+        "##contig=<ID=X>",
+        "X\t7\t.\tG\tA\t.\t.\t.",
+        "2\t3\t.\tC\tT\t.\t.\t.",
+    ]
+    with open(vcf, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+    shards = pl.splitShards(vcf)
+    assert [size for shard, size in shards] == [2, 2, 1]
+    for shard, size in shards:
+        shutil.copy(shard, shard + ".annot")
+    pl.mergeShards(vcf)
+    with open(vcf + ".annot") as fh:
+        assert fh.read() == "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("depth", [1, 4])
+def testStreamingPipeline(depth, inputs, baseline, tmp_path):
+    results = annotate(inputs, str(tmp_path), streaming=True, queue_depth=depth)
+    assertSame(results, baseline)
+
+
+"""Stage failing on the record at position fail
+"""
+
+
+class FailingStage(ann.Stage):
+    def __init__(self, fail):
+        ann.Stage.__init__(self)
+        self.fail = fail
+
+    def annotate(self, record):
+        if record.pos == self.fail:
+            raise ValueError("failed at " + str(record.pos))
+        record.addInfo("seen")
+
+
+"""A failing stage fails the run, without leaving a thread blocked on a
+   full queue
+"""
+
+
+def testStreamingRaisesStageError(inputs, tmp_path):
+    vcf = str(tmp_path / "premium_3.vcf")
+    shutil.copy(inputs["premium_3.vcf"], vcf)
+    with open(vcf) as fh:
+        records = [l for l in fh if not ann.isHeader(l)]
+    fail = int(records[len(records) // 2].split("\t")[1])
+
+    stages = [FailingStage(None), FailingStage(fail), FailingStage(None)]
+    with pytest.raises(ValueError, match="failed at"):
+        pl.runStreaming(vcf, stages, block_size=10, depth=1)
+
+
+@pytest.mark.parametrize("concurrency", [2, 3])
+def testAsyncPipeline(concurrency, inputs, baseline, tmp_path):
+    results = annotate(
+        inputs, str(tmp_path), concurrency=concurrency, batch_size=BATCH_SIZE
+    )
+    assertSame(results, baseline)
+
+
+"""Stage taking a random time over each block, so blocks complete out of
+   order; it counts the records it annotates
+"""
+
+
+class SlowStage(ann.Stage):
+    counters = ("seen",)
+
+    def __init__(self, seed):
+        ann.Stage.__init__(self)
+        self.rng = random.Random(seed)
+        self.seen = 0
+
+    def annotateBlock(self, block):
+        time.sleep(self.rng.random() / 100)
+        ann.Stage.annotateBlock(self, block)
+
+    def annotate(self, record):
+        self.seen = self.seen + 1
+        record.addInfo("seen")
+
+
+def testAsyncWritesBlocksInOrder(inputs, tmp_path):
+    vcf = str(tmp_path / "premium_3.vcf")
+    shutil.copy(inputs["premium_3.vcf"], vcf)
+    chains = [[SlowStage(seed)] for seed in range(4)]
+    pl.runAsync(vcf, chains, block_size=7)
+
+    with open(vcf) as fh:
+        lines = [l.strip() for l in fh]
+    with open(vcf + ".annot") as fh:
+        annotated = [l.strip() for l in fh]
+    expected = []
+    for line in lines:
+        if not ann.isHeader(line):
+            fields = line.split("\t")
+            fields[ann.INFO] = fields[ann.INFO] + ";seen"
+            line = "\t".join(fields)
+        expected.append(line)
+    assert annotated == expected
+    assert chains[0][0].seen == len([l for l in lines if not ann.isHeader(l)])
+
+
+"""The parallel mode opens its lookups in the shards only
+"""
+
+
+def testParallelOpensNoLookupInParent(inputs, baseline, tmp_path, monkeypatch):
+    opened = []
+    openLookup = lk.openLookup
+
+    def countingOpenLookup(backend="sql"):
+        opened.append(backend)
+        return openLookup(backend)
+
+    monkeypatch.setattr(lk, "openLookup", countingOpenLookup)
+    results = annotate(inputs, str(tmp_path), workers=2)
+    assertSame(results, baseline)
+    assert opened == []
+
+
+### EOF
@@ -0,0 +1,89 @@
+# test_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of VariantRecord, the parsed record the stages annotate
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import annotate as ann
+
+INDS = ann.getFormatSpecificIndices("vcf")
+
+
+def record(line):
+    return ann.VariantRecord(line.split("\t"), INDS)
+
+
+LINES = [
+    "1\t100\t.\tA\tG\t50\tPASS\tDP=3",
+    "chrX\t7\t.\tG\tA\t.\t.\t.\tGT\t0/1\t1/1",
+    "2\t5\t.\tC\tT\t.\t.\t",
+    "2\t5\t.\tC\tT\t.\t.",
+]
+
+
+@pytest.mark.parametrize("line", LINES)
+def testLineUnchanged(line):
+    r = record(line)
+    assert r.line() == line
+    assert r.pos == int(line.split("\t")[1])
+
+
+"""addInfo appends after a ";" unless INFO already ends with one, like the
+   INFO + ";" + annotation of the stages before records were parsed once
+"""
+
+
+@pytest.mark.parametrize(
+    "info, expected",
+    [
+        ("DP=3", "DP=3;x=1"),
+        ("DP=3;", "DP=3;x=1"),
+        ("", ";x=1"),
+        (".", ".;x=1"),
+    ],
+)
+def testAddInfo(info, expected):
+    r = record("1\t100\t.\tA\tG\t.\t.\t" + info)
+    r.addInfo("x=1")
+    assert r.getInfo() == expected
+    r.addInfo("y=2")
+    assert r.line().split("\t")[7] == expected + ";y=2"
+
+
+def testExtendAndSetInfo():
+    r = record("1\t100\t.\tA\tG\t.\t.\t.\tGT\t0/1")
+    r.extendInfo(";DB")
+    r.extendInfo(";VC=SNV")
+    assert r.getInfo() == ".;DB;VC=SNV"
+    r.setInfo("DB")
+    assert r.line() == "1\t100\t.\tA\tG\t.\t.\tDB\tGT\t0/1"
+
+
+"""stripLast does to the record what writing it to a file and reading it
+   back with line.strip() did between the passes of the per-stage code
+"""
+
+
+@pytest.mark.parametrize(
+    "line, annotation",
+    [
+        ("1\t100\t.\tA\tG\t.\t.\tDP=3", "x=1 \t"),
+        ("1\t100\t.\tA\tG\t.\t.\tDP=3\tGT\t0/1 ", "x=1"),
+        ("1\t100\t.\tA\tG\t.\t.\tDP=3", "  "),
+    ],
+)
+def testStripLast(line, annotation):
+    r = record(line)
+    r.extendInfo(annotation)
+    written = r.line()
+    r.stripLast()
+    assert r.line() == written.strip()
+
+
+### EOF
@@ -0,0 +1,98 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the reference snapshots and the snapshot lookup backend
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import intervals as iv
+import lookup as lk
+import snapshot as ss
+import utils as u
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.fixture(scope="session")
+def snapshot_dir(reference_db, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("snapshot"))
+    for table, chrom_col, start_col, end_col in ss.SNAPSHOT_TABLES:
+        ss.exportTable(directory, table, chrom_col, start_col, end_col)
+    return directory
+
+
+@pytest.mark.parametrize("batch_size", [0, BATCH_SIZE])
+def testSnapshotBackend(
+    batch_size, inputs, baseline, snapshot_dir, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(ss, "SNAPSHOT_DIR", snapshot_dir)
+    results = annotate(inputs, str(tmp_path), lookup="snapshot", batch_size=batch_size)
+    assertSame(results, baseline)
+
+
+"""Snapshot lookups return the rows SQL returns, in the same order
+"""
+
+
+@pytest.mark.parametrize("table", ["refGene", "gadAll", "chrom_pos_unequal"])
+def testSnapshotMatchesSql(table, snapshot_dir):
+    key = [k for k in ss.SNAPSHOT_TABLES if k[0] == table][0]
+    table, chrom_col, start_col, end_col = key
+    chrom = "1" if chrom_col != "chrom" else "chr1"
+    columns = dict(chrom_col=chrom_col, start_col=start_col, end_col=end_col)
+
+    with u.db_cursor() as cursor:
+        cursor.execute(
+            "select " + start_col + " from " + table + " where " + chrom_col + " = %s",
+            (chrom,),
+        )
+        starts = [int(r[0]) for r in cursor.fetchall()]
+
+    snapshot = lk.SnapshotLookup(snapshot_dir)
+    sql = lk.SqlLookup()
+    rng = random.Random(table)
+    positions = sorted(rng.choice(starts) + rng.randint(-100, 100) for i in range(100))
+    found = 0
+    for pos in positions:
+        hi = pos + rng.choice([0, 500])
+        rows = snapshot.overlap(table, chrom, pos, hi, **columns)
+        assert [tuple(r) for r in rows] == [
+            tuple(r) for r in sql.overlap(table, chrom, pos, hi, **columns)
+        ]
+        found = found + len(rows)
+    assert found > 0
+    block = snapshot.overlapBlock(table, chrom, positions, **columns)
+    assert block == [snapshot.overlap(table, chrom, p, **columns) for p in positions]
+    sql.close()
+
+
+def testChromosomeCase(snapshot_dir):
+    snapshot = ss.openSnapshot(snapshot_dir, "refGene")
+    rows = snapshot.query("chr1", 0, 10**9)
+    assert len(rows) > 0
+    assert snapshot.query("CHR1", 0, 10**9) == rows
+    assert snapshot.queryBlock("Chr1", [0] * 40) == [[]] * 40
+
+
+"""Exports with and without NumPy write the same file
+"""
+
+
+def testExportWithoutNumpy(snapshot_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(iv, "np", None)
+    for table in ["refGene", "dbSNP"]:
+        key = [k for k in ss.SNAPSHOT_TABLES if k[0] == table][0]
+        ss.exportTable(str(tmp_path), *key)
+        with open(str(tmp_path / (table + ss.SUFFIX)), "rb") as fh:
+            exported = fh.read()
+        with open(snapshot_dir + "/" + table + ss.SUFFIX, "rb") as fh:
+            assert fh.read() == exported
+
+
+### EOF
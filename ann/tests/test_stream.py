@@ -0,0 +1,65 @@
+# test_stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the stages reading their rows from unbuffered cursors
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import lookup as lk
+from conftest import annotate, assertSame
+
+"""Tables read through SqlLookup.stream() during a run, tfbsConsSites
+   standing for its per-chromosome tables
+"""
+
+
+@pytest.fixture
+def streamed(monkeypatch):
+    tables = set()
+    stream = lk.SqlLookup.stream
+
+    def recordingStream(self, sql, args):
+        tables.add(sql.split(" from ")[1].split()[0].rstrip("0123456789XYMT"))
+        return stream(self, sql, args)
+
+    monkeypatch.setattr(lk.SqlLookup, "stream", recordingStream)
+    return tables
+
+
+def testStreamRows(inputs, baseline, streamed, tmp_path):
+    results = annotate(inputs, str(tmp_path), stream_rows=True)
+    assertSame(results, baseline)
+    assert streamed == {"refGene", "gadAll", "tfbsConsSites"}
+
+
+"""tfbs_index holds the tfbsConsSites rows of the chromosome of a sorted
+   input in memory, so that stage stops streaming and the run says so
+"""
+
+
+def testStreamRowsWithTfbsIndex(inputs, baseline, streamed, tmp_path, capsys):
+    results = annotate(inputs, str(tmp_path), stream_rows=True, tfbs_index=True)
+    assertSame(results, baseline)
+    assert streamed == {"refGene", "gadAll"}
+    assert "tfbsConsSites rows of each chromosome" in capsys.readouterr().out
+
+
+def testStreamRowsOfUnsortedInputWithTfbsIndex(
+    reference_db, shuffled, streamed, tmp_path, capsys
+):
+    expected = annotate(shuffled, str(tmp_path / "per-file"))
+    streamed.clear()
+    results = annotate(
+        shuffled, str(tmp_path / "stream"), stream_rows=True, tfbs_index=True
+    )
+    assertSame(results, expected)
+    assert "tfbsConsSites" in streamed
+    assert "held in memory" not in capsys.readouterr().out
+
+
+### EOF
@@ -0,0 +1,83 @@
+# test_sweep.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the sweep-line mode of the overlap stages
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import intervals as iv
+import lookup as lk
+from conftest import annotate, assertSame
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(sweep=True),
+        dict(sweep=True, fused=True),
+        dict(sweep=True, lookup="index", streaming=True),
+    ],
+    ids=["per-file", "fused", "index-streaming"],
+)
+def testSweepMatchesPerFilePipeline(kwargs, inputs, baseline, tmp_path):
+    assertSame(annotate(inputs, str(tmp_path), **kwargs), baseline)
+
+
+def testSweepOfUnsortedInput(reference_db, shuffled, tmp_path):
+    expected = annotate(shuffled, str(tmp_path / "per-file"))
+    results = annotate(shuffled, str(tmp_path / "sweep"), sweep=True, fused=True)
+    assertSame(results, expected)
+
+
+"""Backend answering from an interval index of random intervals
+"""
+
+
+class IndexedLookup(lk.Lookup):
+    def __init__(self, seed):
+        rng = random.Random(seed)
+        self.index = iv.IntervalIndex()
+        for i in range(300):
+            start = rng.randint(0, 5000)
+            end = start + rng.choice([0, 3, 50, 1500])
+            self.index.add(rng.choice(["chr1", "chr2"]), start, end, (i,))
+        self.index.freeze()
+
+    def overlap(self, table, chrom, lo, hi=None, **kwargs):
+        return self.index.query(chrom, lo, hi)
+
+    def loadTable(self, *args, **kwargs):
+        return self.index
+
+
+def testSweepMatchesLookups():
+    backend = IndexedLookup(1)
+    sweep = lk.SweepLookup(backend)
+    rng = random.Random(2)
+    for chrom in ["chr1", "chr2"]:
+        for pos in sorted(rng.randint(0, 7000) for i in range(300)):
+            assert sweep.overlap("t", chrom, pos) == backend.overlap("t", chrom, pos)
+    assert sweep.sorted
+
+    ## a chromosome coming back: answered by the backend from then on
+    assert sweep.overlap("t", "chr1", 2500) == backend.overlap("t", "chr1", 2500)
+    assert not sweep.sorted
+    assert sweep.overlap("t", "chr2", 10) == backend.overlap("t", "chr2", 10)
+
+
+def testSweepBackwardsPosition():
+    backend = IndexedLookup(3)
+    sweep = lk.SweepLookup(backend)
+    assert sweep.overlap("t", "chr1", 3000) == backend.overlap("t", "chr1", 3000)
+    assert sweep.overlap("t", "chr1", 2000) == backend.overlap("t", "chr1", 2000)
+    assert not sweep.sorted
+
+
+### EOF
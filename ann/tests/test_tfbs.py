@@ -0,0 +1,103 @@
+# test_tfbs.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the per-chromosome tfbsConsSites index (TfbsIndex)
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import pytest
+
+import lookup as lk
+import vcfsort as vs
+from conftest import BATCH_SIZE, annotate, assertSame
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    loaded = []
+    loadTableIndex = lk.loadTableIndex
+
+    def countingLoadTableIndex(table, *args):
+        loaded.append(table)
+        return loadTableIndex(table, *args)
+
+    monkeypatch.setattr(lk, "loadTableIndex", countingLoadTableIndex)
+    return loaded
+
+
+@pytest.mark.parametrize("batch_size", [0, BATCH_SIZE])
+def testTfbsIndexOnSortedInput(batch_size, inputs, baseline, tmp_path, loads):
+    assert vs.isSorted(inputs["premium_3.vcf"])
+    results = annotate(inputs, str(tmp_path), tfbs_index=True, batch_size=batch_size)
+    assertSame(results, baseline)
+    ## one load per chromosome of premium_3.vcf, 1 to 22
+    assert len(loads) == len(set(loads)) == 22
+
+
+"""Unsorted input is looked up per variant: no table is loaded, where
+   reloading a chromosome each time it came back cost a load per run of
+   records
+"""
+
+
+def testTfbsIndexOnUnsortedInput(reference_db, shuffled, tmp_path, loads):
+    expected = annotate(shuffled, str(tmp_path / "per-file"))
+    results = annotate(shuffled, str(tmp_path / "index"), tfbs_index=True)
+    assertSame(results, expected)
+    assert loads == []
+
+
+"""Input sorted with SortInput is annotated from the index
+"""
+
+
+def testTfbsIndexOnSortedUpload(reference_db, shuffled, tmp_path, loads):
+    expected = annotate(shuffled, str(tmp_path / "per-file"))
+    results = annotate(shuffled, str(tmp_path / "index"), tfbs_index=True, sort=True)
+    assertSame(results, expected)
+    assert len(loads) == len(set(loads)) == 22
+
+
+"""Lookup holding the queries it was asked for, in place of a backend
+"""
+
+
+class RecordingLookup(lk.Lookup):
+    def __init__(self):
+        self.queries = []
+
+    def overlap(self, table, chrom, lo, hi=None, **kwargs):
+        self.queries.append((table, lo))
+        return [(table, lo)]
+
+    def loadTable(self, table, *args):
+        self.queries.append((table, "load"))
+        return self
+
+    def query(self, chrom, lo, hi=None):
+        return [("loaded", lo)]
+
+
+def testChromosomeComingBackFallsBack():
+    recording = RecordingLookup()
+    lookup = lk.ChromosomeLookup(recording)
+    assert lookup.overlap("t1", None, 1) == [("loaded", 1)]
+    assert lookup.overlap("t1", None, 2) == [("loaded", 2)]
+    assert lookup.overlap("t2", None, 3) == [("loaded", 3)]
+    assert lookup.overlap("t1", None, 4) == [("t1", 4)]
+    assert lookup.overlap("t2", None, 5) == [("t2", 5)]
+    assert lookup.overlap("t3", None, 6) == [("t3", 6)]
+    assert recording.queries == [
+        ("t1", "load"),
+        ("t2", "load"),
+        ("t1", 4),
+        ("t2", 5),
+        ("t3", 6),
+    ]
+    assert lookup.loads == 2
+
+
+### EOF
@@ -0,0 +1,123 @@
+# test_utils.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the connection pool and the RDS secret cache
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+
+import pytest
+
+import utils as u
+
+
+@pytest.fixture
+def pool(reference_db, monkeypatch):
+    monkeypatch.setattr(u, "_pool", [])
+    return u._pool
+
+
+def testConnectionReturnedToPool(pool):
+    conn = u.db_connect()
+    raw = conn.conn
+    conn.close()
+    conn.close()
+    assert pool == [raw]
+
+    again = u.db_connect()
+    assert again.conn is raw
+    assert pool == []
+    again.close()
+
+
+def testPoolSize(pool, monkeypatch):
+    monkeypatch.setattr(u, "POOL_SIZE", 2)
+    conns = [u.borrow_connection() for i in range(3)]
+    for conn in conns:
+        u.return_connection(conn)
+    assert pool == conns[:2]
+
+
+def testPoolNotInheritedByChildProcess(pool, monkeypatch):
+    conn = u.borrow_connection()
+    u.return_connection(conn)
+    ## as if the pool had been filled by a parent process
+    monkeypatch.setattr(u, "_pool_pid", -1)
+    assert u.borrow_connection() is not conn
+
+
+def testCursorClosedBeforeReturn(pool):
+    with pytest.raises(ValueError):
+        with u.db_cursor(unbuffered=True) as cursor:
+            cursor.execute("select POS from dbSNP")
+            next(iter(cursor))
+            raise ValueError("stop halfway")
+    assert len(pool) == 1
+    with pytest.raises(Exception):
+        cursor.fetchone()
+
+    with u.db_cursor() as again:
+        again.execute("select count(*) from dbSNP")
+        assert again.fetchone()[0] > 0
+    assert len(pool) == 1
+
+
+"""Connection whose cursors fail to close, like one whose unread rows
+   could not be drained
+"""
+
+
+class BrokenCursor(object):
+    def close(self):
+        raise OSError("lost connection while reading the rows left")
+
+
+class BrokenConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self, *args):
+        return BrokenCursor()
+
+    def close(self):
+        self.closed = True
+
+
+def testConnectionDroppedWhenCursorFailsToClose(pool, monkeypatch):
+    conn = BrokenConnection()
+    monkeypatch.setattr(u, "borrow_connection", lambda: conn)
+    with u.db_cursor(unbuffered=True):
+        pass
+    assert conn.closed
+    assert pool == []
+
+
+class SecretsManager(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls = self.calls + 1
+        return {"SecretString": json.dumps({"host": "h", "call": self.calls})}
+
+
+def testSecretCached(monkeypatch):
+    asm = SecretsManager()
+    monkeypatch.setattr(u.boto3, "client", lambda *args, **kwargs: asm)
+    monkeypatch.setattr(u, "_secret", None)
+    monkeypatch.setattr(u, "_secret_time", 0)
+
+    assert u.get_db_secret()["call"] == 1
+    assert u.get_db_secret()["call"] == 1
+    assert u.get_db_secret(refresh=True)["call"] == 2
+
+    monkeypatch.setattr(u, "SECRET_TTL", 0)
+    assert u.get_db_secret()["call"] == 3
+    assert asm.calls == 3
+
+
+### EOF
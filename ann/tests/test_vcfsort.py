@@ -0,0 +1,121 @@
+# test_vcfsort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the external merge sort of unsorted uploads
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import random
+import shutil
+
+import pytest
+
+import vcfsort as vs
+from conftest import annotate, assertSame, shuffleVcf
+
+HEADER = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+"""Unsorted VCF lines of random records on several chromosomes, with
+   repeated positions and header lines in the middle
+"""
+
+
+def unsortedLines(count, seed=1):
+    rng = random.Random(seed)
+    lines = ["##fileformat=VCFv4.1\n", HEADER]
+    for i in range(count):
+        chrom = rng.choice(["1", "2", "10", "X", "chrY", "MT"])
+        pos = rng.randint(1, 300)
+        lines.append(f"{chrom}\t{str(pos)}\t.\tA\tG\t.\t.\tN={str(i)}\n")
+        if i % 97 == 0:
+            lines.append(f"##note={str(i)}\n")
+    return lines
+
+
+def writeLines(path, lines):
+    with open(path, "w") as fh:
+        fh.writelines(lines)
+
+
+def readLines(path):
+    with open(path) as fh:
+        return fh.readlines()
+
+
+def expectedSort(lines):
+    headers = [l for l in lines if l.startswith("#")]
+    records = [l for l in lines if not l.startswith("#")]
+    return headers + sorted(records, key=vs.recordKey)
+
+
+@pytest.mark.parametrize("fanin", [vs.MERGE_FANIN, 3])
+def testSortAndRestore(fanin, tmp_path, monkeypatch):
+    runs = []
+    writeRun = vs.writeRun
+
+    def countingWriteRun(directory, entries):
+        path = writeRun(directory, entries)
+        runs.append(path)
+        return path
+
+    monkeypatch.setattr(vs, "writeRun", countingWriteRun)
+    monkeypatch.setattr(vs, "MERGE_FANIN", fanin)
+
+    vcf = str(tmp_path / "unsorted.vcf")
+    lines = unsortedLines(2000)
+    writeLines(vcf, lines)
+    assert not vs.isSorted(vcf)
+
+    ## small chunks: many runs, merged in several passes when fanin is 3
+    order = vs.sortVcf(vcf, chunk_bytes=8 * 1024)
+    assert len(runs) > fanin
+    assert readLines(vcf) == expectedSort(lines)
+    assert vs.isSorted(vcf)
+
+    annotated = vcf + ".annot"
+    shutil.copy(vcf, annotated)
+    vs.restoreOrder(annotated, order, chunk_bytes=8 * 1024)
+    assert readLines(annotated) == lines
+    assert not os.path.exists(order)
+    ## no runs or temporary directories left behind
+    assert sorted(os.listdir(str(tmp_path))) == ["unsorted.vcf", "unsorted.vcf.annot"]
+
+
+def testSortedInputLeftAsItIs(tmp_path):
+    vcf = str(tmp_path / "sorted.vcf")
+    lines = expectedSort(unsortedLines(200))
+    writeLines(vcf, lines)
+    assert vs.sortVcf(vcf) is None
+    assert readLines(vcf) == lines
+
+
+def testLastLineWithoutNewline(tmp_path):
+    vcf = str(tmp_path / "unsorted.vcf")
+    writeLines(vcf, [HEADER, "1\t9\t.\tA\tG\t.\t.\t.\n", "1\t5\t.\tA\tG\t.\t.\t."])
+    order = vs.sortVcf(vcf)
+    assert readLines(vcf) == [
+        HEADER,
+        "1\t5\t.\tA\tG\t.\t.\t.\n",
+        "1\t9\t.\tA\tG\t.\t.\t.\n",
+    ]
+    vs.restoreOrder(vcf, order)
+    assert readLines(vcf)[1] == "1\t9\t.\tA\tG\t.\t.\t.\n"
+
+
+"""An unsorted upload is sorted for the sweep and given back in the order
+   it came in: the same output as the per-file pipeline on the same file
+"""
+
+
+def testSortedSweepOfUnsortedInput(reference_db, shuffled, tmp_path):
+    assert not vs.isSorted(shuffled["premium_3.vcf"])
+    expected = annotate(shuffled, str(tmp_path / "per-file"))
+    results = annotate(shuffled, str(tmp_path / "sorted"), sort=True, sweep=True)
+    assertSame(results, expected)
+
+
+### EOF
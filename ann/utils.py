@@ -13,15 +13,42 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import os
 import json
+import threading
+import time
+from contextlib import contextmanager
+
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+import localdb
+
+# Seconds the RDS secret is reused before Secrets Manager is asked again
+SECRET_TTL = int(os.environ.get("ANN_DB_SECRET_TTL", 300))
+
+# Idle connections kept open per process
+POOL_SIZE = int(os.environ.get("ANN_DB_POOL_SIZE", 8))
+
+_secret = None
+_secret_time = 0
+_pool = []
+_pool_pid = os.getpid()
+_pool_lock = threading.Lock()
+
+"""Get RDS credentials from AWS Secrets Manager, cached for SECRET_TTL seconds
 """
 
 
-def db_connect():
+def get_db_secret(refresh=False):
+    global _secret, _secret_time
+
+    if (
+        not refresh
+        and _secret is not None
+        and (time.time() - _secret_time) < SECRET_TTL
+    ):
+        return _secret
+
     AWS_REGION_NAME = (
         os.environ["AWS_REGION_NAME"]
         if ("AWS_REGION_NAME" in os.environ)
@@ -32,11 +59,36 @@ def db_connect():
     asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
     try:
         asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
+        _secret = json.loads(asm_response["SecretString"])
+        _secret_time = time.time()
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
+    return _secret
+
+
+"""Open a new connection to the reference database
+   ANN_DB_BACKEND selects the RDS database (mysql) or a local sqlite or
+   duckdb file at ANN_DB_PATH (see localdb.py)
+"""
+
+
+def open_db_connection():
+    backend = os.environ.get("ANN_DB_BACKEND", "mysql")
+    if backend != "mysql":
+        return localdb.connect(backend, os.environ.get("ANN_DB_PATH", "annotator.db"))
+
+    try:
+        rds_secret = get_db_secret()
+        return connect_with_secret(rds_secret)
+    except pymysql.err.OperationalError:
+        # The cached secret may have been rotated; fetch it again once
+        rds_secret = get_db_secret(refresh=True)
+        return connect_with_secret(rds_secret)
+
+
+def connect_with_secret(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret["host"]
     mysql_port = rds_secret["port"]
@@ -46,10 +98,113 @@ def db_connect():
 
     # Return a connection to the database
     return pymysql.connect(
-        host=rds_host, port=mysql_port, user=username, passwd=password, db=database_name
+        host=rds_host,
+        port=mysql_port,
+        user=username,
+        passwd=password,
+        db=database_name,
+        autocommit=True,
     )
 
 
+"""Connection handed out by the pool; close() returns it to the pool
+   instead of closing the socket
+"""
+
+
+class PooledConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self, *args):
+        return self.conn.cursor(*args)
+
+    def close(self):
+        if self.conn is not None:
+            return_connection(self.conn)
+            self.conn = None
+
+
+"""Take a live connection from the process-wide pool, opening one if the
+   pool is empty; idle connections are health-checked with a ping
+"""
+
+
+def borrow_connection():
+    global _pool, _pool_pid
+
+    conn = None
+    with _pool_lock:
+        # Connections inherited from a parent process must not be shared
+        if _pool_pid != os.getpid():
+            _pool = []
+            _pool_pid = os.getpid()
+        if len(_pool) > 0:
+            conn = _pool.pop()
+
+    if conn is not None:
+        try:
+            conn.ping(reconnect=True)
+            return conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    return open_db_connection()
+
+
+def return_connection(conn):
+    with _pool_lock:
+        if _pool_pid == os.getpid() and len(_pool) < POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn.close()
+
+
+"""Borrow a cursor for the duration of a with block
+   unbuffered gives an SSCursor, whose rows are read from the server as
+   they are iterated; the cursor is closed when the block ends, which reads
+   the rows left, and a connection whose cursor fails to close is dropped
+   instead of going back to the pool
+"""
+
+
+@contextmanager
+def db_cursor(unbuffered=False):
+    conn = borrow_connection()
+    if unbuffered:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+    else:
+        cursor = conn.cursor()
+    try:
+        yield cursor
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+        if conn is not None:
+            return_connection(conn)
+
+
+"""Get connection to reference database
+   The connection comes from the process-wide pool; close() gives it back
+"""
+
+
+def db_connect():
+    return PooledConnection(borrow_connection())
+
+
 """Column inices for pileup and VCF
 """
 
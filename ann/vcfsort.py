@@ -0,0 +1,260 @@
+# vcfsort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# External merge sort of VCF records by coordinate
+#
+# sortVcf() rewrites an unsorted VCF with its records grouped by chromosome
+# and sorted by position, in chunks of at most chunk_bytes held in memory:
+# each chunk is sorted and written to a temporary run, and the runs are
+# merged with a k-way heap merge. The original line number of every output
+# line is kept in vcf + .order, so restoreOrder() can put the annotated
+# file back in the order it was uploaded in, with the same bounded memory.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from array import array
+
+import annotate as ann
+import file_utils as fu
+
+# Bytes of memory taken by the lines sorted at a time, their sort keys
+# included
+CHUNK_BYTES = 32 * 1024 * 1024
+
+# Memory of a chunk entry besides its line: the (key, line number, line)
+# tuple, the coordinate key and its ints, and the list slot; measured with
+# tracemalloc at about 250 bytes, several times a short VCF line
+ENTRY_BYTES = 256
+
+# Runs merged at a time; more runs are merged in several passes
+MERGE_FANIN = 64
+
+# Line numbers read from or written to the .order file at a time
+ORDER_BLOCK = 65536
+
+"""Sort key of a chromosome: numbered ones first, by number, then the
+   others by name, with or without the "chr" prefix
+"""
+
+
+def chromKey(chrom):
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
+    if chrom.isdigit():
+        return (0, int(chrom), "")
+    return (1, 0, chrom)
+
+
+def recordKey(line, sep="\t"):
+    fields = line.split(sep, 2)
+    return (chromKey(fields[0].strip()), int(fields[1].strip()))
+
+
+"""True if every chromosome's records are consecutive and in position
+   order, which is all the sweep, index and shard strategies need
+"""
+
+
+def isSorted(vcf, sep="\t"):
+    done = set()
+    chrom = None
+    pos = None
+    fh = open(vcf)
+    try:
+        for line in fh:
+            line = line.strip()
+            if ann.isHeader(line):
+                continue
+            key = recordKey(line, sep)
+            if key[0] != chrom:
+                if key[0] in done:
+                    return False
+                if chrom is not None:
+                    done.add(chrom)
+                chrom = key[0]
+            elif key[1] < pos:
+                return False
+            pos = key[1]
+    finally:
+        fh.close()
+    return True
+
+
+"""Runs: temporary files of "<line number>\t<line>" sorted by key, where
+   key is computed again from the line number and line when merging
+"""
+
+
+def writeRun(directory, entries):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(fd, "w") as fh:
+        for entry in entries:
+            fh.write(str(entry[1]) + "\t" + entry[2])
+    return path
+
+
+def readRun(path, key):
+    with open(path) as fh:
+        for line in fh:
+            index, line = line.split("\t", 1)
+            index = int(index)
+            yield (key(index, line), index, line)
+
+
+"""Sorts (line number, line) pairs by key(line number, line) into runs of
+   entries taking at most chunk_bytes of memory each
+"""
+
+
+def sortRuns(lines, key, directory, chunk_bytes=CHUNK_BYTES):
+    runs = []
+    chunk = []
+    size = 0
+    for index, line in lines:
+        chunk.append((key(index, line), index, line))
+        size = size + sys.getsizeof(line) + ENTRY_BYTES
+        if size >= chunk_bytes:
+            chunk.sort()
+            runs.append(writeRun(directory, chunk))
+            chunk = []
+            size = 0
+    if len(chunk) > 0 or len(runs) == 0:
+        chunk.sort()
+        runs.append(writeRun(directory, chunk))
+    return runs
+
+
+"""Yields the (key, line number, line) entries of runs in key order,
+   merging at most MERGE_FANIN runs at a time
+"""
+
+
+def mergeRuns(runs, key, directory):
+    while len(runs) > MERGE_FANIN:
+        merged = []
+        for i in range(0, len(runs), MERGE_FANIN):
+            group = runs[i : i + MERGE_FANIN]
+            merged.append(
+                writeRun(directory, heapq.merge(*[readRun(r, key) for r in group]))
+            )
+            for run in group:
+                fu.delete(run)
+        runs = merged
+    return heapq.merge(*[readRun(r, key) for r in runs])
+
+
+def writeOrder(fh, indices):
+    array("q", indices).tofile(fh)
+    del indices[:]
+
+
+"""Sorts the records of vcf by coordinate, in place, when they are not
+   sorted yet; header lines are moved to the top. Returns the path of the
+   .order file to hand to restoreOrder(), or None if vcf was left as it is.
+"""
+
+
+def sortVcf(vcf, sep="\t", chunk_bytes=CHUNK_BYTES):
+    if isSorted(vcf, sep):
+        return None
+
+    def key(index, line):
+        return recordKey(line, sep)
+
+    directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(vcf)))
+    try:
+        fh = open(vcf)
+        fh_header = open(os.path.join(directory, "header"), "w")
+        headers = []
+
+        def records():
+            for index, line in enumerate(fh):
+                if not line.endswith("\n"):
+                    line = line + "\n"
+                if ann.isHeader(line.strip()):
+                    fh_header.write(line)
+                    headers.append(index)
+                else:
+                    yield (index, line)
+
+        runs = sortRuns(records(), key, directory, chunk_bytes)
+        fh.close()
+        fh_header.close()
+
+        fh_out = open(vcf + ".sorting", "w")
+        fh_order = open(vcf + ".order", "wb")
+        fh_in = open(os.path.join(directory, "header"))
+        shutil.copyfileobj(fh_in, fh_out)
+        fh_in.close()
+        writeOrder(fh_order, headers)
+
+        indices = []
+        for entry in mergeRuns(runs, key, directory):
+            fh_out.write(entry[2])
+            indices.append(entry[1])
+            if len(indices) >= ORDER_BLOCK:
+                writeOrder(fh_order, indices)
+        writeOrder(fh_order, indices)
+        fh_out.close()
+        fh_order.close()
+    finally:
+        shutil.rmtree(directory)
+
+    os.replace(vcf + ".sorting", vcf)
+    print(f"Sorted {vcf}")
+    return vcf + ".order"
+
+
+"""Puts the lines of path (annotated from a file sorted by sortVcf) back in
+   the original order given by the order file, which is then deleted
+"""
+
+
+def restoreOrder(path, order, chunk_bytes=CHUNK_BYTES):
+    def key(index, line):
+        return index
+
+    directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        fh = open(path)
+        fh_order = open(order, "rb")
+
+        def lines():
+            indices = array("q")
+            i = 0
+            for line in fh:
+                if i == len(indices):
+                    indices = array("q")
+                    try:
+                        indices.fromfile(fh_order, ORDER_BLOCK)
+                    except EOFError:
+                        ## fromfile keeps the items it could read
+                        pass
+                    i = 0
+                yield (indices[i], line)
+                i = i + 1
+
+        runs = sortRuns(lines(), key, directory, chunk_bytes)
+        fh.close()
+        fh_order.close()
+
+        fh_out = open(path + ".restoring", "w")
+        for entry in mergeRuns(runs, key, directory):
+            fh_out.write(entry[2])
+        fh_out.close()
+    finally:
+        shutil.rmtree(directory)
+
+    os.replace(path + ".restoring", path)
+    fu.delete(order)
+
+
+### EOF